@@ -27,10 +27,12 @@ process echo_files {
         """
 }
 include { validate_reads } from "./workflows/modules/validate.nf"
-include { host_filter; subsample_reads } from "./workflows/modules/host_filter.nf"
+include { host_filter; subsample_reads; adaptive_sample } from "./workflows/modules/host_filter.nf"
+include { dedup_reads } from "./workflows/modules/dedup.nf"
 include { pathogen_alignment; assign_taxon } from "./workflows/modules/pathogen_alignment.nf"
 include { abundance_calculation } from "./workflows/modules/abundance_calculation.nf"
-include { summary_report } from "./workflows/modules/summary_report.nf"  
+include { summary_report; taxon_report } from "./workflows/modules/summary_report.nf"
+include { coverage } from "./workflows/modules/coverage.nf"  
 
 script_dir = file("$workflow.projectDir").getParent() 
 println "Project : $workflow.projectDir"
@@ -47,12 +49,33 @@ workflow {
 
     validated_reads = validate_reads(reads)
     nonhuman_ch = host_filter(validated_reads.valid_reads)
-    subsampled_ch = subsample_reads(nonhuman_ch.nonhuman_reads)
+    if (params.adaptive) {
+        hit_ch = adaptive_sample(nonhuman_ch.nonhuman_reads).hit_json
+    } else {
+        subsampled_ch = subsample_reads(nonhuman_ch.nonhuman_reads)
 
-    hit_ch = pathogen_alignment(subsampled_ch.subsampled_reads.collect()).flatten()
-    taxon_ch = assign_taxon(hit_ch)
-    abundance_ch = abundance_calculation(taxon_ch.hit_json, taxon_ch.taxon_json)
-    summary_report(abundance_ch.hit_json, abundance_ch.taxon_json, abundance_ch.rpm_json)
-        .view { "summary report: $it" }
+        query_ch = params.dedup ? dedup_reads(subsampled_ch.subsampled_reads).dedup_reads : subsampled_ch.subsampled_reads
+
+        hit_ch = pathogen_alignment(query_ch.collect()).hit_json.flatten()
+    }
+    if (params.fused_report) {
+        report_ch = taxon_report(hit_ch.collect())
+        report_ch.report.flatten()
+            .view { "summary report: $it" }
+        taxon_ch = report_ch.taxon_json.flatten()
+            .map { [it.name.tokenize('.')[0], it] }
+        sample_ch = hit_ch.map { [it.name.tokenize('.')[0], it] }.join(taxon_ch)
+    } else {
+        taxon_ch = assign_taxon(hit_ch.collect()).taxon_json.flatten()
+            .map { [it.name.tokenize('.')[0], it] }
+        sample_ch = hit_ch.map { [it.name.tokenize('.')[0], it] }.join(taxon_ch)
+        abundance_ch = abundance_calculation(sample_ch.map { it[1] }, sample_ch.map { it[2] })
+        summary_report(abundance_ch.hit_json, abundance_ch.taxon_json, abundance_ch.rpm_json).report
+            .view { "summary report: $it" }
+    }
+
+    if (params.coverage) {
+        coverage(sample_ch)
+    }
 
 }
\ No newline at end of file
@@ -1,19 +1,29 @@
 #!/usr/bin/env python
+import numpy as np
+import pandas as pd
 
+from modules.taxonparse import RANKS, count_taxids
 
-def get_rpm(read2taxon, rank="species"):
+
+def get_rpm(taxonomy, rank="species", count_mode="total"):
     """
     Calculate relative abundance of each taxon
-
+    taxonomy: normalized taxonomy, see taxonparse.normalize_taxonomy -> dict
+    count_mode: "total" weights reads by their dedup multiplicity,
+                "dedup" counts each unique read once -> str
     """
     taxid2rpm = {}
     total_n = 0
-    for read_id, taxon in read2taxon.items():
-        if taxon["lineage"].get(rank):
-            total_n += 1
-            taxid = taxon["lineage"][rank]["taxid"]
-            taxid2rpm.setdefault(taxid, {"rpm": 0, "hit_n": 0, "taxon": taxon})
-            taxid2rpm[taxid]["hit_n"] += 1
+    for taxid, n in count_taxids(taxonomy, count_mode=count_mode).items():
+        lineage = taxonomy["lineages"].get(taxid)
+        if lineage and lineage.get(rank):
+            total_n += n
+            rank_taxid = lineage[rank]["taxid"]
+            taxid2rpm.setdefault(
+                rank_taxid,
+                {"rpm": 0, "hit_n": 0, "taxon": {"taxid": taxid, "lineage": lineage}},
+            )
+            taxid2rpm[rank_taxid]["hit_n"] += n
 
     for taxid in list(taxid2rpm.keys()):
         taxid2rpm[taxid]["rpm"] = (taxid2rpm[taxid]["hit_n"] / total_n) * (10**6)
@@ -21,5 +31,130 @@ def get_rpm(read2taxon, rank="species"):
     return taxid2rpm
 
 
+def add_length_normalization(taxid2rpm, taxonomy, length_index, rank="species"):
+    """
+    Add length-normalized RPKM and TPM to the output of get_rpm.
+    The length of a taxon is the mean reference sequence length over the
+    assigned taxids below it; taxa without known length get None.
+    taxid2rpm: output of get_rpm -> dict
+    taxonomy: normalized taxonomy, see taxonparse.normalize_taxonomy -> dict
+    length_index: reference length index -> RefLengthIndex
+    return: taxid2rpm with "rpkm" and "tpm" -> dict
+    """
+    taxids = list(taxonomy["lineages"].keys())
+    total_lens, seq_ns = length_index.taxid_length(taxids)
+    rank_taxid2len = {}
+    for taxid, total_len, seq_n in zip(taxids, total_lens, seq_ns):
+        lineage = taxonomy["lineages"][taxid]
+        if not lineage or not lineage.get(rank):
+            continue
+        len_n = rank_taxid2len.setdefault(lineage[rank]["taxid"], [0, 0])
+        len_n[0] += int(total_len)
+        len_n[1] += int(seq_n)
+
+    total_n = sum(values["hit_n"] for values in taxid2rpm.values())
+    taxid2rate = {}
+    for taxid, values in taxid2rpm.items():
+        total_len, seq_n = rank_taxid2len.get(taxid, (0, 0))
+        if total_len == 0:
+            values["rpkm"] = None
+            continue
+        kb = total_len / seq_n / 10**3
+        values["rpkm"] = values["hit_n"] / kb / (total_n / 10**6)
+        taxid2rate[taxid] = values["hit_n"] / kb
+    rate_sum = sum(taxid2rate.values())
+    for taxid, values in taxid2rpm.items():
+        values["tpm"] = (
+            taxid2rate[taxid] / rate_sum * 10**6 if taxid in taxid2rate else None
+        )
+    return taxid2rpm
+
+
+def get_rank_rpm(taxonomy, ranks=RANKS, count_mode="total", taxid2n=None):
+    """
+    Calculate relative abundance at every rank in one pass.
+    Reads are counted once at their assigned taxid, then the counts are rolled
+    up to each rank of the lineage with array-indexed accumulators.
+    taxonomy: normalized taxonomy, see taxonparse.normalize_taxonomy -> dict
+    ranks: ranks to report -> tuple
+    count_mode: "total" or "dedup", see get_rpm -> str
+    taxid2n: reads per assigned taxid if already counted, see
+        taxonparse.count_taxids -> dict
+    return: tidy table with rank, taxid, name, hit_n, rpm -> pd.DataFrame
+    """
+    if taxid2n is None:
+        taxid2n = count_taxids(taxonomy, count_mode=count_mode)
+    lineages = [taxonomy["lineages"].get(taxid) or {} for taxid in taxid2n]
+    node_counts = np.fromiter(taxid2n.values(), dtype=np.int64, count=len(taxid2n))
+
+    tables = []
+    for rank in ranks:
+        rank_taxid2idx = {}
+        rank_names = []
+        parent_idx = np.full(len(lineages), -1, dtype=np.int64)
+        for i, lineage in enumerate(lineages):
+            node = lineage.get(rank)
+            if not node:
+                continue
+            j = rank_taxid2idx.get(node["taxid"])
+            if j is None:
+                j = rank_taxid2idx[node["taxid"]] = len(rank_names)
+                rank_names.append(node["name"])
+            parent_idx[i] = j
+        mask = parent_idx >= 0
+        hit_n = np.bincount(
+            parent_idx[mask], weights=node_counts[mask], minlength=len(rank_names)
+        ).astype(np.int64)
+        total_n = hit_n.sum()
+        tables.append(
+            pd.DataFrame(
+                {
+                    "rank": rank,
+                    "taxid": list(rank_taxid2idx.keys()),
+                    "name": rank_names,
+                    "hit_n": hit_n,
+                    "rpm": hit_n / total_n * (10**6) if total_n else 0.0,
+                }
+            ).sort_values("rpm", ascending=False, kind="stable")
+        )
+    return pd.concat(tables, ignore_index=True)
+
+
+def calculate_abundance(taxonomy, count_mode="total", length_index=None):
+    """
+    Species rPM (and RPKM and TPM with a length index) and rPM at every rank
+    taxonomy: normalized taxonomy, see taxonparse.normalize_taxonomy -> dict
+    count_mode: "total" or "dedup", see get_rpm -> str
+    length_index: reference length index -> RefLengthIndex
+    return: (taxid -> {"rpm", "hit_n", "taxon", ...}, rank table) -> tuple
+    """
+    taxid2n = count_taxids(taxonomy, count_mode=count_mode)
+    rank_df = get_rank_rpm(taxonomy, count_mode=count_mode, taxid2n=taxid2n)
+
+    # same as get_rpm: the taxon of a species is its first assigned taxid
+    species2taxid = {}
+    for taxid in taxid2n:
+        lineage = taxonomy["lineages"].get(taxid)
+        if lineage and lineage.get("species"):
+            species2taxid.setdefault(lineage["species"]["taxid"], taxid)
+    taxid2rpm = {}
+    for row in rank_df[rank_df["rank"] == "species"].itertuples(index=False):
+        taxid = species2taxid[row.taxid]
+        taxid2rpm[row.taxid] = {
+            "rpm": float(row.rpm),
+            "hit_n": int(row.hit_n),
+            "taxon": {"taxid": taxid, "lineage": taxonomy["lineages"][taxid]},
+        }
+    if length_index is not None:
+        add_length_normalization(taxid2rpm, taxonomy, length_index)
+    return taxid2rpm, rank_df
+
+
 def get_zscore(taxon, background_model):
-    pass
+    """
+    Z score of a taxon against the background model
+    taxon: {"taxid": ..., "rpm": ...} -> dict
+    background_model: background model of control samples -> BackgroundModel
+    return: z score -> float
+    """
+    return float(background_model.zscores([taxon["taxid"]], [taxon["rpm"]])[0])
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+import json
+import tempfile
+from pathlib import Path
+
+from modules.common import parse_fastq
+from modules.subsample import seqtk_sample
+from modules.alignment import aln_with_minimap2, call_hits, minimap2_index
+from modules.taxonparse import get_lineage
+from modules.report import SpeciesAccumulator
+
+
+def top_rpm(accumulator, top_n):
+    """
+    return: taxid -> rpm of the top_n species -> dict
+    """
+    taxid2rpm = accumulator.get_rpm()
+    return {taxid: values["rpm"] for taxid, values in list(taxid2rpm.items())[:top_n]}
+
+
+def rpm_change(prev, curr):
+    """
+    Largest relative change of rPM over the top species of both batches.
+    A species entering or leaving the top list counts as a change of 1.
+    No species after two batches in a row counts as converged, a single batch
+    without hits may just be too shallow.
+    prev: top rpm of the previous batch, None before the first batch -> dict
+    curr: top rpm of the current batch -> dict
+    return: relative change -> float
+    """
+    if prev is None:
+        return 1.0
+    if not curr and not prev:
+        return 0.0
+    if set(prev) != set(curr):
+        return 1.0
+    return max(abs(curr[taxid] - prev[taxid]) / prev[taxid] for taxid in curr)
+
+
+def adaptive_sample(
+    reads,
+    reference,
+    taxdump_dir,
+    out_dir,
+    start_n=100000,
+    max_n=1000000,
+    growth=2.0,
+    top_n=10,
+    tolerance=0.05,
+    read_type="illumina",
+    threads=0,
+):
+    """
+    Subsample reads in growing batches until the top species rPM are stable.
+    A random pool of max_n reads is drawn once; batches of start_n, start_n *
+    growth, ... reads are aligned and assigned in turn, and sampling stops when
+    the top_n species are the same as after the previous batch and none of
+    their rPM changed by more than tolerance. The minimap2 index is built once
+    (or taken prebuilt from next to reference) and only loaded per batch.
+    reads: path to fastq file -> Path
+    reference: path to target FASTA file or .mmi index -> Path
+    taxdump_dir: path to taxdump directory -> Path
+    out_dir: path to output directory -> Path
+    start_n: reads in the first batch -> int
+    max_n: maximum number of reads -> int
+    growth: factor by which the total depth grows per batch -> float
+    top_n: number of species compared between batches -> int
+    tolerance: maximum relative rPM change to stop -> float
+    return: paths of the subsampled fastq, hit json and trace -> dict
+    """
+    out_dir = Path(out_dir)
+    sample_id = reads.name.split(".")[0]
+    preset = None if read_type == "illumina" else "map-ont"
+    outputs = {
+        "subsampled_fq": out_dir / f"{sample_id}.subsampled.fq",
+        "hit_json": out_dir / f"{sample_id}.hit.json",
+        "trace_json": out_dir / f"{sample_id}.adaptive.json",
+    }
+
+    accumulator = SpeciesAccumulator()
+    taxid2lineage = {}
+    hits = []
+    trace = []
+    read_n = 0
+    target_n = start_n
+    prev = None
+
+    with tempfile.TemporaryDirectory(prefix="adaptive_", dir=out_dir) as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        index = minimap2_index(
+            reference, index_dir=tmp_dir, preset=preset, threads=threads
+        )
+        pool = seqtk_sample(reads, max_n, tmp_dir / "pool.fq", sample_id=sample_id)
+        pool_records = parse_fastq(pool)
+        with open(outputs["subsampled_fq"], "w") as f_out:
+            while True:
+                batch_fq = tmp_dir / "batch.fq"
+                batch_n = 0
+                with open(batch_fq, "w") as f_batch:
+                    for name, seq, qual in pool_records:
+                        record = f"@{name}\n{seq}\n+\n{qual}\n"
+                        f_batch.write(record)
+                        f_out.write(record)
+                        batch_n += 1
+                        if read_n + batch_n >= target_n:
+                            break
+                if batch_n == 0:
+                    break
+                read_n += batch_n
+
+                paf = aln_with_minimap2(
+                    target=index,
+                    queries=batch_fq,
+                    preset=preset,
+                    work_dir=tmp_dir,
+                    threads=threads,
+                )
+                batch_hits = call_hits(paf=paf).get(sample_id, [])
+                hits.extend(batch_hits)
+                new_taxids = set(hit["tname"].split("|")[1] for hit in batch_hits)
+                new_taxids -= taxid2lineage.keys()
+                if new_taxids:
+                    taxid2lineage.update(get_lineage(new_taxids, taxdump_dir))
+                for hit in {hit["qname"]: hit for hit in batch_hits}.values():
+                    taxid = hit["tname"].split("|")[1]
+                    accumulator.add(
+                        hit, {"taxid": taxid, "lineage": taxid2lineage.get(taxid)}
+                    )
+
+                curr = top_rpm(accumulator, top_n)
+                change = rpm_change(prev, curr)
+                trace.append(
+                    {
+                        "reads": read_n,
+                        "hit_n": accumulator.total_n,
+                        "change": round(change, 4),
+                        "top_rpm": curr,
+                    }
+                )
+                print(
+                    f"adaptive sampling: {read_n} reads, {accumulator.total_n} hits, "
+                    f"top {top_n} rPM change {change:.2%}"
+                )
+                # stop when converged or when the pool has no reads left
+                if change <= tolerance or read_n < target_n or read_n >= max_n:
+                    break
+                prev = curr
+                target_n = min(int(target_n * growth), max_n)
+
+    outputs["hit_json"].write_text(json.dumps(hits, indent=4))
+    outputs["trace_json"].write_text(
+        json.dumps(
+            {
+                "converged": bool(trace) and trace[-1]["change"] <= tolerance,
+                "top_n": top_n,
+                "tolerance": tolerance,
+                "batches": trace,
+            },
+            indent=2,
+        )
+    )
+    return outputs
@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+import os
 import json
 import click
 from click_option_group import optgroup, GroupedOption
@@ -8,8 +9,24 @@ from pathlib import Path
 import subprocess
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from modules.common import set_threads, CONTEXT_SETTINGS, BaseNameType
+from modules.common import (
+    set_threads,
+    parse_fastq,
+    instrument,
+    run_pipeline,
+    CONTEXT_SETTINGS,
+    BaseNameType,
+)
 from modules.taxonparse import get_lineage
+from modules.dedup import get_read_count, strip_read_count
+from modules.aln_cache import AlignmentCache, reference_fingerprint
+from modules.extsort import group_paf, MAX_MEM
+from modules.subsample import count_reads
+from modules.report import IncrementalReport
+from modules.progress import track_stage
+
+# reads aligned per minimap2 run in incremental mode, each run ends in a snapshot
+CHUNK_READS = 250000
 
 
 def parse_paf(paf=None, line=None):
@@ -52,13 +69,16 @@ def parse_paf(paf=None, line=None):
             line_dct[tag] = int(value) if tag_type == "i" else value
         return line_dct
 
+    def _iter_paf(paf):
+        with open(paf, "r") as f:
+            for line in f:
+                yield _parse_line(line)
+
     if line:
         line = _parse_line(line)
         return line
     elif paf:
-        with open(paf, "r") as f:
-            for line in f.readlines():
-                yield _parse_line(line)
+        return _iter_paf(paf)
     else:
         raise ValueError("Either paf or line must be provided.")
 
@@ -121,23 +141,101 @@ def aln_with_minimap2(
         else:
             mm2_cmd.append(queries)
         print(" ".join([str(i) for i in mm2_cmd]))
-        mm2_proc = subprocess.run(mm2_cmd)
+        with instrument("minimap2"):
+            mm2_proc = subprocess.run(mm2_cmd)
         if mm2_proc.returncode != 0:
             raise subprocess.CalledProcessError(mm2_proc.returncode, mm2_proc.args)
 
     return out_paf
 
 
-def call_hits(paf=None, taxdump_dir=None):
+@set_threads
+def minimap2_index(reference, index_dir=None, k=14, w=8, preset=None, threads=0):
+    """
+    Split minimap2 index (-I 8G parts, like aln_with_minimap2) of reference,
+    built once so that repeated alignments only load it. A prebuilt index next
+    to reference, e.g. non_human_nt.fna.k14w8.mmi from build_db, is used as is.
+    reference: path to target FASTA file or .mmi index -> pathlib.Path
+    index_dir: where to build the index, default next to reference -> pathlib.Path
+    return: path to .mmi index -> pathlib.Path
+    """
+    reference = Path(reference)
+    if reference.suffix == ".mmi":
+        return reference
+    name = f"{reference.name}.{preset or f'k{k}w{w}'}.mmi"
+    prebuilt = reference.with_name(name)
+    if prebuilt.is_file():
+        return prebuilt
+    index_dir = reference.parent if index_dir is None else Path(index_dir)
+    mmi = index_dir / name
+    if mmi.is_file():
+        return mmi
+    tmp_mmi = index_dir / f".{name}.{os.getpid()}.tmp"
+    mm2_cmd = ["minimap2", "-d", str(tmp_mmi), "-I", "8G", "-t", str(threads)]
+    if preset:
+        mm2_cmd.extend(["-x", preset])
+    else:
+        mm2_cmd.extend(["-k", str(k), "-w", str(w)])
+    mm2_cmd.append(str(reference))
+    print(" ".join(mm2_cmd))
+    try:
+        with instrument("minimap2_index"):
+            run_pipeline([mm2_cmd])
+        os.replace(tmp_mmi, mmi)
+    finally:
+        tmp_mmi.unlink(missing_ok=True)
+    return mmi
+
+
+def iter_query_chunks(queries, chunk_reads, work_dir):
+    """
+    Split reads into FASTQ files of at most chunk_reads reads
+    queries: path to query FASTQ files -> list
+    chunk_reads: reads per chunk -> int
+    work_dir: directory of the chunks -> pathlib.Path
+    return: path to each chunk, removed once the next one is requested -> generator
+    """
+    chunk_fq = Path(work_dir) / "chunk.fq"
+    f = None
+    read_n = 0
+    for query in queries:
+        for name, seq, qual in parse_fastq(query):
+            if f is None:
+                f = open(chunk_fq, "w")
+            f.write(f"@{name}\n{seq}\n+\n{qual}\n")
+            read_n += 1
+            if read_n == chunk_reads:
+                f.close()
+                yield chunk_fq
+                f = None
+                read_n = 0
+    if f is not None:
+        f.close()
+        yield chunk_fq
+    chunk_fq.unlink(missing_ok=True)
+
+
+def pass_hit_filter(aln_rec):
+    """
+    Keep primary alignments covering at least 90% of the read
+    """
+    return aln_rec["tp"] == "P" and aln_rec["alnlen"] >= aln_rec["qlen"] * 0.9
+
+
+def call_hits(paf=None, taxdump_dir=None, alignments=None):
     """
     Assign reads to taxon
+    Reads collapsed by dedup keep their multiplicity in hit["count"].
+    alignments: parsed alignments used instead of paf -> list
     """
     # taxids = set()
     sample2hits = {}
-    for aln_rec in parse_paf(paf=paf):
-        if aln_rec["tp"] != "P" or aln_rec["alnlen"] < aln_rec["qlen"] * 0.9:
+    for aln_rec in parse_paf(paf=paf) if alignments is None else alignments:
+        if not pass_hit_filter(aln_rec):
             continue
 
+        aln_rec["count"] = get_read_count(aln_rec["qname"])
+        aln_rec["qname"] = strip_read_count(aln_rec["qname"])
         read_id = aln_rec["qname"]
         sample_id = read_id.split(".")[0]
         sample2hits.setdefault(sample_id, [])
@@ -145,15 +243,102 @@ def call_hits(paf=None, taxdump_dir=None):
     return sample2hits
 
 
-def select_best_alignment(alignments=[], paf=None):
-    """(Deprecated)
-    Select the best alignment from a list of alignments.
-    iter_alignments: list of alignments -> list
-    return: best alignment -> dict
+def call_hits_incremental(lines, report, progress=None):
+    """
+    call_hits over PAF lines, feeding each read to an incremental report.
+    minimap2 writes the alignments of a read together, so a read is complete
+    as soon as the next query name appears.
+    lines: PAF lines of minimap2 --paf-no-hit -> iterable
+    report: provisional report updated per read -> IncrementalReport
+    progress: stage progress counting processed reads -> track_stage
+    return: same as call_hits -> dict
+    """
+    sample2hits = {}
+
+    def _add_read(qname, aln_recs):
+        sample_id = strip_read_count(qname).split(".")[0]
+        hits = call_hits(alignments=aln_recs).get(sample_id, [])
+        sample2hits.setdefault(sample_id, []).extend(hits)
+        report.add(sample_id, hits[-1] if hits else None)
+        if progress is not None:
+            progress.update()
+
+    qname = None
+    aln_recs = []
+    for line in lines:
+        line_qname = line[: line.find("\t")]
+        if line_qname != qname:
+            if qname is not None:
+                _add_read(qname, aln_recs)
+            qname = line_qname
+            aln_recs = []
+        if line.split("\t", 6)[5] != "*":
+            aln_recs.append(parse_paf(line=line))
+    if qname is not None:
+        _add_read(qname, aln_recs)
+    return sample2hits
+
+
+def aln_incremental(
+    queries,
+    reference,
+    report,
+    preset=None,
+    work_dir=None,
+    threads=0,
+    chunk_reads=CHUNK_READS,
+    progress=None,
+):
+    """
+    Align reads chunk by chunk and write a provisional snapshot after each
+    chunk. Every chunk is aligned like aln_with_minimap2 against a split index
+    built once, so memory stays that of the normal alignment.
+    queries: path to query FASTQ files -> list
+    reference: path to target FASTA file or .mmi index -> pathlib.Path
+    report: provisional report -> IncrementalReport
+    chunk_reads: reads aligned per minimap2 run -> int
+    progress: stage progress counting processed reads -> track_stage
+    return: same as call_hits -> dict
+    """
+    work_dir = Path().cwd() if work_dir is None else Path(work_dir)
+    sample2hits = {}
+    with tempfile.TemporaryDirectory(prefix="incremental_", dir=work_dir) as tmp_dir:
+        index = minimap2_index(
+            reference, index_dir=tmp_dir, preset=preset, threads=threads
+        )
+        for chunk_fq in iter_query_chunks(queries, chunk_reads, tmp_dir):
+            paf = aln_with_minimap2(
+                queries=chunk_fq,
+                target=index,
+                preset=preset,
+                work_dir=tmp_dir,
+                threads=threads,
+                mm2_args={"paf_no_hit": True},
+            )
+            with open(paf) as f:
+                for sample_id, hits in call_hits_incremental(
+                    f, report, progress=progress
+                ).items():
+                    sample2hits.setdefault(sample_id, []).extend(hits)
+            report.snapshot()
+    report.snapshot(final=True)
+    return sample2hits
+
+
+def group_alignments(paf, max_mem=MAX_MEM, tmp_dir=None):
     """
-    best_dct = {}
+    Group alignments by read with an external sort, so PAFs larger than memory
+    can be processed one read at a time.
+    paf: path to PAF file -> str or pathlib.Path
+    max_mem: memory budget of the sort in bytes -> int
+    return: (qname, alignments) per read -> generator
+    """
+    for qname, lines in group_paf(paf, max_mem=max_mem, tmp_dir=tmp_dir):
+        yield qname, [parse_paf(line=line) for line in lines]
+
 
-    for alignment in alignments if alignments else parse_paf(paf=paf):
+def _best_of(alignments, best_dct):
+    for alignment in alignments:
         if alignment["alnlen"] < alignment["qlen"] * 0.9:
             continue
         qname = alignment["qname"]
@@ -163,10 +348,31 @@ def select_best_alignment(alignments=[], paf=None):
             best_dct[qname] = {"pident": pident, "tnames": [tname], "aln": alignment}
         elif pident == best_dct[qname]["pident"]:
             best_dct[qname]["tnames"].append(tname)
-
     return best_dct
 
 
+def iter_best_alignments(paf, max_mem=MAX_MEM, tmp_dir=None):
+    """
+    Best alignments of each read, one read at a time.
+    return: (qname, best alignment) -> generator
+    """
+    for qname, alignments in group_alignments(paf, max_mem=max_mem, tmp_dir=tmp_dir):
+        best_dct = _best_of(alignments, {})
+        if qname in best_dct:
+            yield qname, best_dct[qname]
+
+
+def select_best_alignment(alignments=[], paf=None, max_mem=MAX_MEM):
+    """(Deprecated)
+    Select the best alignment from a list of alignments.
+    iter_alignments: list of alignments -> list
+    return: best alignment -> dict
+    """
+    if alignments:
+        return _best_of(alignments, {})
+    return dict(iter_best_alignments(paf, max_mem=max_mem))
+
+
 def reassign_alignments(best_dct):
     """(Deprecated)
     Reassign alignments to the best reference.
@@ -198,26 +404,151 @@ def reassign_alignments(best_dct):
     return reassign_dct
 
 
-def main(queries, reference, out_dir, threads, read_type, paf=None):
+def aln_with_cache(queries, reference, cache, preset=None, work_dir=None, threads=0):
+    """
+    Look up reads in the alignment cache and align only the misses with minimap2.
+    queries: path to query FASTQ files -> list or pathlib.Path
+    reference: path to target FASTA file -> pathlib.Path
+    cache: alignment cache -> AlignmentCache
+    return: cached and fresh alignments passing the hit filter -> list
+    """
+    work_dir = Path().cwd() if work_dir is None else Path(work_dir)
+    queries = queries if isinstance(queries, (list, tuple)) else [queries]
+    alignments = []
+    miss2key = {}
+    read_n = 0
+
+    with tempfile.TemporaryDirectory(prefix="aln_cache_", dir=work_dir) as tmp_dir:
+        miss_fq = Path(tmp_dir) / "miss.fq"
+        with open(miss_fq, "w") as f:
+
+            def _lookup(batch):
+                keys = [cache.key(seq) for _, seq, _ in batch]
+                found = cache.get_many(keys)
+                for (name, seq, qual), key in zip(batch, keys):
+                    qname = name.split()[0]
+                    if key in found:
+                        alignments.extend(dict(hit, qname=qname) for hit in found[key])
+                    else:
+                        miss2key[qname] = key
+                        f.write(f"@{qname}\n{seq}\n+\n{qual}\n")
+
+            for query in queries:
+                batch = []
+                for rec in parse_fastq(query):
+                    read_n += 1
+                    batch.append(rec)
+                    if len(batch) >= 10000:
+                        _lookup(batch)
+                        batch = []
+                _lookup(batch)
+
+        print(f"alignment cache: {read_n - len(miss2key)} of {read_n} reads found")
+        if miss2key:
+            paf = aln_with_minimap2(
+                target=reference,
+                queries=miss_fq,
+                preset=preset,
+                work_dir=tmp_dir,
+                threads=threads,
+            )
+            qname2hits = {qname: [] for qname in miss2key}
+            for aln_rec in parse_paf(paf=paf):
+                if not pass_hit_filter(aln_rec):
+                    continue
+                qname2hits[aln_rec["qname"]].append(
+                    {k: v for k, v in aln_rec.items() if k != "qname"}
+                )
+                alignments.append(aln_rec)
+            cache.put_many(
+                {miss2key[qname]: hits for qname, hits in qname2hits.items()}
+            )
+    return alignments
+
+
+def main(
+    queries,
+    reference,
+    out_dir,
+    threads,
+    read_type,
+    paf=None,
+    cache_dir=None,
+    cache_size=10,
+    partial_dir=None,
+    taxdump_dir=None,
+    snapshot_interval=60,
+    chunk_reads=CHUNK_READS,
+):
     preset = None if read_type == "illumina" else "map-ont"
     out_dir.mkdir(parents=True, exist_ok=True)
 
-    paf = (
-        aln_with_minimap2(
-            target=reference,
-            queries=queries,
-            preset=preset,
-            work_dir=out_dir,
-            threads=threads,
+    with track_stage("alignment") as progress:
+        if paf is None and partial_dir is not None:
+            queries = queries if isinstance(queries, (list, tuple)) else [queries]
+            report = IncrementalReport(
+                taxdump_dir,
+                partial_dir,
+                total_n=sum(count_reads(query) for query in queries),
+                interval=snapshot_interval,
+            )
+            progress.total = report.total_n
+            sample2hits = aln_incremental(
+                queries,
+                reference,
+                report,
+                preset=preset,
+                work_dir=out_dir,
+                threads=threads,
+                chunk_reads=chunk_reads,
+                progress=progress,
+            )
+        elif paf is None and cache_dir is not None:
+            mm2_version = subprocess.run(
+                ["minimap2", "--version"], stdout=subprocess.PIPE
+            ).stdout.decode()
+            cache = AlignmentCache(
+                cache_dir,
+                reference_fingerprint(
+                    reference, preset=preset, k=14, w=8, minimap2=mm2_version.strip()
+                ),
+                max_bytes=int(cache_size * 1024**3),
+            )
+            try:
+                alignments = aln_with_cache(
+                    queries,
+                    reference,
+                    cache,
+                    preset=preset,
+                    work_dir=out_dir,
+                    threads=threads,
+                )
+            finally:
+                cache.close()
+            sample2hits = call_hits(alignments=alignments)
+        else:
+            paf = (
+                aln_with_minimap2(
+                    target=reference,
+                    queries=queries,
+                    preset=preset,
+                    work_dir=out_dir,
+                    threads=threads,
+                )
+                if paf is None
+                else paf
+            )
+            sample2hits = call_hits(paf=paf)
+        progress.update(
+            0,
+            hits=sum(len(hits) for hits in sample2hits.values()),
+            samples=len(sample2hits),
         )
-        if paf is None
-        else paf
-    )
-    sample2hits = call_hits(paf=paf)
     hit_jsons = []
     for sample_id, hits in sample2hits.items():
         hit_json = out_dir / f"{sample_id}.hit.json"
         hit_json.write_text(json.dumps(hits, indent=4))
+        hit_jsons.append(hit_json)
     return hit_jsons
 
 
@@ -303,6 +634,42 @@ class OptionEatAll(GroupedOption):
     default="illumina",
     show_default=True,
 )
+@optgroup.option(
+    "--cache_dir",
+    help="alignment cache directory, reads found there are not re-aligned",
+    type=click.Path(exists=False, dir_okay=True, resolve_path=True, path_type=Path),
+)
+@optgroup.option(
+    "--cache_size",
+    help="maximum size of the alignment cache in GB",
+    type=click.FLOAT,
+    default=10,
+    show_default=True,
+)
+@optgroup.option(
+    "--partial_dir",
+    help="write provisional rpm/report snapshots here while minimap2 runs",
+    type=click.Path(exists=False, dir_okay=True, resolve_path=True, path_type=Path),
+)
+@optgroup.option(
+    "--taxdump_dir",
+    help="taxdump directory, required with --partial_dir",
+    type=click.Path(exists=True, dir_okay=True, resolve_path=True, path_type=Path),
+)
+@optgroup.option(
+    "--snapshot_interval",
+    help="seconds between snapshots while a chunk is processed",
+    type=click.INT,
+    default=60,
+    show_default=True,
+)
+@optgroup.option(
+    "--chunk_reads",
+    help="reads aligned per minimap2 run with --partial_dir, a snapshot follows each",
+    type=click.INT,
+    default=CHUNK_READS,
+    show_default=True,
+)
 @optgroup.group("Output options")
 @optgroup.option(
     "--out_dir",
@@ -311,13 +678,29 @@ class OptionEatAll(GroupedOption):
     type=click.Path(exists=False, dir_okay=True, resolve_path=True, path_type=Path),
     required=True,
 )
-def cli(queries, reference, paf, out_dir, threads, read_type):
+@instrument("pathogen_alignment", sample_from="queries")
+def cli(
+    queries,
+    reference,
+    paf,
+    out_dir,
+    threads,
+    read_type,
+    cache_dir,
+    cache_size,
+    partial_dir,
+    taxdump_dir,
+    snapshot_interval,
+    chunk_reads,
+):
     if queries is None and paf is None:
         raise ValueError("Either queries or paf must be provided.")
     if queries is not None and paf is not None:
         raise ValueError("Only one of queries or paf must be provided.")
     if queries is None and reference is None and paf is None:
         raise ValueError("reference and queries must be provided.")
+    if partial_dir is not None and taxdump_dir is None:
+        raise ValueError("taxdump_dir must be provided with partial_dir.")
 
     hit_jsons = main(
         queries=queries,
@@ -326,6 +709,12 @@ def cli(queries, reference, paf, out_dir, threads, read_type):
         out_dir=out_dir,
         threads=threads,
         read_type=read_type,
+        cache_dir=cache_dir,
+        cache_size=cache_size,
+        partial_dir=partial_dir,
+        taxdump_dir=taxdump_dir,
+        snapshot_interval=snapshot_interval,
+        chunk_reads=chunk_reads,
     )
     for hit_json in hit_jsons:
         click.echo(f"hit json written to {hit_json}")
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+import json
+import time
+import sqlite3
+import hashlib
+from pathlib import Path
+
+
+def reference_fingerprint(reference, **params):
+    """
+    Fingerprint a reference and the alignment parameters used against it.
+    The file is identified by path, size, mtime and its first and last MiB,
+    so hashing a 100+ GB fasta is avoided.
+    reference: path to reference fasta or minimap2 index -> Path
+    params: alignment parameters that change the hits -> dict
+    return: hex digest -> str
+    """
+    reference = Path(reference).resolve()
+    stat = reference.stat()
+    m = hashlib.md5()
+    m.update(f"{reference}\t{stat.st_size}\t{stat.st_mtime_ns}".encode())
+    with open(reference, "rb") as f:
+        m.update(f.read(1 << 20))
+        if stat.st_size > 1 << 20:
+            f.seek(max(stat.st_size - (1 << 20), 1 << 20))
+            m.update(f.read())
+    m.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return m.hexdigest()
+
+
+class AlignmentCache:
+    """
+    On-disk cache of filtered hits keyed by read sequence and reference fingerprint.
+    Entries are evicted least-recently-used first once the cache exceeds max_bytes.
+    """
+
+    BATCH_SIZE = 500
+
+    def __init__(self, cache_dir, fingerprint, max_bytes=10 * 1024**3):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.fingerprint = fingerprint.encode()
+        self.max_bytes = max_bytes
+        self.conn = sqlite3.connect(self.cache_dir / "aln_cache.sqlite", timeout=300)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS hits "
+            "(key BLOB PRIMARY KEY, hits TEXT, size INTEGER, atime REAL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS hits_atime ON hits (atime)")
+        self.conn.commit()
+
+    def key(self, seq):
+        """
+        seq: read sequence -> str
+        return: cache key -> bytes
+        """
+        return hashlib.blake2b(
+            self.fingerprint + b"\0" + seq.upper().encode(), digest_size=20
+        ).digest()
+
+    def get_many(self, keys):
+        """
+        keys: cache keys -> list
+        return: key -> list of hits for the keys found -> dict
+        """
+        found = {}
+        now = time.time()
+        keys = list(set(keys))
+        for i in range(0, len(keys), self.BATCH_SIZE):
+            batch = keys[i : i + self.BATCH_SIZE]
+            marks = ",".join("?" * len(batch))
+            for key, hits in self.conn.execute(
+                f"SELECT key, hits FROM hits WHERE key IN ({marks})", batch
+            ):
+                found[key] = json.loads(hits)
+            self.conn.execute(
+                f"UPDATE hits SET atime = ? WHERE key IN ({marks})", [now, *batch]
+            )
+        self.conn.commit()
+        return found
+
+    def put_many(self, key2hits):
+        """
+        key2hits: key -> list of hits (empty if the read has none) -> dict
+        """
+        now = time.time()
+        rows = []
+        for key, hits in key2hits.items():
+            value = json.dumps(hits)
+            rows.append((key, value, len(key) + len(value), now))
+        self.conn.executemany("INSERT OR REPLACE INTO hits VALUES (?, ?, ?, ?)", rows)
+        self.conn.commit()
+        self.evict()
+
+    def evict(self):
+        """
+        Drop least recently used entries until the cache fits in max_bytes
+        """
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM hits").fetchone()
+        excess = total[0] - self.max_bytes
+        if excess <= 0:
+            return
+        freed = 0
+        stale = []
+        for key, size in self.conn.execute("SELECT key, size FROM hits ORDER BY atime"):
+            stale.append((key,))
+            freed += size
+            if freed >= excess:
+                break
+        self.conn.executemany("DELETE FROM hits WHERE key = ?", stale)
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
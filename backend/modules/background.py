@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+import json
+import click
+import numpy as np
+from pathlib import Path
+
+from modules.common import CONTEXT_SETTINGS
+
+
+class BackgroundModel:
+    """
+    Per-taxon mean and variance of log10(rPM + 1) across control samples.
+    Taxa absent from a control count as rPM 0, so every taxon shares the same
+    number of samples and new controls are folded in with Welford's update.
+    """
+
+    MIN_STD = 0.1
+    MAX_ZSCORE = 99
+
+    def __init__(self, taxids=None, mean=None, m2=None, n=0, samples=None):
+        self.taxids = np.array([] if taxids is None else taxids, dtype=np.int64)
+        self.mean = np.zeros(len(self.taxids)) if mean is None else np.asarray(mean)
+        self.m2 = np.zeros(len(self.taxids)) if m2 is None else np.asarray(m2)
+        self.n = int(n)
+        self.samples = list(samples) if samples is not None else []
+
+    @classmethod
+    def load(cls, path):
+        """
+        path: path to background model (.npz) -> Path
+        """
+        with np.load(path) as data:
+            return cls(
+                taxids=data["taxids"],
+                mean=data["mean"],
+                m2=data["m2"],
+                n=data["n"],
+                samples=data["samples"].tolist(),
+            )
+
+    def save(self, path):
+        """
+        path: path to background model (.npz) -> Path
+        """
+        with open(path, "wb") as f:
+            np.savez(
+                f,
+                taxids=self.taxids,
+                mean=self.mean,
+                m2=self.m2,
+                n=np.array(self.n),
+                samples=np.array(self.samples, dtype=str),
+            )
+
+    def add_sample(self, taxid2rpm, sample_id=None):
+        """
+        Fold one control sample into the model
+        taxid2rpm: taxid -> rPM of the control -> dict
+        sample_id: name of the control, skipped if already in the model -> str
+        return: True if the sample was added -> bool
+        """
+        if sample_id is not None and sample_id in self.samples:
+            return False
+        taxids = np.fromiter((int(t) for t in taxid2rpm), dtype=np.int64)
+        rpms = np.fromiter(taxid2rpm.values(), dtype=np.float64, count=len(taxids))
+
+        new_taxids = np.setdiff1d(taxids, self.taxids)
+        if len(new_taxids):
+            # previous controls had rPM 0 for unseen taxa: mean 0, m2 0
+            all_taxids = np.union1d(self.taxids, new_taxids)
+            idx = np.searchsorted(all_taxids, self.taxids)
+            mean = np.zeros(len(all_taxids))
+            m2 = np.zeros(len(all_taxids))
+            mean[idx] = self.mean
+            m2[idx] = self.m2
+            self.taxids, self.mean, self.m2 = all_taxids, mean, m2
+
+        x = np.zeros(len(self.taxids))
+        x[np.searchsorted(self.taxids, taxids)] = np.log10(rpms + 1)
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+        if sample_id is not None:
+            self.samples.append(sample_id)
+        return True
+
+    def zscores(self, taxids, rpms):
+        """
+        Z scores of a sample's taxa against the background
+        taxids: taxids of the sample -> array-like
+        rpms: rPM of each taxid -> array-like
+        return: z scores, nan if the model has fewer than 2 controls -> np.ndarray
+        """
+        taxids = np.asarray(taxids, dtype=np.int64)
+        x = np.log10(np.asarray(rpms, dtype=np.float64) + 1)
+        if self.n < 2:
+            return np.full(len(x), np.nan)
+        mean = np.zeros(len(x))
+        var = np.zeros(len(x))
+        if len(self.taxids):
+            idx = np.minimum(np.searchsorted(self.taxids, taxids), len(self.taxids) - 1)
+            found = self.taxids[idx] == taxids
+            mean[found] = self.mean[idx[found]]
+            var[found] = self.m2[idx[found]] / (self.n - 1)
+        std = np.maximum(np.sqrt(var), self.MIN_STD)
+        return np.clip((x - mean) / std, -self.MAX_ZSCORE, self.MAX_ZSCORE)
+
+
+@click.command(
+    help="Build or update a background model from rpm json of control samples",
+    context_settings=CONTEXT_SETTINGS,
+)
+@click.argument(
+    "rpm_json",
+    nargs=-1,
+    type=click.Path(exists=True, dir_okay=False, resolve_path=True, path_type=Path),
+    required=True,
+)
+@click.option(
+    "--model",
+    "-m",
+    help="background model (.npz), updated in place if it exists",
+    type=click.Path(exists=False, dir_okay=False, resolve_path=True, path_type=Path),
+    required=True,
+)
+def cli(rpm_json, model):
+    bg_model = BackgroundModel.load(model) if model.is_file() else BackgroundModel()
+    for rpm_f in rpm_json:
+        taxid2rpm = {
+            taxid: values["rpm"]
+            for taxid, values in json.loads(rpm_f.read_text()).items()
+        }
+        sample_id = rpm_f.name.split(".")[0]
+        if not bg_model.add_sample(taxid2rpm, sample_id=sample_id):
+            click.echo(f"{sample_id} is already in the background model, skipped")
+    bg_model.save(model)
+    click.echo(f"{bg_model.n} controls, {len(bg_model.taxids)} taxa: {model}")
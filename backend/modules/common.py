@@ -2,18 +2,49 @@
 
 import os
 import gzip
+import signal
+import socket
+import asyncio
+import subprocess
+import math
+import time
 import click
 import json
 import yaml
+import cProfile
+import pstats
+import resource
+import threading
+import tracemalloc
+from collections import deque
 from pathlib import Path
 from logging import getLogger, StreamHandler, FileHandler, DEBUG, WARN, INFO, Formatter
 
-
 logger = getLogger(__file__)
+if not logger.handlers:
+    _handler = StreamHandler()
+    _handler.setFormatter(Formatter("%(asctime)s %(levelname)s %(message)s"))
+    logger.addHandler(_handler)
+    logger.setLevel(INFO)
 PROJECT_ROOT = Path(__file__).parent.parent.parent
-MAX_THREADS = os.cpu_count()
+CGROUP_ROOT = Path("/sys/fs/cgroup")
 
 CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
+# comma separated profilers run by instrumented stages: cprofile, tracemalloc
+PROFILE_ENV = "REICH_PROFILE"
+PROFILERS = ("cprofile", "tracemalloc")
+PROFILE_TOP_N = 40
+_instrument_local = threading.local()
+# run_pipeline: bytes read from a pipe at once, stderr lines kept for errors and
+# seconds a stage gets to exit after SIGTERM before it is killed
+PIPE_READ_SIZE = 1 << 20
+STDERR_TAIL = 20
+KILL_GRACE = 5
+# unix socket of a warm worker (see modules.worker) that short stages run on
+WORKER_SOCKET_ENV = "REICH_WORKER_SOCKET"
+# seconds to reach the worker, and to wait for the result of a task
+WORKER_CONNECT_TIMEOUT = 5
+WORKER_TIMEOUT = 3600
 
 
 def read_config():
@@ -26,6 +57,117 @@ def read_config():
         return {}
 
 
+def _read_cpu_quota(cgroup_dir):
+    """
+    cgroup_dir: cgroup v2 or v1 cpu controller directory -> Path
+    return: CPU quota in CPUs, None if unlimited -> float
+    """
+    try:
+        cpu_max = cgroup_dir / "cpu.max"
+        if cpu_max.is_file():
+            quota, period = cpu_max.read_text().split()[:2]
+            return None if quota == "max" else int(quota) / int(period)
+        cfs_quota = cgroup_dir / "cpu.cfs_quota_us"
+        if cfs_quota.is_file():
+            quota = int(cfs_quota.read_text())
+            period = int((cgroup_dir / "cpu.cfs_period_us").read_text())
+            return None if quota <= 0 else quota / period
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def cgroup_cpu_limit():
+    """
+    CPU quota of the cgroup of this process and its parents, as set by
+    docker --cpus, kubernetes limits or slurm
+    return: quota in CPUs, None if unlimited -> float
+    """
+    try:
+        lines = Path("/proc/self/cgroup").read_text().splitlines()
+    except OSError:
+        return None
+    cgroup_dirs = set()
+    for line in lines:
+        _, controllers, path = line.split(":", 2)
+        if controllers and "cpu" not in controllers.split(","):
+            continue
+        # cgroup v2 has one hierarchy, v1 one per controller
+        root = CGROUP_ROOT / controllers if controllers else CGROUP_ROOT
+        if not root.is_dir():
+            root = CGROUP_ROOT / "cpu"
+        cgroup_dir = root / path.lstrip("/")
+        while cgroup_dir != root and root in cgroup_dir.parents:
+            cgroup_dirs.add(cgroup_dir)
+            cgroup_dir = cgroup_dir.parent
+        # inside a container the own cgroup is usually mounted as the root
+        cgroup_dirs.add(root)
+    limits = [quota for quota in map(_read_cpu_quota, cgroup_dirs) if quota]
+    return min(limits) if limits else None
+
+
+def available_cpus():
+    """
+    CPUs this process may use: its CPU affinity, capped by the cgroup quota
+    rounded up
+    return: number of CPUs -> int
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    limit = cgroup_cpu_limit()
+    if limit is not None:
+        cpus = min(cpus, max(1, math.ceil(limit)))
+    return cpus
+
+
+MAX_THREADS = available_cpus()
+
+
+def split_threads(threads, weights, limits=None):
+    """
+    Split a thread budget among processes that run at the same time, e.g. the
+    commands of a pipe chain. Every process gets one thread first and the rest
+    is shared in proportion to the weights, so the budget is only exceeded
+    when it is smaller than the number of processes.
+    threads: thread budget, 0 for all available CPUs -> int
+    weights: relative share of each process, e.g. {"bowtie2": 6, "fastq": 1} -> dict
+    limits: most threads a process can use, the rest goes to the others -> dict
+    return: threads of each process -> dict
+    """
+    threads = int(threads) or MAX_THREADS
+    limits = {} if limits is None else limits
+    shares = {name: 1 for name in weights}
+    spare = max(threads - len(weights), 0)
+    weights = {
+        name: weight for name, weight in weights.items() if limits.get(name, 2) > 1
+    }
+    while weights:
+        total = sum(weights.values())
+        capped = [
+            name
+            for name, weight in weights.items()
+            if name in limits and spare * weight / total > limits[name] - 1
+        ]
+        if not capped:
+            break
+        for name in capped:
+            shares[name] = limits[name]
+            spare -= limits[name] - 1
+            del weights[name]
+    total = sum(weights.values())
+    exact = {name: spare * weight / total for name, weight in weights.items()}
+    for name, share in exact.items():
+        shares[name] += int(share)
+    # hand out what rounding down left, largest remainders first
+    left = spare - sum(int(share) for share in exact.values())
+    remainders = {name: share - int(share) for name, share in exact.items()}
+    for name in sorted(remainders, key=remainders.get, reverse=True)[:left]:
+        shares[name] += 1
+    return shares
+
+
 def set_threads(func):
     def wrapper(*args, **kwargs):
         threads = kwargs.get("threads", 0)
@@ -46,6 +188,408 @@ def set_out_dir(func):
     return wrapper
 
 
+def read_proc_io():
+    """
+    Bytes read and written by this process and the children it waited for
+    return: {"read_bytes", "write_bytes", "read_chars", "write_chars"} -> dict
+    """
+    counters = {}
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                key, value = line.split(":")
+                counters[key] = int(value)
+    except OSError:
+        pass
+    return {
+        "read_bytes": counters.get("read_bytes", 0),
+        "write_bytes": counters.get("write_bytes", 0),
+        "read_chars": counters.get("rchar", 0),
+        "write_chars": counters.get("wchar", 0),
+    }
+
+
+class instrument:
+    """
+    Record wall time, CPU time, peak RSS and I/O of a stage, and the CPU time
+    and peak RSS of the subprocesses it waited for (minimap2, bowtie2, ...).
+    A stage with an out_dir writes {sample_id}.{stage}.metrics.json there,
+    a stage without one is added to the "stages" of the enclosing stage.
+    With REICH_PROFILE (or profile) set to cprofile and/or tracemalloc, a
+    stage with an out_dir also writes the profile next to its metrics.
+
+        with instrument("host_removal", aligner="bowtie2"):
+            ...
+
+        @set_out_dir
+        @instrument("coverage", sample_from="hit_json")
+        def main(hit_json, out_dir):
+            ...
+
+    As a decorator, out_dir is taken from the out_dir argument and the sample
+    id from the file name of the sample_from argument.
+    """
+
+    def __init__(
+        self,
+        stage,
+        out_dir=None,
+        sample_id=None,
+        sample_from=None,
+        profile=None,
+        **fields,
+    ):
+        self.stage = stage
+        self.out_dir = out_dir
+        self.sample_id = sample_id
+        self.sample_from = sample_from
+        self.profile = profile
+        self.fields = fields
+        self.metrics = None
+
+    def __call__(self, func):
+        def wrapper(*args, **kwargs):
+            sample_id = self.sample_id
+            sample_path = kwargs.get(self.sample_from) if self.sample_from else None
+            if isinstance(sample_path, (list, tuple)):
+                sample_path = sample_path[0] if len(sample_path) == 1 else None
+            if sample_path:
+                sample_id = Path(sample_path).name.split(".")[0]
+            with instrument(
+                self.stage,
+                out_dir=kwargs.get("out_dir", self.out_dir),
+                sample_id=sample_id,
+                profile=self.profile,
+                **self.fields,
+            ):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    def _profilers(self):
+        if self.out_dir is None:
+            return []
+        profile = self.profile
+        if profile is None:
+            profile = os.environ.get(PROFILE_ENV, "")
+        profilers = [name.strip() for name in profile.split(",") if name.strip()]
+        for name in profilers:
+            if name not in PROFILERS:
+                raise ValueError(f"Unknown profiler {name}, use {', '.join(PROFILERS)}")
+        return profilers
+
+    def __enter__(self):
+        self.stack = _instrument_local.__dict__.setdefault("stack", [])
+        self.parent = self.stack[-1] if self.stack else None
+        self.stack.append(self)
+        self.stages = []
+        profilers = self._profilers()
+        self.tracing = "tracemalloc" in profilers and not tracemalloc.is_tracing()
+        if self.tracing:
+            tracemalloc.start()
+        self.profiler = cProfile.Profile() if "cprofile" in profilers else None
+        self.start_time = time.time()
+        self.start = time.perf_counter()
+        self.self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        self.child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.io = read_proc_io()
+        if self.profiler is not None:
+            self.profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.profiler is not None:
+            self.profiler.disable()
+        wall = time.perf_counter() - self.start
+        self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        io = read_proc_io()
+        user = self_usage.ru_utime - self.self_usage.ru_utime
+        system = self_usage.ru_stime - self.self_usage.ru_stime
+        metrics = {"stage": self.stage}
+        if self.sample_id is not None:
+            metrics["sample_id"] = self.sample_id
+        metrics.update(self.fields)
+        metrics.update(
+            {
+                "status": "ok" if exc_type is None else "failed",
+                "start": round(self.start_time, 3),
+                "wall_s": round(wall, 3),
+                "cpu_user_s": round(user, 3),
+                "cpu_sys_s": round(system, 3),
+                "cpu_util": round((user + system) / wall, 2) if wall else 0,
+                # ru_maxrss is in KiB and is the peak of the whole process
+                "peak_rss_mb": round(self_usage.ru_maxrss / 1024, 1),
+                "io": {key: io[key] - self.io[key] for key in io},
+                "children": {
+                    "cpu_user_s": round(
+                        child_usage.ru_utime - self.child_usage.ru_utime, 3
+                    ),
+                    "cpu_sys_s": round(
+                        child_usage.ru_stime - self.child_usage.ru_stime, 3
+                    ),
+                    "peak_rss_mb": round(child_usage.ru_maxrss / 1024, 1),
+                },
+            }
+        )
+        if exc_type is not None:
+            metrics["error"] = str(exc)
+        if self.tracing:
+            metrics["python_peak_mb"] = round(
+                tracemalloc.get_traced_memory()[1] / 1024**2, 1
+            )
+        if self.stages:
+            metrics["stages"] = self.stages
+        self.stack.pop()
+        self.metrics = metrics
+
+        if self.out_dir is not None:
+            self._write(metrics)
+        elif self.parent is not None:
+            self.parent.stages.append(metrics)
+        else:
+            logger.debug(json.dumps(metrics))
+        return False
+
+    def _write(self, metrics):
+        out_dir = Path(self.out_dir)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        prefix = self.stage
+        if self.sample_id is not None:
+            prefix = f"{self.sample_id}.{self.stage}"
+        if self.profiler is not None:
+            self.profiler.dump_stats(out_dir / f"{prefix}.prof")
+            with open(out_dir / f"{prefix}.prof.txt", "w") as f:
+                stats = pstats.Stats(self.profiler, stream=f)
+                stats.sort_stats("cumulative").print_stats(PROFILE_TOP_N)
+        if self.tracing:
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            with open(out_dir / f"{prefix}.tracemalloc.txt", "w") as f:
+                for stat in snapshot.statistics("lineno")[:PROFILE_TOP_N]:
+                    f.write(f"{stat}\n")
+        (out_dir / f"{prefix}.metrics.json").write_text(
+            json.dumps(metrics, indent=4, cls=AdvancedJSONEncoder)
+        )
+
+
+def _killpg(pid, sig):
+    try:
+        os.killpg(pid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def _terminate(procs):
+    """
+    SIGTERM the process group of every stage, SIGKILL those still running
+    after KILL_GRACE seconds
+    """
+    loop = asyncio.get_running_loop()
+    for proc in procs:
+        _killpg(proc.pid, signal.SIGTERM)
+        loop.call_later(
+            KILL_GRACE,
+            lambda proc=proc: proc.returncode is None
+            and _killpg(proc.pid, signal.SIGKILL),
+        )
+
+
+async def _log_stderr(name, stream, tail):
+    while True:
+        try:
+            line = await stream.readline()
+        except ValueError:
+            # longer than PIPE_READ_SIZE, the line has been skipped
+            continue
+        if not line:
+            break
+        line = line.decode(errors="replace").rstrip()
+        tail.append(line)
+        logger.info(f"[{name}] {line}")
+
+
+async def _read_lines(stream, callback):
+    # lines are joined from pieces only once, one line can be a whole chromosome
+    pieces = []
+    while True:
+        chunk = await stream.read(PIPE_READ_SIZE)
+        if not chunk:
+            break
+        start = 0
+        end = chunk.find(b"\n")
+        while end >= 0:
+            pieces.append(chunk[start : end + 1])
+            callback(b"".join(pieces))
+            pieces = []
+            start = end + 1
+            end = chunk.find(b"\n", start)
+        if start < len(chunk):
+            pieces.append(chunk[start:])
+    if pieces:
+        callback(b"".join(pieces))
+
+
+async def _run_pipeline(cmds, stdin, stdout, cwd, env, timeout, stages):
+    loop = asyncio.get_running_loop()
+    if threading.current_thread() is threading.main_thread():
+        loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    tails = [deque(maxlen=STDERR_TAIL) for _ in cmds]
+    procs = []
+    fds = []
+    readers = []
+    stdout_reader = None
+    try:
+        stage_stdin = stdin
+        for i, cmd in enumerate(cmds):
+            next_stdin = None
+            if i < len(cmds) - 1:
+                next_stdin, stage_stdout = os.pipe()
+                fds.extend([next_stdin, stage_stdout])
+            elif callable(stdout):
+                stage_stdout = asyncio.subprocess.PIPE
+            else:
+                stage_stdout = stdout
+            stages[i]["start"] = round(time.time(), 3)
+            proc = await asyncio.create_subprocess_exec(
+                *[str(arg) for arg in cmd],
+                stdin=stage_stdin,
+                stdout=stage_stdout,
+                stderr=asyncio.subprocess.PIPE,
+                cwd=cwd,
+                env=env,
+                limit=PIPE_READ_SIZE,
+                # own process group, so a wrapper such as bowtie2 is killed
+                # together with the aligner it started
+                start_new_session=True,
+            )
+            procs.append(proc)
+            stages[i]["pid"] = proc.pid
+            readers.append(
+                asyncio.ensure_future(
+                    _log_stderr(stages[i]["stage"], proc.stderr, tails[i])
+                )
+            )
+            # the parent keeps no pipe ends, so a stage sees EOF or SIGPIPE
+            # as soon as its neighbour exits
+            for fd in (stage_stdin, stage_stdout):
+                if isinstance(fd, int) and fd in fds:
+                    os.close(fd)
+                    fds.remove(fd)
+            stage_stdin = next_stdin
+
+        if callable(stdout):
+            stdout_reader = asyncio.ensure_future(_read_lines(procs[-1].stdout, stdout))
+        waits = {asyncio.ensure_future(proc.wait()): i for i, proc in enumerate(procs)}
+        pending = set(waits) | ({stdout_reader} if stdout_reader else set())
+        deadline = None if timeout is None else loop.time() + timeout
+        failed = None
+        while pending:
+            remaining = None if deadline is None else max(deadline - loop.time(), 0)
+            done, pending = await asyncio.wait(
+                pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED
+            )
+            if not done:
+                _terminate(procs)
+                cmd = " | ".join(stage["cmd"] for stage in stages)
+                raise subprocess.TimeoutExpired(cmd, timeout)
+            for task in done:
+                if task is stdout_reader:
+                    if task.exception() is not None and failed is None:
+                        failed = -1
+                        _terminate(procs)
+                    continue
+                i = waits[task]
+                returncode = procs[i].returncode
+                stages[i]["returncode"] = returncode
+                stages[i]["wall_s"] = round(time.time() - stages[i]["start"], 3)
+                # a stage gets SIGPIPE only after the next one stopped reading,
+                # which either fails itself or finished early like head
+                broken_pipe = returncode == -signal.SIGPIPE and i < len(procs) - 1
+                if returncode and not broken_pipe and failed is None:
+                    failed = i
+                    # the group of the failed stage too, for children left behind
+                    _terminate(procs)
+        await asyncio.gather(*readers)
+        if stdout_reader is not None:
+            # raises the error of the stdout callback
+            stdout_reader.result()
+        if failed is not None:
+            tail = "\n".join(tails[failed])
+            logger.error(
+                f"{stages[failed]['stage']} exited with {procs[failed].returncode}: "
+                f"{stages[failed]['cmd']}\n{tail}"
+            )
+            raise subprocess.CalledProcessError(
+                procs[failed].returncode, cmds[failed], stderr=tail
+            )
+    finally:
+        for fd in fds:
+            os.close(fd)
+        running = [proc for proc in procs if proc.returncode is None]
+        for proc in running:
+            _killpg(proc.pid, signal.SIGKILL)
+        for proc in running:
+            await proc.wait()
+        for task in readers:
+            task.cancel()
+
+
+def run_pipeline(cmds, stdin=None, stdout=None, cwd=None, env=None, timeout=None):
+    """
+    Run commands connected by pipes, cmds[0] | cmds[1] | ..., like a shell
+    with pipefail. The stderr of every stage is logged line by line. The first
+    stage that fails stops the others: their process groups get SIGTERM, then
+    SIGKILL after KILL_GRACE seconds, so no aligner is left running.
+    SIGTERM of this process (in the main thread) stops the stages the same way.
+    The timing of every stage is added to the "stages" of an enclosing
+    instrument.
+    cmds: commands, e.g. [["bowtie2", ...], ["samtools", "fastq", ...]] -> list
+    stdin: input of the first command, a path or file -> Path
+    stdout: output of the last command, a path, file or function called with
+        every line (as bytes), which throttles the command while it runs;
+        None inherits stdout -> Path
+    timeout: seconds the pipeline may run -> float
+    return: cmd, pid, start, wall_s and returncode of each stage -> list
+    """
+    stages = [
+        {"stage": Path(str(cmd[0])).name, "cmd": " ".join(map(str, cmd))}
+        for cmd in cmds
+    ]
+    opened = []
+    if isinstance(stdin, (str, Path)):
+        stdin = open(stdin, "rb")
+        opened.append(stdin)
+    if isinstance(stdout, (str, Path)):
+        stdout = open(stdout, "wb")
+        opened.append(stdout)
+    main_thread = threading.current_thread() is threading.main_thread()
+    # the event loop resets SIGTERM to the default when it closes
+    sigterm_handler = signal.getsignal(signal.SIGTERM)
+    try:
+        asyncio.run(_run_pipeline(cmds, stdin, stdout, cwd, env, timeout, stages))
+    except asyncio.CancelledError:
+        # stopped by SIGTERM once the stages were killed, now handle the signal
+        if sigterm_handler is not None:
+            signal.signal(signal.SIGTERM, sigterm_handler)
+        signal.raise_signal(signal.SIGTERM)
+        raise
+    finally:
+        if main_thread and sigterm_handler is not None:
+            signal.signal(signal.SIGTERM, sigterm_handler)
+        for f in opened:
+            f.close()
+        stack = getattr(_instrument_local, "stack", None)
+        if stack:
+            stack[-1].stages.extend(stages)
+        for stage in stages:
+            logger.info(
+                f"{stage['stage']}: {stage.get('wall_s')} s, "
+                f"exit {stage.get('returncode')}"
+            )
+    return stages
+
+
 def get_basename(path):
     path = Path(path)
     return (
@@ -89,6 +633,23 @@ def check_seq_format(file):
             return "unknown"
 
 
+def parse_fastq(file):
+    """
+    Iterate over the records of a (gzipped) fastq file
+    file: path to fastq file -> Path
+    return: generator of (name, seq, qual) -> tuple
+    """
+    with open_gz(file) as f:
+        while True:
+            header = f.readline()
+            if not header:
+                break
+            seq = f.readline().rstrip("\n")
+            f.readline()
+            qual = f.readline().rstrip("\n")
+            yield header[1:].rstrip("\n"), seq, qual
+
+
 def generate_batch(file, out_dir=None):
     # deprecated
     file = Path(file)
@@ -153,3 +714,45 @@ class BaseNameType(click.ParamType):
                 self.fail(f"{value} is not a basename path", param, ctx)
         except ValueError:
             self.fail(f"{value} is not a basename path", param, ctx)
+
+
+class WorkerUnavailable(Exception):
+    pass
+
+
+def call_worker(task, socket_path=None, timeout=WORKER_TIMEOUT, **kwargs):
+    """
+    Run a task on the warm worker, see modules.worker. Paths are sent resolved,
+    so the worker must see the same filesystem.
+    task: name of the task, e.g. "assign_taxon" -> str
+    socket_path: socket of the worker, default $REICH_WORKER_SOCKET -> Path
+    timeout: seconds to wait for the result -> float
+    kwargs: arguments of the task, json serializable -> dict
+    return: result of the task -> object
+    raise: WorkerUnavailable if no worker is set, it can not be reached within
+        WORKER_CONNECT_TIMEOUT or it does not answer within timeout, so the
+        caller can run the task in process
+    """
+    socket_path = socket_path or os.environ.get(WORKER_SOCKET_ENV)
+    if not socket_path:
+        raise WorkerUnavailable("No worker socket set")
+    request = json.dumps({"task": task, "kwargs": kwargs}, cls=AdvancedJSONEncoder)
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            # a worker stuck with a full backlog must not hang the stage
+            sock.settimeout(WORKER_CONNECT_TIMEOUT)
+            sock.connect(str(socket_path))
+            sock.settimeout(timeout)
+            sock.sendall(request.encode() + b"\n")
+            with sock.makefile("rb") as f:
+                response = f.readline()
+    except OSError as e:
+        logger.warning(f"worker at {socket_path} is unavailable: {e}")
+        raise WorkerUnavailable(f"Worker at {socket_path} is unavailable: {e}")
+    if not response:
+        logger.warning(f"worker at {socket_path} closed the connection")
+        raise WorkerUnavailable(f"Worker at {socket_path} closed the connection")
+    response = json.loads(response)
+    if not response["ok"]:
+        raise Exception(f"Worker failed to run {task}: {response['error']}")
+    return response["result"]
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+import numpy as np
+import pandas as pd
+
+
+def _prefix_sum(values):
+    return np.concatenate([[0], np.cumsum(values)])
+
+
+def get_coverage(hits, bins=10):
+    """
+    Calculate breadth, mean depth and a binned depth profile per reference.
+    Alignments are handled as sorted interval arrays: the union of intervals is
+    a running maximum over end positions, and the depth profile is read off the
+    integral of the coverage function at the bin edges with prefix sums.
+    hits: alignment records with tname, tlen, tstart, tend and optional count -> list
+    bins: number of bins in the depth profile -> int
+    return: one row per reference -> pd.DataFrame
+    """
+    cols = ["accession", "taxid", "tlen", "hit_n", "covered_bases", "breadth"]
+    cols += ["mean_depth", "depth_profile"]
+    if not hits:
+        return pd.DataFrame(columns=cols)
+
+    codes, tnames = pd.factorize(np.array([hit["tname"] for hit in hits]))
+    starts = np.fromiter((hit["tstart"] for hit in hits), np.int64, len(hits))
+    ends = np.fromiter((hit["tend"] for hit in hits), np.int64, len(hits))
+    weights = np.fromiter((hit.get("count", 1) for hit in hits), np.int64, len(hits))
+    tlens = np.zeros(len(tnames), dtype=np.int64)
+    tlens[codes] = np.fromiter((hit["tlen"] for hit in hits), np.int64, len(hits))
+    acc_n = len(tnames)
+
+    # intervals sorted by (reference, start) on one axis, references laid end to end
+    offsets = _prefix_sum(tlens + 1)[:-1]
+    first = _prefix_sum(np.bincount(codes, minlength=acc_n))[:-1]
+    order = np.lexsort((starts, codes))
+    s_codes, s_starts, s_ends = codes[order], starts[order], ends[order]
+    key_starts = s_starts + offsets[s_codes]
+    key_ends = s_ends + offsets[s_codes]
+
+    prev_end = np.concatenate([[-1], np.maximum.accumulate(key_ends)[:-1]])
+    covered = np.maximum(key_ends - np.maximum(key_starts, prev_end), 0)
+    covered_bases = np.bincount(s_codes, weights=covered, minlength=acc_n)
+    aligned_bases = np.bincount(
+        codes, weights=(ends - starts) * weights, minlength=acc_n
+    )
+
+    # coverage integral C(x) = sum_{s<x} w(x - s) - sum_{e<x} w(x - e)
+    w_starts = weights[order]
+    start_w = _prefix_sum(w_starts)
+    start_ws = _prefix_sum(w_starts * s_starts)
+    e_order = np.lexsort((ends, codes))
+    e_codes, e_ends, w_ends = codes[e_order], ends[e_order], weights[e_order]
+    key_e = e_ends + offsets[e_codes]
+    end_w = _prefix_sum(w_ends)
+    end_we = _prefix_sum(w_ends * e_ends)
+
+    edges = tlens[:, None] * np.arange(bins + 1)[None, :] // bins
+    key_edges = edges + offsets[:, None]
+    lo = first[:, None]
+    n_s = np.searchsorted(key_starts, key_edges, side="left")
+    n_e = np.searchsorted(key_e, key_edges, side="left")
+    integral = (
+        edges * (start_w[n_s] - start_w[lo])
+        - (start_ws[n_s] - start_ws[lo])
+        - (edges * (end_w[n_e] - end_w[lo]) - (end_we[n_e] - end_we[lo]))
+    )
+    widths = np.diff(edges, axis=1)
+    profile = np.divide(
+        np.diff(integral, axis=1),
+        widths,
+        out=np.zeros(widths.shape),
+        where=widths > 0,
+    )
+
+    return pd.DataFrame(
+        {
+            "accession": [tname.split("|")[0] for tname in tnames],
+            "taxid": [tname.split("|")[1] for tname in tnames],
+            "tlen": tlens,
+            "hit_n": np.bincount(codes, weights=weights, minlength=acc_n).astype(int),
+            "covered_bases": covered_bases.astype(np.int64),
+            "breadth": covered_bases / np.maximum(tlens, 1),
+            "mean_depth": aligned_bases / np.maximum(tlens, 1),
+            "depth_profile": [
+                ",".join(f"{depth:.2f}" for depth in row) for row in profile
+            ],
+        },
+        columns=cols,
+    )
+
+
+def get_species_coverage(acc_coverage, lineages, rank="species"):
+    """
+    Aggregate reference coverage to species over the references that were hit
+    acc_coverage: output of get_coverage -> pd.DataFrame
+    lineages: taxid -> lineage, as in the normalized taxonomy -> dict
+    return: one row per species -> pd.DataFrame
+    """
+    sp_taxids = []
+    sp_names = []
+    for taxid in acc_coverage["taxid"]:
+        node = (lineages.get(taxid) or {}).get(rank)
+        sp_taxids.append(node["taxid"] if node else None)
+        sp_names.append(node["name"] if node else None)
+    df = acc_coverage.assign(
+        sp_taxid=sp_taxids,
+        name=sp_names,
+        aligned_bases=acc_coverage["mean_depth"] * acc_coverage["tlen"],
+    ).dropna(subset=["sp_taxid"])
+    sp_df = (
+        df.groupby(["sp_taxid", "name"], sort=False)
+        .agg(
+            references=("accession", "size"),
+            tlen=("tlen", "sum"),
+            hit_n=("hit_n", "sum"),
+            covered_bases=("covered_bases", "sum"),
+            aligned_bases=("aligned_bases", "sum"),
+        )
+        .reset_index()
+        .rename(columns={"sp_taxid": "taxid"})
+    )
+    sp_df["breadth"] = sp_df["covered_bases"] / sp_df["tlen"].clip(lower=1)
+    sp_df["mean_depth"] = sp_df["aligned_bases"] / sp_df["tlen"].clip(lower=1)
+    return (
+        sp_df.drop(columns="aligned_bases")
+        .sort_values("hit_n", ascending=False)
+        .reset_index(drop=True)
+    )
@@ -1,16 +1,24 @@
 #!/usr/bin/env python
-import os
 import json
 import hashlib
 import requests
-import subprocess
 import tarfile
 import tempfile
 from pathlib import Path
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from modules.common import set_threads, set_out_dir, open_gz
+from modules.common import (
+    set_threads,
+    set_out_dir,
+    split_threads,
+    open_gz,
+    instrument,
+    run_pipeline,
+)
 from modules.taxonparse import list_subtree
+from modules.alignment import minimap2_index
+from modules.reflen import RefLengthBuilder, RefLengthIndex, build_length_index
+from modules.taxon_index import INDEX_NAME, TaxonIndex, build_taxon_index
 
 
 def validate_md5(file, md5):
@@ -56,9 +64,10 @@ def download_file(url, out_dir, rewrite=False):
                         f.write(chunk)
                 returncode = 0
             elif method == "rsync":
-                returncode = os.system(
-                    f"rsync --copy-links --times --quiet {url} {out_dir}"
+                run_pipeline(
+                    [["rsync", "--copy-links", "--times", "--quiet", url, out_dir]]
                 )
+                returncode = 0
             else:
                 returncode = 1
 
@@ -101,13 +110,22 @@ def build_acc2taxid(acc2taxid=None, out_dir=None):
 
 @set_threads
 def convert_blastdb_to_fasta(
-    blastdb, basename, taxids=[], min_len=1, compress=False, threads=0
+    blastdb,
+    basename,
+    taxids=[],
+    min_len=1,
+    compress=False,
+    length_index=None,
+    threads=0,
 ):
     """
     Convert blastdb to fasta file
     blastdb: path to blastdb -> Path
     basename: basename of output fasta file -> Path
     taxids: list of taxids to extract -> list
+    length_index: directory to write the reference length index to -> Path
+    compress: BGZF-compress the fasta so it stays randomly accessible -> bool
+    return: fasta, indexed by {fasta}.fai (and {fasta}.gzi if compressed) -> Path
     """
     taxids = [str(taxid) for taxid in taxids]
     basename = Path(basename)
@@ -130,30 +148,42 @@ def convert_blastdb_to_fasta(
 
     min_len = 0 if min_len is None else min_len
 
-    with open(fasta_fpath, "w") as f:
-        blastdbcmd_proc = subprocess.Popen(extract_cmd, stdout=subprocess.PIPE)
-
-        while True:
-            line = blastdbcmd_proc.stdout.readline().decode()
-            if not line:
-                break
+    builder = RefLengthBuilder() if length_index is not None else None
+    offset = 0
+    with open(fasta_fpath, "w") as f, open(f"{fasta_fpath}.fai", "w") as f_fai:
 
-            seqid, taxid, seq, seqlen = line.split(delim)
+        def write_record(line):
+            nonlocal offset
+            seqid, taxid, seq, seqlen = line.decode().split(delim)
 
             if int(seqlen) >= min_len:
-                f.write(f">{seqid}|{taxid}\n{seq}\n")
+                header = f">{seqid}|{taxid}\n"
+                f.write(f"{header}{seq}\n")
+                offset += len(header)
+                seq_len = len(seq)
+                f_fai.write(
+                    f"{seqid}|{taxid}\t{seq_len}\t{offset}\t{seq_len}\t{seq_len + 1}\n"
+                )
+                offset += seq_len + 1
+                if builder is not None:
+                    builder.add(seqid, taxid, seqlen)
+
+        # blastdbcmd is paused while the records are written
+        run_pipeline([extract_cmd], stdout=write_record)
+    if builder is not None:
+        builder.save(length_index)
 
     if compress:
-        compress_proc = subprocess.run(["pigz", "-p", threads, fasta_fpath])
-        if compress_proc.returncode:
-            raise Exception("Failed to compress fasta file")
+        run_pipeline([["bgzip", "-@", str(threads), "-i", "-f", fasta_fpath]])
+        Path(f"{fasta_fpath}.fai").rename(f"{fasta_fpath}.gz.fai")
         fasta_fpath = fasta_fpath.with_suffix(".fa.gz")
 
     return fasta_fpath
 
 
+@set_threads
 @set_out_dir
-def build_blastdb(taxdump_dir, db_type="nt", out_dir=None, resume=False):
+def build_blastdb(taxdump_dir, db_type="nt", out_dir=None, resume=False, threads=0):
     def batch_get_blastdb(url, out_dir):
         tar_fpath = out_dir / Path(url).name
         md5_fpath = tar_fpath.with_suffix(".gz.md5")
@@ -213,12 +243,26 @@ def build_blastdb(taxdump_dir, db_type="nt", out_dir=None, resume=False):
     human_taxids = list_subtree(taxids=[9606], taxdump_dir=taxdump_dir)
     non_human_taxids = all_taxids - human_taxids - excluded_taxids
 
+    # both conversions run at the same time, the non-human one is far larger
+    db_threads = split_threads(threads, {"non_human": 3, "human": 1})
     db_args = [
-        (db_basename, non_human_fa.with_suffix(), non_human_taxids, 50, False),
-        (db_basename, human_fa.with_suffix(), human_taxids, 50, False),
+        (
+            db_basename,
+            non_human_fa.with_suffix(),
+            non_human_taxids,
+            50,
+            False,
+            out_dir / f"non_human_{db_type}_lengths",
+        ),
+        (db_basename, human_fa.with_suffix(), human_taxids, 50, False, None),
     ]
     with ThreadPoolExecutor(max_workers=2) as executor:
-        futures = [executor.submit(convert_blastdb_to_fasta, *arg) for arg in db_args]
+        futures = [
+            executor.submit(convert_blastdb_to_fasta, *arg, threads=arg_threads)
+            for arg, arg_threads in zip(
+                db_args, (db_threads["non_human"], db_threads["human"])
+            )
+        ]
         results = [future.result() for future in as_completed(futures)]
 
     if any([result[0] for result in results]):
@@ -257,25 +301,36 @@ def build_human_db(human_fa, out_dir, threads=0):
             "hisat2": hisat2_dir / "genome_tran",
         }
 
-    bowtie_index_p = subprocess.Popen(
-        ["bowtie2-build", "--threads", threads, human_fa, bowtie_base_index]
+    # the hisat2 index is downloaded and extracted while bowtie2-build runs
+    build_threads = split_threads(
+        threads, {"bowtie2_build": 7, "hisat2": 1}, limits={"hisat2": 1}
     )
-
-    returncode, hisat2_tar = download_file(url=hisat2_url, out_dir=out_dir)
-    if returncode:
-        raise Exception("Failed to download hisat2 index")
-
-    tar_dirname = None
-    with tarfile.open(hisat2_tar, "r:gz") as tar:
-        for tarinfo in tar:
-            if tarinfo.isfile() and tarinfo.name.endswith(".ht2"):
-                tar.extract(tarinfo, out_dir)
-            elif tarinfo.isdir():
-                tar_dirname = tarinfo.name
-    hisat2_dir = out_dir / tar_dirname
-    hisat2_dir = hisat2_dir.rename(out_dir / f"{tar_dirname}_hisat")
-    hisat2_tar.unlink()
-    bowtie_index_p.wait()
+    bowtie2_build_cmd = [
+        "bowtie2-build",
+        "--threads",
+        str(build_threads["bowtie2_build"]),
+        human_fa,
+        bowtie_base_index,
+    ]
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        bowtie_index = executor.submit(run_pipeline, [bowtie2_build_cmd])
+
+        returncode, hisat2_tar = download_file(url=hisat2_url, out_dir=out_dir)
+        if returncode:
+            raise Exception("Failed to download hisat2 index")
+
+        tar_dirname = None
+        with tarfile.open(hisat2_tar, "r:gz") as tar:
+            for tarinfo in tar:
+                if tarinfo.isfile() and tarinfo.name.endswith(".ht2"):
+                    tar.extract(tarinfo, out_dir)
+                elif tarinfo.isdir():
+                    tar_dirname = tarinfo.name
+        hisat2_dir = out_dir / tar_dirname
+        hisat2_dir = hisat2_dir.rename(out_dir / f"{tar_dirname}_hisat")
+        hisat2_tar.unlink()
+        # raises if bowtie2-build failed
+        bowtie_index.result()
 
     return {
         "bowtie2": bowtie_base_index,
@@ -295,29 +350,32 @@ def build_human_hisat2_index(out_dir, threads=0):
                 for chunk in r.iter_content(chunk_size=8192):
                     f.write(chunk)
     for f in (out_dir / Path(url).name for url in (human_fna_url, human_gtf_url)):
-        subprocess.run(["pigz", "-p", threads, f])
+        run_pipeline([["pigz", "-d", "-p", threads, f]])
     human_fna = (out_dir / Path(human_fna_url).name).with_suffix("")
     human_gtf = (out_dir / Path(human_gtf_url).name).with_suffix("")
     exon_f = out_dir / "exon.ss"
     splice_f = out_dir / "splice.ss"
     hisat_base_index = out_dir / "chm13v2.0_plusY"
-    build_proc = subprocess.run(
+    run_pipeline(
         [
-            "hisat2-build",
-            "-p",
-            threads,
-            "--exon",
-            exon_f,
-            "--ss",
-            splice_f,
-            human_fna,
-            hisat_base_index,
+            [
+                "hisat2-build",
+                "-p",
+                threads,
+                "--exon",
+                exon_f,
+                "--ss",
+                splice_f,
+                human_fna,
+                hisat_base_index,
+            ]
         ]
     )
 
 
 @set_threads
 @set_out_dir
+@instrument("build_db")
 def build_db(out_dir=None, threads=0):
     taxdump_dir = out_dir / "taxdump"
     taxdump_dir.mkdir(parents=True, exist_ok=True)
@@ -333,11 +391,35 @@ def build_db(out_dir=None, threads=0):
         with tarfile.open(taxdump_dir, "r:gz") as tar:
             tar.extractall(taxdump_dir)
         taxdump_dir.unlink()
+    if not TaxonIndex.exists(taxdump_dir / INDEX_NAME):
+        print("Building taxon index")
+        with instrument("taxon_index"):
+            build_taxon_index(taxdump_dir)
+
+    with instrument("blastdb"):
+        blastdbs = build_blastdb(
+            taxdump_dir=taxdump_dir, out_dir=out_dir, db_type="nt", threads=threads
+        )
+    length_index = out_dir / "non_human_nt_lengths"
+    if not RefLengthIndex.exists(length_index):
+        print("Building reference length index")
+        with instrument("length_index"):
+            build_length_index(blastdbs["fasta"]["non_human"], length_index)
+
+    # index of the pathogen alignment, loaded by incremental and adaptive runs
+    # instead of being built per run
+    minimap2_index(blastdbs["fasta"]["non_human"], threads=threads)
+
+    with instrument("human_db"):
+        human_dbs = build_human_db(
+            human_fa=blastdbs["fasta"]["human"],
+            out_dir=out_dir / "human",
+            threads=threads,
+        )
 
-    blastdbs = build_blastdb(taxdump_dir=taxdump_dir, out_dir=out_dir, db_type="nt")
-
-    human_dbs = build_human_db(
-        human_fa=blastdbs["fasta"]["human"], out_dir=out_dir / "human", threads=0
-    )
-
-    return {"blastdb": blastdbs, "human_idx": human_dbs, "taxdump": taxdump_dir}
+    return {
+        "blastdb": blastdbs,
+        "human_idx": human_dbs,
+        "taxdump": taxdump_dir,
+        "length_index": length_index,
+    }
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+import json
+import click
+import hashlib
+from pathlib import Path
+
+from modules.common import (
+    set_out_dir,
+    get_basename,
+    parse_fastq,
+    instrument,
+    CONTEXT_SETTINGS,
+)
+
+SIZE_TAG = ";size="
+
+
+def get_read_count(qname):
+    """
+    Get the multiplicity stored in a read name, e.g. sample.1;size=3
+    qname: read name -> str
+    return: number of reads collapsed into this one -> int
+    """
+    if SIZE_TAG in qname:
+        return int(qname.rsplit(SIZE_TAG, 1)[1])
+    return 1
+
+
+def strip_read_count(qname):
+    """
+    Remove the multiplicity tag from a read name
+    qname: read name -> str
+    return: read name -> str
+    """
+    return qname.split(SIZE_TAG, 1)[0]
+
+
+def _read_key(seq_1, seq_2=None):
+    key = seq_1 if seq_2 is None else f"{seq_1}\0{seq_2}"
+    return hashlib.blake2b(key.encode(), digest_size=16).digest()
+
+
+@set_out_dir
+def dedup_reads(fastq_1, fastq_2=None, out_dir=None):
+    """
+    Collapse identical reads (or read pairs) into one representative.
+    The first occurrence is kept and renamed to {name};size={count}.
+    fastq_1: path to fastq file -> Path
+    fastq_2: path to fastq file -> Path
+    return: (dedup fastq_1, dedup fastq_2, stats) -> tuple
+    """
+    fastq_1 = Path(fastq_1)
+    fastq_2 = Path(fastq_2) if fastq_2 is not None else None
+
+    def _records():
+        if fastq_2 is None:
+            for rec in parse_fastq(fastq_1):
+                yield rec, None
+        else:
+            yield from zip(parse_fastq(fastq_1), parse_fastq(fastq_2))
+
+    key2count = {}
+    for rec_1, rec_2 in _records():
+        key = _read_key(rec_1[1], rec_2[1] if rec_2 else None)
+        key2count[key] = key2count.get(key, 0) + 1
+
+    unique_n = len(key2count)
+    out_1 = out_dir / f"{get_basename(fastq_1.name)}.dedup.fq"
+    out_2 = (
+        out_dir / f"{get_basename(fastq_2.name)}.dedup.fq"
+        if fastq_2 is not None
+        else None
+    )
+    total_n = 0
+    f_2 = open(out_2, "w") if out_2 is not None else None
+    with open(out_1, "w") as f_1:
+        for rec_1, rec_2 in _records():
+            total_n += 1
+            key = _read_key(rec_1[1], rec_2[1] if rec_2 else None)
+            count = key2count.pop(key, None)
+            if count is None:
+                continue
+            for f, rec in ((f_1, rec_1), (f_2, rec_2)):
+                if f is None:
+                    continue
+                name, seq, qual = rec
+                name = name.split()[0]
+                f.write(f"@{name}{SIZE_TAG}{count}\n{seq}\n+\n{qual}\n")
+    if f_2 is not None:
+        f_2.close()
+
+    stats = {
+        "total_reads": total_n,
+        "unique_reads": unique_n,
+        "duplication_rate": 1 - unique_n / total_n if total_n else 0,
+    }
+    sample_id = fastq_1.name.split(".")[0]
+    (out_dir / f"{sample_id}.dedup.json").write_text(json.dumps(stats, indent=4))
+    return out_1, out_2, stats
+
+
+@click.command(
+    help="Collapse duplicated reads into one representative",
+    context_settings=CONTEXT_SETTINGS,
+)
+@click.option(
+    "--fastq_1",
+    "-1",
+    help="read1 fastq file",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    required=True,
+)
+@click.option(
+    "--fastq_2",
+    "-2",
+    help="read2 fastq file",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    required=False,
+)
+@click.option(
+    "--out_dir",
+    "-o",
+    help="output directory",
+    type=click.Path(exists=False, dir_okay=True, resolve_path=True, path_type=Path),
+    default=Path().cwd(),
+    show_default=True,
+)
+@instrument("dedup", sample_from="fastq_1")
+def cli(fastq_1, fastq_2, out_dir):
+    out_1, out_2, stats = dedup_reads(fastq_1, fastq_2, out_dir=out_dir)
+    click.echo(
+        f"{stats['unique_reads']} unique of {stats['total_reads']} reads "
+        f"written to {out_1}"
+    )
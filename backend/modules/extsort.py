@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+import heapq
+import tempfile
+from pathlib import Path
+from itertools import groupby
+
+MAX_MEM = 1024**3
+MAX_RUNS = 128
+# rough per-line overhead of a str held in a list
+LINE_OVERHEAD = 100
+
+
+def paf_qname(line):
+    return line[: line.find("\t")]
+
+
+def _write_run(lines, tmp_dir, key):
+    lines.sort(key=key)
+    run = tempfile.NamedTemporaryFile(
+        "w", prefix="run_", suffix=".txt", dir=tmp_dir, delete=False
+    )
+    with run:
+        run.writelines(lines)
+    return Path(run.name)
+
+
+def _merge_runs(runs, tmp_dir, key):
+    """
+    Merge runs MAX_RUNS at a time until a single pass can read them all
+    """
+    while len(runs) > MAX_RUNS:
+        merged = []
+        for i in range(0, len(runs), MAX_RUNS):
+            batch = runs[i : i + MAX_RUNS]
+            handles = [open(run) for run in batch]
+            out = tempfile.NamedTemporaryFile(
+                "w", prefix="run_", suffix=".txt", dir=tmp_dir, delete=False
+            )
+            with out:
+                out.writelines(heapq.merge(*handles, key=key))
+            for handle, run in zip(handles, batch):
+                handle.close()
+                run.unlink()
+            merged.append(Path(out.name))
+        runs = merged
+    return runs
+
+
+def external_sort(lines, key=paf_qname, max_mem=MAX_MEM, tmp_dir=None):
+    """
+    Sort lines that may not fit in memory.
+    Lines are buffered up to max_mem bytes, spilled to disk as sorted runs and
+    merged with a heap. The sort is stable, so lines with the same key keep
+    their input order.
+    lines: iterable of newline-terminated lines -> iterable
+    key: sort key of a line -> function
+    max_mem: memory budget in bytes -> int
+    tmp_dir: directory for the sorted runs -> str or pathlib.Path
+    return: sorted lines -> generator
+    """
+    with tempfile.TemporaryDirectory(prefix="extsort_", dir=tmp_dir) as run_dir:
+        runs = []
+        buffer = []
+        buffer_size = 0
+        for line in lines:
+            if not line.endswith("\n"):
+                line += "\n"
+            buffer.append(line)
+            buffer_size += len(line) + LINE_OVERHEAD
+            if buffer_size >= max_mem:
+                runs.append(_write_run(buffer, run_dir, key))
+                buffer = []
+                buffer_size = 0
+
+        if not runs:
+            buffer.sort(key=key)
+            yield from buffer
+            return
+
+        if buffer:
+            runs.append(_write_run(buffer, run_dir, key))
+        del buffer
+        runs = _merge_runs(runs, run_dir, key)
+        handles = [open(run) for run in runs]
+        try:
+            yield from heapq.merge(*handles, key=key)
+        finally:
+            for handle in handles:
+                handle.close()
+
+
+def group_paf(paf, max_mem=MAX_MEM, tmp_dir=None):
+    """
+    Group the lines of a PAF by query name, whatever order minimap2 wrote them in
+    paf: path to PAF file -> str or pathlib.Path
+    max_mem: memory budget in bytes -> int
+    tmp_dir: directory for the sorted runs, default next to the PAF -> pathlib.Path
+    return: (qname, lines) per read -> generator
+    """
+    tmp_dir = Path(paf).parent if tmp_dir is None else tmp_dir
+    with open(paf) as f:
+        sorted_lines = external_sort(f, key=paf_qname, max_mem=max_mem, tmp_dir=tmp_dir)
+        for qname, lines in groupby(sorted_lines, key=paf_qname):
+            yield qname, list(lines)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+import mmap
+import zlib
+import click
+import struct
+import numpy as np
+from pathlib import Path
+
+from modules.common import CONTEXT_SETTINGS
+
+FAI_DTYPE = [
+    ("acc", "S64"),
+    ("length", "<i8"),
+    ("offset", "<i8"),
+    ("linebases", "<i8"),
+    ("linewidth", "<i8"),
+]
+
+
+def fai_path(fasta):
+    return Path(f"{fasta}.fai")
+
+
+def build_fai(fasta):
+    """
+    Build a samtools-style .fai for an uncompressed fasta in one streaming pass
+    fasta: path to fasta -> Path
+    return: path to .fai -> Path
+    """
+    with open(fasta, "rb") as f_in, open(fai_path(fasta), "w") as f_out:
+        name = None
+        offset = 0
+        for line in f_in:
+            if line.startswith(b">"):
+                if name is not None:
+                    f_out.write(f"{name}\t{length}\t{seq_offset}\t{bases}\t{width}\n")
+                name = line[1:].split()[0].decode()
+                seq_offset = offset + len(line)
+                length = bases = width = 0
+            else:
+                if width == 0:
+                    bases = len(line.rstrip(b"\r\n"))
+                    width = len(line)
+                length += len(line.rstrip(b"\r\n"))
+            offset += len(line)
+        if name is not None:
+            f_out.write(f"{name}\t{length}\t{seq_offset}\t{bases}\t{width}\n")
+    return fai_path(fasta)
+
+
+def _load_fai(fai):
+    """
+    Load a .fai into a structured array sorted by accession, the part of the
+    sequence name before "|". The array is cached next to the .fai as .npy.
+    """
+    cache = Path(f"{fai}.npy")
+    if cache.is_file() and cache.stat().st_mtime >= Path(fai).stat().st_mtime:
+        return np.load(cache, mmap_mode="r")
+    rows = []
+    with open(fai) as f:
+        for line in f:
+            name, length, offset, bases, width = line.rstrip("\n").split("\t")[:5]
+            rows.append(
+                (
+                    name.split("|")[0].encode(),
+                    int(length),
+                    int(offset),
+                    int(bases),
+                    int(width),
+                )
+            )
+    records = np.array(rows, dtype=FAI_DTYPE)
+    records.sort(order="acc", kind="stable")
+    try:
+        np.save(cache, records)
+    except OSError:
+        pass
+    return records
+
+
+class FastaIndex:
+    """
+    Random access to a (BGZF-compressed) fasta through its .fai.
+    The fasta is memory-mapped; for BGZF files the .gzi block index maps
+    uncompressed offsets to the compressed block to start decompressing from.
+    """
+
+    def __init__(self, fasta):
+        self.fasta = Path(fasta)
+        self.records = _load_fai(fai_path(self.fasta))
+        self._file = open(self.fasta, "rb")
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        gzi = Path(f"{self.fasta}.gzi")
+        self.bgzf = self._mm[:2] == b"\x1f\x8b"
+        if self.bgzf:
+            if not gzi.is_file():
+                raise Exception(f"{gzi} not found, compress with bgzip -i")
+            with open(gzi, "rb") as f:
+                (n,) = struct.unpack("<Q", f.read(8))
+                pairs = np.frombuffer(f.read(16 * n), dtype="<u8").reshape(n, 2)
+            self.block_c = np.concatenate([[0], pairs[:, 0]]).astype(np.int64)
+            self.block_u = np.concatenate([[0], pairs[:, 1]]).astype(np.int64)
+
+    def get(self, acc):
+        """
+        acc: accession -> str
+        return: .fai record or None -> np.void
+        """
+        key = acc.encode()
+        idx = np.searchsorted(self.records["acc"], key)
+        if idx < len(self.records) and self.records["acc"][idx] == key:
+            return self.records[idx]
+        return None
+
+    def _read_bgzf(self, start, end):
+        i = int(np.searchsorted(self.block_u, start, side="right")) - 1
+        pos = int(self.block_c[i])
+        u_pos = int(self.block_u[i])
+        chunks = []
+        while u_pos < end and pos < len(self._mm):
+            xlen = struct.unpack_from("<H", self._mm, pos + 10)[0]
+            bsize = None
+            extra = pos + 12
+            while extra < pos + 12 + xlen:
+                si1, si2, slen = struct.unpack_from("<BBH", self._mm, extra)
+                if si1 == 66 and si2 == 67:
+                    bsize = struct.unpack_from("<H", self._mm, extra + 4)[0]
+                extra += 4 + slen
+            if bsize is None:
+                raise Exception(f"{self.fasta} is gzip but not BGZF")
+            data = zlib.decompress(self._mm[pos : pos + bsize + 1], wbits=31)
+            chunks.append(data[max(start - u_pos, 0) : max(end - u_pos, 0)])
+            u_pos += len(data)
+            pos += bsize + 1
+        return b"".join(chunks)
+
+    def fetch(self, acc, start=0, end=None):
+        """
+        Fetch a region of a reference sequence
+        acc: accession -> str
+        start: 0-based start -> int
+        end: 0-based exclusive end, default end of sequence -> int
+        return: sequence -> str
+        """
+        record = self.get(acc)
+        if record is None:
+            raise KeyError(acc)
+        length = int(record["length"])
+        end = length if end is None else min(int(end), length)
+        start = max(int(start), 0)
+        if start >= end:
+            return ""
+        bases, width = int(record["linebases"]), int(record["linewidth"])
+        offset = int(record["offset"])
+        byte_start = offset + start // bases * width + start % bases
+        byte_end = offset + (end - 1) // bases * width + (end - 1) % bases + 1
+        if self.bgzf:
+            raw = self._read_bgzf(byte_start, byte_end)
+        else:
+            raw = self._mm[byte_start:byte_end]
+        if width > bases:
+            raw = raw.replace(b"\n", b"").replace(b"\r", b"")
+        return raw.decode()
+
+    def close(self):
+        self._mm.close()
+        self._file.close()
+
+
+@click.command(
+    help="Fetch a reference region, e.g. MN908947.3:100-200 (0-based, end exclusive)",
+    context_settings=CONTEXT_SETTINGS,
+)
+@click.option(
+    "--fasta",
+    "-f",
+    help="fasta with a .fai (and .gzi if BGZF-compressed)",
+    type=click.Path(exists=True, dir_okay=False, resolve_path=True, path_type=Path),
+    required=True,
+)
+@click.option("--build_index", help="build the .fai first", is_flag=True)
+@click.argument("regions", nargs=-1)
+def cli(fasta, build_index, regions):
+    if build_index:
+        click.echo(f"Output: {build_fai(fasta)}")
+    fasta_index = FastaIndex(fasta)
+    for region in regions:
+        acc, _, span = region.partition(":")
+        start, _, end = span.partition("-")
+        seq = fasta_index.fetch(acc, int(start or 0), int(end) if end else None)
+        click.echo(f">{region}\n{seq}")
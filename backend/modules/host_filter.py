@@ -1,7 +1,13 @@
 #!/usr/bin/env python
+import os
+import json
+import time
+import fcntl
 import click
+import math
+import shutil
+import hashlib
 import tempfile
-import subprocess
 from pathlib import Path
 
 from modules.common import (
@@ -10,7 +16,12 @@ from modules.common import (
     get_basename,
     BaseNameType,
     CONTEXT_SETTINGS,
+    instrument,
+    split_threads,
+    run_pipeline,
 )
+from modules.subsample import count_reads, seqtk_sample
+from modules.progress import emit, track_stage
 
 
 @set_threads
@@ -21,8 +32,9 @@ def qc_filter(fastq_1, fastq_2=None, threads=0, out_dir=None):
     fastq_1: path to fastq file -> Path
     fastq_2: path to fastq file -> Path
     """
-    fastq_1_basename = get_basename(fastq_1)
-    fastq_2_basename = get_basename(fastq_2) if fastq_2 is not None else None
+    # outputs go to out_dir, also when the input is an absolute path
+    fastq_1_basename = get_basename(Path(fastq_1).name)
+    fastq_2_basename = get_basename(Path(fastq_2).name) if fastq_2 is not None else None
     qc_cmd = [
         "fastp",
         "-w",
@@ -51,9 +63,7 @@ def qc_filter(fastq_1, fastq_2=None, threads=0, out_dir=None):
     ]
     if fastq_2 is not None:
         qc_cmd.extend(["-I", fastq_2, "-O", out_dir / f"{fastq_2_basename}.qc.fq"])
-    qc_proc = subprocess.run(qc_cmd)
-    if qc_proc.returncode:
-        raise Exception("Failed to run fastp\nCMD: " + " ".join(qc_cmd))
+    run_pipeline([qc_cmd])
     return {
         "fastq_1": out_dir / f"{fastq_1_basename}.qc.fq",
         "fastq_2": out_dir / f"{fastq_2_basename}qc.fq"
@@ -64,6 +74,86 @@ def qc_filter(fastq_1, fastq_2=None, threads=0, out_dir=None):
     }
 
 
+def fastp_read_counts(fastp_json):
+    """
+    fastp_json: fastp json report -> Path
+    return: {"n": reads before QC, "passed": reads after QC} -> dict
+    """
+    summary = json.loads(Path(fastp_json).read_text()).get("summary", {})
+    return {
+        "n": summary.get("before_filtering", {}).get("total_reads", 0),
+        "passed": summary.get("after_filtering", {}).get("total_reads", 0),
+    }
+
+
+def list_index_files(ref_idx):
+    """
+    List the files of a bowtie2/hisat2 index
+    ref_idx: basename of index -> Path
+    return: index files -> list
+    """
+    ref_idx = Path(ref_idx)
+    return sorted(
+        [
+            f
+            for f in ref_idx.parent.glob(f"{ref_idx.name}.*")
+            if f.is_file() and f.suffix in (".bt2", ".bt2l", ".ht2", ".ht2l")
+        ]
+    )
+
+
+def warm_index(ref_idx, lock_dir=None, max_age=3600, chunk_size=64 * 1024 * 1024):
+    """
+    Load index files into the page cache once per node.
+    Concurrent tasks wait on a lock under lock_dir; the first one reads the
+    index through and leaves a stamp, the others see the stamp and return.
+    Aligners started with --mm then map the same cached pages instead of
+    loading a private copy each.
+    ref_idx: basename of index -> Path
+    lock_dir: node-local directory for lock and stamp files -> Path
+    max_age: seconds before a stamp is considered stale -> int
+    return: True if this call read the index -> bool
+    """
+    if lock_dir is None:
+        lock_dir = "/dev/shm" if Path("/dev/shm").is_dir() else tempfile.gettempdir()
+    lock_dir = Path(lock_dir)
+    lock_dir.mkdir(parents=True, exist_ok=True)
+
+    idx_files = list_index_files(ref_idx)
+    if not idx_files:
+        raise Exception(f"No index files found for {ref_idx}")
+    boot_id = Path("/proc/sys/kernel/random/boot_id")
+    signature = {
+        "boot_id": boot_id.read_text().strip() if boot_id.is_file() else "",
+        "files": [[str(f), f.stat().st_size, f.stat().st_mtime] for f in idx_files],
+    }
+    key = hashlib.md5(str(Path(ref_idx).resolve()).encode()).hexdigest()
+    stamp_file = lock_dir / f"reich_{key}.warm"
+
+    with open(lock_dir / f"reich_{key}.lock", "w") as lock_f:
+        fcntl.flock(lock_f, fcntl.LOCK_EX)
+        try:
+            if stamp_file.is_file():
+                stamp = json.loads(stamp_file.read_text())
+                if (
+                    stamp.get("signature") == signature
+                    and time.time() - stamp.get("time", 0) < max_age
+                ):
+                    return False
+            for idx_file in idx_files:
+                with open(idx_file, "rb") as f:
+                    if hasattr(os, "posix_fadvise"):
+                        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+                    while f.read(chunk_size):
+                        pass
+            stamp_file.write_text(
+                json.dumps({"signature": signature, "time": time.time()})
+            )
+        finally:
+            fcntl.flock(lock_f, fcntl.LOCK_UN)
+    return True
+
+
 @set_threads
 @set_out_dir
 def remove_human_reads(
@@ -71,6 +161,7 @@ def remove_human_reads(
     fastq_2=None,
     bowtie2_idx=None,
     hisat2_idx=None,
+    shared_index=False,
     threads=0,
     out_dir=None,
 ):
@@ -78,12 +169,19 @@ def remove_human_reads(
     Remove human reads from fastq files
     fastq_1: path to fastq file -> Path
     fastq_2: path to fastq file -> Path
+    shared_index: warm the indexes once per node and memory-map them -> bool
     """
     if bowtie2_idx is None and hisat2_idx is None:
         raise Exception("Either bowtie2_idx or hisat2_idx must be provided")
 
     fastq_1_basename = get_basename(fastq_1)
     fastq_2_basename = get_basename(fastq_2) if fastq_2 is not None else None
+    sample_id = Path(fastq_1).name.split(".")[0]
+    # the aligner, samtools sort and samtools fastq run at the same time
+    chain = {"aligner": 6, "fastq": 1}
+    if fastq_2 is not None:
+        chain["sort"] = 2
+    chain_threads = split_threads(threads, chain, limits={"sort": 4, "fastq": 2})
 
     with tempfile.TemporaryDirectory(
         prefix="human_removal", dir=fastq_1.parent
@@ -92,27 +190,28 @@ def remove_human_reads(
         for aln_prog, ref_idx in zip(["bowtie2", "hisat2"], [bowtie2_idx, hisat2_idx]):
             if ref_idx is None:
                 continue
-            aln_cmd = [aln_prog, "-p", threads, "-x", ref_idx]
+            step_start = time.time()
+            emit("host_removal", "start", aligner=aln_prog, sample_id=sample_id)
+            aln_cmd = [aln_prog, "-p", str(chain_threads["aligner"]), "-x", ref_idx]
+            if shared_index:
+                warm_index(ref_idx)
+                aln_cmd.append("--mm")
             if fastq_2 is None:
                 aln_cmd.extend(["-U", fastq_1])
             else:
                 aln_cmd.extend(["-1", fastq_1, "-2", fastq_2])
 
-            aln_proc = subprocess.Popen(aln_cmd, stdout=subprocess.PIPE)
-
+            cmds = [aln_cmd]
             if fastq_2 is not None:
-                sort_cmd = ["samtools", "sort", "-@", "4", "-n", "-O", "SAM"]
-                sort_proc = subprocess.Popen(
-                    sort_cmd, stdin=aln_proc.stdout, stdout=subprocess.PIPE
-                )
+                # samtools -@ is the number of additional threads
+                sort_threads = str(chain_threads["sort"] - 1)
+                cmds.append(["samtools", "sort", "-@", sort_threads, "-n", "-O", "SAM"])
 
-            fastq_cmd = ["samtools", "fastq", "-f", "4", "-@", "4", "-"]
+            fastq_threads = str(chain_threads["fastq"] - 1)
+            fastq_cmd = ["samtools", "fastq", "-f", "4", "-@", fastq_threads, "-"]
             if fastq_2 is None:
                 fastq_1 = tmp_dir / "filter.fq"
                 fastq_cmd.extend(["-0", str(fastq_1), "-s", "/dev/null"])
-                fastq_proc = subprocess.run(fastq_cmd, stdin=aln_proc.stdout)
-                if not fastq_1.is_file():
-                    raise Exception("Failed to extract non-human reads")
             else:
                 fastq_1 = tmp_dir / "filter_1.fq"
                 fastq_2 = tmp_dir / "filter_2.fq"
@@ -129,40 +228,187 @@ def remove_human_reads(
                         "-n",
                     ]
                 )
-                fastq_proc = subprocess.run(fastq_cmd, stdin=sort_proc.stdout)
-
-            if fastq_proc.returncode:
-                print(" ".join([str(i) for i in fastq_proc.args]))
+            cmds.append(fastq_cmd)
+            run_pipeline(cmds)
+            if not fastq_1.is_file():
                 raise Exception("Failed to extract non-human reads")
             if fastq_1.is_file():
                 fastq_1 = fastq_1.rename(f"{fastq_1_basename}.nonhuman.fq")
             if fastq_2 is not None and fastq_2.is_file():
                 fastq_2 = fastq_2.rename(f"{fastq_2_basename}.nonhuman.fq")
+            emit(
+                "host_removal",
+                "end",
+                aligner=aln_prog,
+                sample_id=sample_id,
+                elapsed=round(time.time() - step_start, 3),
+            )
     return fastq_1, fastq_2
 
 
 @set_threads
 @set_out_dir
 def main(
-    fastq_1, fastq_2=None, bowtie2_idx=None, hisat2_idx=None, threads=0, out_dir=None
+    fastq_1,
+    fastq_2=None,
+    bowtie2_idx=None,
+    hisat2_idx=None,
+    shared_index=False,
+    threads=0,
+    out_dir=None,
 ):
-    qc_out = qc_filter(fastq_1, fastq_2, threads=threads, out_dir=out_dir)
+    sample_id = Path(fastq_1).name.split(".")[0]
+    with track_stage("qc", sample_id=sample_id) as progress, instrument("qc"):
+        qc_out = qc_filter(fastq_1, fastq_2, threads=threads, out_dir=out_dir)
+        progress.update(**fastp_read_counts(qc_out["json"]))
     fastq_1 = qc_out["fastq_1"]
     fastq_2 = qc_out["fastq_2"]
     if bowtie2_idx is not None and hisat2_idx is not None:
-        nhuman_fastq_1, nhuman_fastq_2 = remove_human_reads(
+        with instrument("host_removal"):
+            nhuman_fastq_1, nhuman_fastq_2 = remove_human_reads(
+                fastq_1,
+                fastq_2,
+                bowtie2_idx=bowtie2_idx,
+                hisat2_idx=hisat2_idx,
+                shared_index=shared_index,
+                threads=threads,
+                out_dir=out_dir,
+            )
+    else:
+        raise Exception("bowtie2_idx and hisat2_idx must be provided")
+    fastq_1.unlink()
+    if fastq_2 is not None:
+        fastq_2.unlink()
+    return nhuman_fastq_1, nhuman_fastq_2
+
+
+def estimate_host_fraction(
+    fastq_1,
+    fastq_2=None,
+    bowtie2_idx=None,
+    hisat2_idx=None,
+    probe_n=20000,
+    shared_index=False,
+    threads=0,
+    out_dir=None,
+):
+    """
+    Estimate the fraction of reads lost to QC and host removal on a random probe
+    fastq_1: path to fastq file -> Path
+    fastq_2: path to fastq file -> Path
+    probe_n: number of reads in the probe -> int
+    return: (removed fraction, number of probed reads) -> tuple
+    """
+    out_dir = Path().cwd() if out_dir is None else Path(out_dir)
+    with tempfile.TemporaryDirectory(prefix="host_probe_", dir=out_dir) as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        probe_1 = seqtk_sample(
+            fastq_1, probe_n, tmp_dir / f"{get_basename(Path(fastq_1).name)}.fq"
+        )
+        probe_2 = (
+            seqtk_sample(
+                fastq_2, probe_n, tmp_dir / f"{get_basename(Path(fastq_2).name)}.fq"
+            )
+            if fastq_2 is not None
+            else None
+        )
+        sampled_n = count_reads(probe_1)
+        if sampled_n == 0:
+            return 0.0, 0
+        nhuman_1, _ = main(
+            probe_1,
+            probe_2,
+            bowtie2_idx=bowtie2_idx,
+            hisat2_idx=hisat2_idx,
+            shared_index=shared_index,
+            threads=threads,
+            out_dir=tmp_dir,
+        )
+        kept_n = count_reads(nhuman_1) if Path(nhuman_1).is_file() else 0
+    return 1 - kept_n / sampled_n, sampled_n
+
+
+@set_threads
+@set_out_dir
+def subsample_first_main(
+    fastq_1,
+    fastq_2=None,
+    bowtie2_idx=None,
+    hisat2_idx=None,
+    subsample_n=1000000,
+    probe_n=20000,
+    margin=1.2,
+    shared_index=False,
+    threads=0,
+    out_dir=None,
+):
+    """
+    Host-filter only as many reads as needed to yield subsample_n non-host reads.
+    The removed fraction is estimated on a probe, then the input is subsampled to
+    subsample_n / (1 - fraction) * margin reads before running main.
+    fastq_1: path to fastq file -> Path
+    fastq_2: path to fastq file -> Path
+    subsample_n: target number of non-host reads -> int
+    probe_n: number of reads used to estimate the host fraction -> int
+    margin: oversampling factor on top of the estimate -> float
+    """
+    fastq_1 = Path(fastq_1).resolve()
+    fastq_2 = Path(fastq_2).resolve() if fastq_2 is not None else None
+    total_n = count_reads(fastq_1)
+    host_frac, sampled_n = estimate_host_fraction(
+        fastq_1,
+        fastq_2,
+        bowtie2_idx=bowtie2_idx,
+        hisat2_idx=hisat2_idx,
+        probe_n=probe_n,
+        shared_index=shared_index,
+        threads=threads,
+        out_dir=out_dir,
+    )
+    keep_frac = max(1 - host_frac, 1 / max(sampled_n, 1))
+    needed_n = math.ceil(subsample_n / keep_frac * margin)
+    print(
+        f"estimated host fraction: {host_frac:.4f} ({sampled_n} probe reads), "
+        f"filtering {min(needed_n, total_n)} of {total_n} reads"
+    )
+    if needed_n >= total_n:
+        return main(
             fastq_1,
             fastq_2,
             bowtie2_idx=bowtie2_idx,
             hisat2_idx=hisat2_idx,
+            shared_index=shared_index,
             threads=threads,
             out_dir=out_dir,
         )
-    else:
-        raise Exception("bowtie2_idx and hisat2_idx must be provided")
-    fastq_1.unlink()
-    if fastq_2 is not None:
-        fastq_2.unlink()
+
+    with tempfile.TemporaryDirectory(prefix="host_subset_", dir=out_dir) as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        subset_1 = seqtk_sample(
+            fastq_1, needed_n, tmp_dir / f"{get_basename(fastq_1.name)}.fq"
+        )
+        subset_2 = (
+            seqtk_sample(
+                fastq_2, needed_n, tmp_dir / f"{get_basename(fastq_2.name)}.fq"
+            )
+            if fastq_2 is not None
+            else None
+        )
+        nhuman_fastq_1, nhuman_fastq_2 = main(
+            subset_1,
+            subset_2,
+            bowtie2_idx=bowtie2_idx,
+            hisat2_idx=hisat2_idx,
+            shared_index=shared_index,
+            threads=threads,
+            out_dir=tmp_dir,
+        )
+        nhuman_fastq_1 = Path(shutil.move(nhuman_fastq_1, out_dir))
+        if nhuman_fastq_2 is not None:
+            nhuman_fastq_2 = Path(shutil.move(nhuman_fastq_2, out_dir))
+        for report in ("fastp.json", "fastp.html"):
+            if (tmp_dir / report).is_file():
+                shutil.move(tmp_dir / report, out_dir / report)
     return nhuman_fastq_1, nhuman_fastq_2
 
 
@@ -196,6 +442,33 @@ def main(
     type=BaseNameType(),
     required=True,
 )
+@click.option(
+    "--shared_index",
+    help="warm the human indexes once per node and share them with --mm",
+    is_flag=True,
+    default=False,
+)
+@click.option(
+    "--subsample_first",
+    help="estimate the host fraction on a probe and only filter enough reads "
+    "to yield --subsample_n non-host reads",
+    is_flag=True,
+    default=False,
+)
+@click.option(
+    "--subsample_n",
+    help="target number of non-host reads for --subsample_first",
+    type=int,
+    default=1000000,
+    show_default=True,
+)
+@click.option(
+    "--probe_n",
+    help="number of reads used to estimate the host fraction",
+    type=int,
+    default=20000,
+    show_default=True,
+)
 @click.option(
     "--threads",
     "-t",
@@ -212,12 +485,38 @@ def main(
     default=Path().cwd(),
     show_default=True,
 )
-def cli(fastq_1, fastq_2, bowtie2_idx, hisat2_idx, threads, out_dir):
-    main(
-        fastq_1=fastq_1,
-        fastq_2=fastq_2,
-        bowtie2_idx=bowtie2_idx,
-        hisat2_idx=hisat2_idx,
-        threads=threads,
-        out_dir=out_dir,
-    )
+@instrument("host_filter", sample_from="fastq_1")
+def cli(
+    fastq_1,
+    fastq_2,
+    bowtie2_idx,
+    hisat2_idx,
+    shared_index,
+    subsample_first,
+    subsample_n,
+    probe_n,
+    threads,
+    out_dir,
+):
+    if subsample_first:
+        subsample_first_main(
+            fastq_1=fastq_1,
+            fastq_2=fastq_2,
+            bowtie2_idx=bowtie2_idx,
+            hisat2_idx=hisat2_idx,
+            subsample_n=subsample_n,
+            probe_n=probe_n,
+            shared_index=shared_index,
+            threads=threads,
+            out_dir=out_dir,
+        )
+    else:
+        main(
+            fastq_1=fastq_1,
+            fastq_2=fastq_2,
+            bowtie2_idx=bowtie2_idx,
+            hisat2_idx=hisat2_idx,
+            shared_index=shared_index,
+            threads=threads,
+            out_dir=out_dir,
+        )
@@ -0,0 +1,492 @@
+#!/usr/bin/env python3
+import os
+import csv
+import json
+import time
+import uuid
+import signal
+import sqlite3
+import threading
+import subprocess
+from pathlib import Path
+
+from modules.common import PROJECT_ROOT, MAX_THREADS, read_config, logger
+from modules.progress import PROGRESS_ENV, emit
+
+JOB_STATES = ("queued", "running", "succeeded", "failed", "cancelled")
+# seconds nextflow gets to shut down after SIGTERM before its group is killed
+STOP_GRACE = 30
+
+
+def get_job_config(config=None):
+    """
+    Job runner settings from the "jobs" section of config.yml
+    return: settings with defaults filled in -> dict
+    """
+    config = read_config() if config is None else config
+    job_config = {
+        "job_dir": str(PROJECT_ROOT / "jobs"),
+        "nextflow": "nextflow",
+        "profile": "local",
+        "cpus": MAX_THREADS,
+        "memory_gb": 0,
+        "job_cpus": 12,
+        "job_memory_gb": 80,
+        "poll_interval": 5,
+    }
+    job_config.update(
+        {
+            key: value
+            for key, value in (config.get("jobs") or {}).items()
+            if value not in (None, "")
+        }
+    )
+    return job_config
+
+
+def get_total_memory_gb():
+    """
+    return: MemTotal from /proc/meminfo in GB, None if unknown -> float
+    """
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    return int(line.split()[1]) / 1024**2
+    except OSError:
+        pass
+    return None
+
+
+def process_start(pid):
+    """
+    Identity of a process that a reused pid does not share: the boot id and
+    the start time of the process in clock ticks since boot
+    pid: process id -> int
+    return: "{boot_id}:{start}", None if there is no such process -> str
+    """
+    try:
+        stat = Path(f"/proc/{pid}/stat").read_text()
+        boot_id = Path("/proc/sys/kernel/random/boot_id").read_text().strip()
+    except OSError:
+        return None
+    # fields after the command name, which may contain spaces and parentheses
+    return f"{boot_id}:{stat.rsplit(')', 1)[1].split()[19]}"
+
+
+def stop_group(pgid, grace=STOP_GRACE):
+    """
+    SIGTERM a process group and wait until all of its processes have exited,
+    SIGKILL it after grace seconds
+    pgid: process group id -> int
+    """
+    deadline = time.time() + grace
+    sig = signal.SIGTERM
+    while True:
+        try:
+            os.killpg(pgid, sig)
+        except ProcessLookupError:
+            return
+        except PermissionError:
+            logger.error(f"not allowed to stop process group {pgid}")
+            return
+        if sig == signal.SIGTERM:
+            sig = 0
+        elif sig == 0 and time.time() > deadline:
+            logger.info(f"process group {pgid} did not exit, killing it")
+            sig = signal.SIGKILL
+            deadline = time.time() + grace
+        elif sig == signal.SIGKILL and time.time() > deadline:
+            logger.error(f"process group {pgid} did not exit after SIGKILL")
+            return
+        time.sleep(0.2)
+
+
+class JobStore:
+    """
+    Persistent job queue in SQLite, safe to share between the API threads and
+    the scheduler thread.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.db_path, timeout=60, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "job_id TEXT PRIMARY KEY, project_id TEXT, status TEXT, params TEXT, "
+            "cpus INTEGER, memory_gb REAL, out_dir TEXT, work_dir TEXT, "
+            "resume INTEGER DEFAULT 0, submitted REAL, started REAL, finished REAL, "
+            "pid INTEGER, pid_start TEXT, returncode INTEGER, error TEXT)"
+        )
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(jobs)")]
+        if "pid_start" not in columns:
+            # queues created before pid_start was recorded
+            self.conn.execute("ALTER TABLE jobs ADD COLUMN pid_start TEXT")
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, submitted)"
+        )
+        self.conn.commit()
+
+    def _to_dict(self, row):
+        job = dict(row)
+        job["params"] = json.loads(job["params"])
+        job["resume"] = bool(job["resume"])
+        return job
+
+    def add(self, project_id, params, cpus, memory_gb, job_dir):
+        """
+        Queue a pipeline run
+        project_id: project the run belongs to -> str
+        params: nextflow params, e.g. {"reads": "/data/*.fq.gz"} -> dict
+        cpus: cpus reserved for the run -> int
+        memory_gb: memory reserved for the run -> float
+        job_dir: parent directory of the job work directories -> Path
+        return: job -> dict
+        """
+        job_id = uuid.uuid4().hex[:12]
+        work_dir = Path(job_dir) / job_id
+        out_dir = params.get("out_dir") or str(work_dir / "out")
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO jobs (job_id, project_id, status, params, cpus, "
+                "memory_gb, out_dir, work_dir, submitted) "
+                "VALUES (?, ?, 'queued', ?, ?, ?, ?, ?, ?)",
+                (
+                    job_id,
+                    project_id,
+                    json.dumps(params),
+                    cpus,
+                    memory_gb,
+                    out_dir,
+                    str(work_dir),
+                    time.time(),
+                ),
+            )
+        return self.get(job_id)
+
+    def get(self, job_id):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT * FROM jobs WHERE job_id = ?", (job_id,)
+            ).fetchone()
+        return None if row is None else self._to_dict(row)
+
+    def list(self, status=None, project_id=None, limit=100):
+        """
+        return: jobs, newest first -> list
+        """
+        query = "SELECT * FROM jobs WHERE 1 = 1"
+        args = []
+        if status:
+            query += " AND status = ?"
+            args.append(status)
+        if project_id:
+            query += " AND project_id = ?"
+            args.append(project_id)
+        query += " ORDER BY submitted DESC LIMIT ?"
+        args.append(limit)
+        with self.lock:
+            rows = self.conn.execute(query, args).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def update(self, job_id, **values):
+        columns = ", ".join(f"{col} = ?" for col in values)
+        with self.lock, self.conn:
+            self.conn.execute(
+                f"UPDATE jobs SET {columns} WHERE job_id = ?",
+                (*values.values(), job_id),
+            )
+
+    def update_if(self, job_id, current, **values):
+        """
+        Update a job only while it is still in status current
+        current: expected status of the job -> str
+        return: True if the job was updated -> bool
+        """
+        columns = ", ".join(f"{col} = ?" for col in values)
+        with self.lock, self.conn:
+            cursor = self.conn.execute(
+                f"UPDATE jobs SET {columns} WHERE job_id = ? AND status = ?",
+                (*values.values(), job_id, current),
+            )
+        return cursor.rowcount == 1
+
+    def close(self):
+        self.conn.close()
+
+
+def read_trace(trace_file):
+    """
+    Summarise a nextflow trace file
+    trace_file: path to trace.txt -> Path
+    return: task counts per status and per process -> dict
+    """
+    progress = {"tasks": 0, "completed": 0, "failed": 0, "processes": {}}
+    if not Path(trace_file).is_file():
+        return progress
+    with open(trace_file) as f:
+        for row in csv.DictReader(f, delimiter="\t"):
+            process = row.get("name", "").split(" (")[0]
+            status = row.get("status", "")
+            counts = progress["processes"].setdefault(
+                process, {"tasks": 0, "completed": 0}
+            )
+            progress["tasks"] += 1
+            counts["tasks"] += 1
+            if status in ("COMPLETED", "CACHED"):
+                progress["completed"] += 1
+                counts["completed"] += 1
+            elif status in ("FAILED", "ABORTED"):
+                progress["failed"] += 1
+    return progress
+
+
+class JobRunner:
+    """
+    Scheduler thread that starts queued runs as nextflow subprocesses.
+    A run is only admitted when its cpus and memory fit in what is left of the
+    node budget, so queued runs wait instead of oversubscribing the node.
+    Runs start in their own session, so cancelling kills the whole process
+    tree, with SIGKILL after STOP_GRACE seconds. A run holds its share of the
+    budget until its nextflow has exited, whatever its status. Runs left
+    "running" by a previous server are stopped (if their nextflow is still
+    alive) and re-queued with -resume. on_success(job) is called after a run finishes cleanly.
+    """
+
+    def __init__(self, store, job_config, on_success=None):
+        self.store = store
+        self.config = job_config
+        self.on_success = on_success
+        self.procs = {}
+        # job_id -> time after which a cancelled run still alive is killed
+        self.kill_at = {}
+        # held while a run is started or cancelled, so a cancel can not slip
+        # between claiming a queued run and registering its process
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def budget(self):
+        """
+        return: (cpus, memory_gb) of the node available to runs -> tuple
+        """
+        memory_gb = self.config["memory_gb"]
+        if not memory_gb:
+            total = get_total_memory_gb()
+            memory_gb = float("inf") if total is None else total
+        return int(self.config["cpus"]), float(memory_gb)
+
+    def check_request(self, cpus, memory_gb):
+        """
+        Reject runs that could never be admitted
+        """
+        total_cpus, total_memory_gb = self.budget()
+        if cpus > total_cpus:
+            raise ValueError(f"cpus {cpus} exceeds the node budget of {total_cpus}")
+        if memory_gb > total_memory_gb:
+            raise ValueError(
+                f"memory_gb {memory_gb} exceeds the node budget of {total_memory_gb}"
+            )
+
+    def progress_file(self, job):
+        """
+        return: progress events of the run, see modules.progress -> Path
+        """
+        return Path(job["work_dir"]) / "progress.jsonl"
+
+    def build_cmd(self, job):
+        params = dict(job["params"])
+        params["out_dir"] = job["out_dir"]
+        params["threads"] = job["cpus"]
+        params["memory"] = f"{int(job['memory_gb'])}G"
+        cmd = [
+            self.config["nextflow"],
+            "run",
+            str(PROJECT_ROOT / "backend" / "main.nf"),
+            "-profile",
+            self.config["profile"],
+            "-with-trace",
+            "trace.txt",
+        ]
+        if job["resume"]:
+            cmd.append("-resume")
+        for key, value in params.items():
+            if isinstance(value, bool):
+                value = str(value).lower()
+            cmd.extend([f"--{key}", str(value)])
+        return cmd
+
+    def start(self, job):
+        """
+        Start a queued run, unless it has left the queue since it was listed
+        return: True if the run was started -> bool
+        """
+        job_id = job["job_id"]
+        with self.lock:
+            if not self.store.update_if(
+                job_id, "queued", status="running", started=time.time()
+            ):
+                return False
+            work_dir = Path(job["work_dir"])
+            cmd = self.build_cmd(job)
+            try:
+                work_dir.mkdir(parents=True, exist_ok=True)
+                with open(work_dir / "nextflow.log", "ab") as log:
+                    proc = subprocess.Popen(
+                        cmd,
+                        cwd=work_dir,
+                        stdout=log,
+                        stderr=subprocess.STDOUT,
+                        stdin=subprocess.DEVNULL,
+                        start_new_session=True,
+                        env=dict(
+                            os.environ,
+                            REICH_JOB_ID=job_id,
+                            **{PROGRESS_ENV: str(self.progress_file(job))},
+                        ),
+                    )
+            except OSError as e:
+                self.store.update(
+                    job_id, status="failed", finished=time.time(), error=str(e)
+                )
+                logger.error(f"job {job_id} failed to start: {e}")
+                return False
+            self.procs[job_id] = proc
+            self.store.update(job_id, pid=proc.pid, pid_start=process_start(proc.pid))
+        emit("job", "running", path=self.progress_file(job), job_id=job_id)
+        logger.info(f"job {job_id} started: {' '.join(cmd)}")
+        return True
+
+    def reap(self):
+        for job_id, proc in list(self.procs.items()):
+            returncode = proc.poll()
+            if returncode is None:
+                kill_at = self.kill_at.get(job_id)
+                if kill_at is not None and time.time() >= kill_at:
+                    logger.warning(f"job {job_id}: nextflow ignored SIGTERM, killing")
+                    try:
+                        os.killpg(proc.pid, signal.SIGKILL)
+                    except ProcessLookupError:
+                        pass
+                    self.kill_at.pop(job_id, None)
+                continue
+            del self.procs[job_id]
+            self.kill_at.pop(job_id, None)
+            job = self.store.get(job_id)
+            status = "succeeded" if returncode == 0 else "failed"
+            # a cancelled run keeps its status
+            if not self.store.update_if(
+                job_id,
+                "running",
+                status=status,
+                finished=time.time(),
+                returncode=returncode,
+            ):
+                continue
+            emit("job", status, path=self.progress_file(job), job_id=job_id)
+            logger.info(f"job {job_id} finished with code {returncode}")
+            if returncode == 0 and self.on_success is not None:
+                try:
+                    self.on_success(self.store.get(job_id))
+                except Exception as e:
+                    logger.error(f"job {job_id}: {e}")
+                    self.store.update(job_id, error=str(e))
+
+    def admit(self):
+        total_cpus, total_memory_gb = self.budget()
+        # a cancelled run keeps its cpus and memory until its nextflow exits
+        running = [self.store.get(job_id) for job_id in list(self.procs)]
+        used_cpus = sum(job["cpus"] for job in running if job)
+        used_memory_gb = sum(job["memory_gb"] for job in running if job)
+        # oldest first; stop at the first run that does not fit so that large
+        # runs are not starved by small ones
+        for job in reversed(self.store.list(status="queued", limit=-1)):
+            if (
+                used_cpus + job["cpus"] > total_cpus
+                or used_memory_gb + job["memory_gb"] > total_memory_gb
+            ):
+                break
+            if not self.start(job):
+                continue
+            used_cpus += job["cpus"]
+            used_memory_gb += job["memory_gb"]
+
+    def recover(self):
+        for job in self.store.list(status="running", limit=-1):
+            # the pid may have been reused after a reboot or a long downtime,
+            # only the nextflow started for this job is stopped
+            pid_start = job["pid_start"]
+            if pid_start and pid_start == process_start(job["pid"]):
+                logger.info(f"job {job['job_id']}: stopping nextflow {job['pid']}")
+                # -resume fails while the old run holds the session lock
+                stop_group(job["pid"])
+            self.store.update(
+                job["job_id"], status="queued", resume=1, pid=None, pid_start=None
+            )
+            logger.info(f"job {job['job_id']} re-queued after restart")
+
+    def cancel(self, job_id):
+        """
+        Cancel a queued or running job
+        return: job after cancelling, None if it does not exist -> dict
+        """
+        with self.lock:
+            job = self.store.get(job_id)
+            if job is None or job["status"] not in ("queued", "running"):
+                return job
+            if not self.store.update_if(
+                job_id, job["status"], status="cancelled", finished=time.time()
+            ):
+                # finished or started meanwhile, report its current state
+                return self.store.get(job_id)
+            proc = self.procs.get(job_id)
+            if proc is not None and proc.poll() is None:
+                try:
+                    os.killpg(proc.pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+                else:
+                    # reap escalates to SIGKILL
+                    self.kill_at[job_id] = time.time() + STOP_GRACE
+        if Path(job["work_dir"]).is_dir():
+            emit("job", "cancelled", path=self.progress_file(job), job_id=job_id)
+        return self.store.get(job_id)
+
+    def progress(self, job_id):
+        """
+        return: job status with task counts from the nextflow trace -> dict
+        """
+        job = self.store.get(job_id)
+        if job is None:
+            return None
+        progress = read_trace(Path(job["work_dir"]) / "trace.txt")
+        progress.update(
+            {key: job[key] for key in ("job_id", "status", "started", "finished")}
+        )
+        return progress
+
+    def loop(self):
+        self.recover()
+        while not self.stop_event.is_set():
+            try:
+                self.reap()
+                self.admit()
+            except Exception as e:
+                logger.error(f"job scheduler: {e}")
+            self.stop_event.wait(self.config["poll_interval"])
+
+    def run_in_thread(self):
+        self.thread = threading.Thread(
+            target=self.loop, name="job-scheduler", daemon=True
+        )
+        self.thread.start()
+        return self.thread
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
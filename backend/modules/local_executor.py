@@ -0,0 +1,871 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import glob
+import time
+import shutil
+import click
+from pathlib import Path
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from modules.common import (
+    CONTEXT_SETTINGS,
+    BaseNameType,
+    MAX_THREADS,
+    PROFILE_ENV,
+    AdvancedJSONEncoder,
+    instrument,
+)
+from modules.validate import validate_fastq
+from modules.host_filter import main as host_filter_main, subsample_first_main
+from modules.subsample import subsample_reads
+from modules.dedup import dedup_reads
+from modules.adaptive import adaptive_sample
+from modules.alignment import main as alignment_main
+from modules.taxonparse import (
+    assign_taxon,
+    get_lineage,
+    map_with_lineages,
+    read_hit_taxids,
+    read_taxonomy,
+)
+from modules.abundance import calculate_abundance
+from modules.reflen import RefLengthIndex
+from modules.report import assign_and_report, species_report
+from modules.coverage import get_coverage, get_species_coverage
+
+# same names and defaults as the params of nextflow_template.config
+DEFAULT_PARAMS = {
+    "threads": MAX_THREADS,
+    "sub_threads": max(1, MAX_THREADS // 4),
+    "read_type": "illumina",
+    "bowtie2_idx": None,
+    "hisat2_idx": None,
+    "nonhuman_db": None,
+    "taxdump_dir": None,
+    "length_index": None,
+    "shared_index": False,
+    "subsample_n": 1000000,
+    "subsample_first": False,
+    "dedup": False,
+    "count_mode": "total",
+    "aln_cache_dir": None,
+    "aln_cache_size": 10,
+    "background_model": None,
+    "fused_report": True,
+    "coverage": False,
+    "adaptive": False,
+    "adaptive_start_n": 100000,
+    "adaptive_top_n": 10,
+    "adaptive_tolerance": 0.05,
+}
+# stages that hold a human or reference index run one at a time by default,
+# with all threads, the others are limited by the number of workers only.
+# Every task also reserves its threads from the cpu budget of the executor, so
+# index stages of different samples do not run at the same time either.
+STAGE_LIMITS = {"host_filter": 1, "adaptive_sample": 1, "pathogen_alignment": 1}
+STATE_DIR = ".local_executor"
+
+
+def get_sample_id(path):
+    return Path(path).name.split(".")[0]
+
+
+def _fingerprint(value):
+    """
+    Resume key of task arguments, files are identified by path, size and mtime
+    """
+    if isinstance(value, dict):
+        return {key: _fingerprint(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_fingerprint(item) for item in value]
+    if isinstance(value, Path):
+        if value.is_file():
+            stat = value.stat()
+            return [str(value), stat.st_size, stat.st_mtime_ns]
+        return str(value)
+    return value
+
+
+def _strip_memory(result):
+    # results kept in memory only are stored under "memory"
+    if isinstance(result, dict):
+        return {
+            key: _strip_memory(value)
+            for key, value in result.items()
+            if key != "memory"
+        }
+    return result
+
+
+def _collect_paths(result):
+    if isinstance(result, Path):
+        return [result]
+    if isinstance(result, dict):
+        return [path for value in result.values() for path in _collect_paths(value)]
+    if isinstance(result, (list, tuple)):
+        return [path for value in result for path in _collect_paths(value)]
+    return []
+
+
+def _restore_paths(result, paths):
+    if isinstance(result, dict):
+        return {key: _restore_paths(value, paths) for key, value in result.items()}
+    if isinstance(result, list):
+        return [_restore_paths(value, paths) for value in result]
+    if isinstance(result, str) and result in paths:
+        return Path(result)
+    return result
+
+
+def _call(stage, sample_id, metrics_dir, func, kwargs):
+    with instrument(stage, out_dir=metrics_dir, sample_id=sample_id):
+        return func(**kwargs)
+
+
+class Task:
+    """
+    One stage of one sample, or of all samples for a batch stage.
+    args is called with the results of deps and returns the keyword arguments
+    of func, which are also the resume key; None skips the task (and the
+    tasks that depend on it). memory, for inline tasks, returns arguments
+    taken from results held in memory, which are not part of the key.
+    cpus are reserved from the budget of the executor while the task runs.
+    """
+
+    def __init__(
+        self,
+        stage,
+        func,
+        args,
+        deps=(),
+        sample_id=None,
+        memory=None,
+        inline=False,
+        cpus=1,
+    ):
+        self.stage = stage
+        self.func = func
+        self.args = args
+        self.deps = list(deps)
+        self.sample_id = sample_id
+        self.memory = memory
+        self.inline = inline
+        self.cpus = cpus
+        self.status = "pending"
+        self.result = None
+
+    @property
+    def name(self):
+        if self.sample_id is None:
+            return self.stage
+        return f"{self.stage} ({self.sample_id})"
+
+
+class LocalExecutor:
+    """
+    Run a DAG of tasks in a process pool without nextflow.
+    Tasks start when their dependencies are done, up to workers at a time, up
+    to the limit of their stage and while their cpus fit in what is left of
+    the cpu budget. A task that does not fit holds back the tasks after it, so
+    it is not starved by cheaper ones. Inline tasks, the cheap stages, run in this
+    process and are given the results of their dependencies in memory.
+    Finished tasks are recorded in out_dir/.local_executor; with resume, a task
+    whose arguments and input files are unchanged and whose outputs exist is
+    not run again. After a failure no new task is started, the running ones
+    are finished so they can be reused.
+    """
+
+    def __init__(self, out_dir, workers=0, limits=None, resume=True, cpus=0):
+        self.out_dir = Path(out_dir)
+        self.state_dir = self.out_dir / STATE_DIR
+        self.metrics_dir = self.out_dir / "metrics"
+        self.workers = int(workers) or min(4, MAX_THREADS)
+        self.cpus = int(cpus) or MAX_THREADS
+        self.limits = dict(STAGE_LIMITS)
+        self.limits.update(limits or {})
+        self.resume = resume
+        self.tasks = []
+        self.failures = []
+
+    def add(self, stage, func, args, deps=(), **kwargs):
+        task = Task(stage, func, args, deps=deps, **kwargs)
+        self.tasks.append(task)
+        return task
+
+    def _state_file(self, task):
+        return self.state_dir / f"{task.sample_id or 'all'}.{task.stage}.json"
+
+    def _cached(self, task, key):
+        state_file = self._state_file(task)
+        if not self.resume or not state_file.is_file():
+            return None
+        state = json.loads(state_file.read_text())
+        if state["key"] != key:
+            return None
+        if not all(Path(path).exists() for path in state["paths"]):
+            return None
+        return _restore_paths(state["result"], set(state["paths"]))
+
+    def _save(self, task, key):
+        result = _strip_memory(task.result)
+        state = {
+            "stage": task.stage,
+            "sample_id": task.sample_id,
+            "key": key,
+            "paths": [str(path.resolve()) for path in _collect_paths(result)],
+            "result": result,
+        }
+        self.state_dir.mkdir(parents=True, exist_ok=True)
+        state_file = self._state_file(task)
+        tmp = state_file.with_name(f".{state_file.name}.tmp")
+        tmp.write_text(json.dumps(state, indent=4, cls=AdvancedJSONEncoder))
+        os.replace(tmp, state_file)
+
+    def _finish(self, task, result, key, start):
+        task.result = result
+        task.status = "done"
+        self._save(task, key)
+        click.echo(f"[done] {task.name} in {time.time() - start:.1f} s")
+
+    def _fail(self, task, error):
+        task.status = "failed"
+        self.failures.append((task, error))
+        click.echo(f"[failed] {task.name}: {error}")
+
+    def _start_ready(self, pool, running):
+        """
+        Start the tasks whose dependencies are done, as far as limits allow
+        return: whether any task changed state -> bool
+        """
+        changed = False
+        used_cpus = sum(t.cpus for t, _, _ in running.values())
+        held_back = False
+        for task in self.tasks:
+            if task.status != "pending":
+                continue
+            dep_status = set(dep.status for dep in task.deps)
+            if dep_status & {"skipped", "failed"}:
+                task.status = "skipped"
+                changed = True
+                continue
+            if dep_status - {"done", "cached"}:
+                continue
+            kwargs = task.args(*[dep.result for dep in task.deps])
+            if kwargs is None:
+                task.status = "skipped"
+                changed = True
+                continue
+            key = json.loads(json.dumps(_fingerprint(kwargs), cls=AdvancedJSONEncoder))
+            cached = self._cached(task, key)
+            if cached is not None:
+                task.result = cached
+                task.status = "cached"
+                changed = True
+                click.echo(f"[cached] {task.name}")
+                continue
+            start = time.time()
+            if task.inline:
+                if task.memory is not None:
+                    kwargs.update(task.memory(*[dep.result for dep in task.deps]))
+                try:
+                    result = _call(
+                        task.stage, task.sample_id, self.metrics_dir, task.func, kwargs
+                    )
+                except Exception as e:
+                    self._fail(task, e)
+                else:
+                    self._finish(task, result, key, start)
+                return True
+            stage_running = sum(
+                1 for t, _, _ in running.values() if t.stage == task.stage
+            )
+            if (
+                held_back
+                or len(running) >= self.workers
+                or stage_running >= self.limits.get(task.stage, self.workers)
+            ):
+                continue
+            # a task larger than the whole budget runs alone
+            if running and used_cpus + task.cpus > self.cpus:
+                held_back = True
+                continue
+            # workers are forked on submit, unflushed output would be repeated
+            sys.stdout.flush()
+            future = pool.submit(
+                _call, task.stage, task.sample_id, self.metrics_dir, task.func, kwargs
+            )
+            running[future] = (task, key, start)
+            used_cpus += task.cpus
+            task.status = "running"
+            changed = True
+            click.echo(f"[start] {task.name}")
+        return changed
+
+    def run(self):
+        """
+        return: tasks by status -> dict
+        """
+        self.failures = []
+        running = {}
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            while True:
+                while not self.failures and self._start_ready(pool, running):
+                    pass
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task, key, start = running.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        self._fail(task, e)
+                    else:
+                        self._finish(task, result, key, start)
+        if self.failures:
+            raise Exception(
+                "Failed tasks:\n"
+                + "\n".join(f"{task.name}: {e}" for task, e in self.failures)
+            )
+        status = {}
+        for task in self.tasks:
+            status.setdefault(task.status, []).append(task.name)
+        return status
+
+
+def validate_stage(reads, out_dir):
+    sample_id = get_sample_id(reads)
+    stats = validate_fastq(reads)
+    valid_json = out_dir / f"{sample_id}.valid.json"
+    valid_json.write_text(
+        json.dumps(
+            {"valid_json": valid_json, "valid_fastq": reads, "stats": stats},
+            indent=4,
+            cls=AdvancedJSONEncoder,
+        )
+    )
+    return {"reads": reads, "valid_json": valid_json}
+
+
+def host_filter_stage(
+    reads, out_dir, subsample_first=False, subsample_n=None, **kwargs
+):
+    # fastp writes fastp.json and fastp.html, so every sample gets its own
+    # work directory, like a nextflow task
+    work_dir = out_dir / f".{get_sample_id(reads)}"
+    if subsample_first:
+        fastq_1, _ = subsample_first_main(
+            reads, subsample_n=subsample_n, out_dir=work_dir, **kwargs
+        )
+    else:
+        fastq_1, _ = host_filter_main(reads, out_dir=work_dir, **kwargs)
+    nonhuman_fq = Path(fastq_1).rename(out_dir / Path(fastq_1).name)
+    shutil.rmtree(work_dir)
+    return {"reads": nonhuman_fq}
+
+
+def subsample_stage(reads, out_dir, subsample_n):
+    return {"reads": subsample_reads(reads, subsample_n, out_dir)}
+
+
+def dedup_stage(reads, out_dir):
+    dedup_fq, _, _ = dedup_reads(reads, out_dir=out_dir)
+    sample_id = get_sample_id(reads)
+    return {"reads": dedup_fq, "dedup_json": out_dir / f"{sample_id}.dedup.json"}
+
+
+def adaptive_stage(reads, out_dir, **kwargs):
+    outputs = adaptive_sample(reads, out_dir=out_dir, **kwargs)
+    return {
+        "reads": outputs["subsampled_fq"],
+        "hit_json": outputs["hit_json"],
+        "trace_json": outputs["trace_json"],
+    }
+
+
+def alignment_stage(queries, out_dir, **kwargs):
+    hit_jsons = alignment_main(queries=tuple(queries), out_dir=out_dir, **kwargs)
+    return {get_sample_id(hit_json): {"hit_json": hit_json} for hit_json in hit_jsons}
+
+
+def taxon_report_stage(hit_jsons, taxdump_dir, threads=1, **kwargs):
+    results = map_with_lineages(
+        partial(assign_and_report, taxdump_dir=taxdump_dir, **kwargs),
+        hit_jsons,
+        taxdump_dir,
+        workers=threads,
+    )
+    return {
+        get_sample_id(hit_json): outputs
+        for hit_json, outputs in zip(hit_jsons, results)
+    }
+
+
+def assign_taxon_stage(hit_jsons, out_dir, taxdump_dir):
+    taxids = set().union(*map(read_hit_taxids, hit_jsons))
+    taxid2lineage = get_lineage(taxids, taxdump_dir)
+    results = {}
+    for hit_json in hit_jsons:
+        sample_id = get_sample_id(hit_json)
+        taxonomy = assign_taxon(hit_json, taxid2lineage=taxid2lineage)
+        taxon_json = out_dir / f"{sample_id}.taxonomy.json"
+        taxon_json.write_text(json.dumps(taxonomy))
+        results[sample_id] = {
+            "taxon_json": taxon_json,
+            "memory": {"taxonomy": taxonomy},
+        }
+    return results
+
+
+def abundance_stage(
+    taxon_json, out_dir, count_mode="total", length_index=None, taxonomy=None
+):
+    sample_id = get_sample_id(taxon_json)
+    taxonomy = read_taxonomy(taxon_json) if taxonomy is None else taxonomy
+    taxid2rpm, rank_df = calculate_abundance(
+        taxonomy,
+        count_mode=count_mode,
+        length_index=RefLengthIndex(length_index) if length_index else None,
+    )
+    rpm_json = out_dir / f"{sample_id}.rpm.json"
+    rpm_json.write_text(json.dumps(taxid2rpm, indent=2))
+    rank_tsv = out_dir / f"{sample_id}.rank_rpm.tsv"
+    rank_df.to_csv(rank_tsv, sep="\t", index=False)
+    return {
+        "rpm_json": rpm_json,
+        "rank_tsv": rank_tsv,
+        "memory": {"taxonomy": taxonomy, "taxid2rpm": taxid2rpm},
+    }
+
+
+def summary_stage(
+    hit_json,
+    taxon_json,
+    rpm_json,
+    out_dir,
+    background=None,
+    taxonomy=None,
+    taxid2rpm=None,
+):
+    taxonomy = read_taxonomy(taxon_json) if taxonomy is None else taxonomy
+    if taxid2rpm is None:
+        taxid2rpm = json.loads(rpm_json.read_text())
+    hits = json.loads(hit_json.read_text())
+    report_tsv = out_dir / f"{get_sample_id(hit_json)}.report.tsv"
+    species_report(hits, taxonomy, taxid2rpm, background=background).to_csv(
+        report_tsv, sep="\t", index=False
+    )
+    return {"report_tsv": report_tsv}
+
+
+def coverage_stage(hit_json, taxon_json, out_dir, bins=10):
+    sample_id = get_sample_id(hit_json)
+    acc_df = get_coverage(json.loads(hit_json.read_text()), bins=bins)
+    outputs = {"coverage_tsv": out_dir / f"{sample_id}.coverage.tsv"}
+    acc_df.to_csv(outputs["coverage_tsv"], sep="\t", index=False)
+    sp_df = get_species_coverage(acc_df, read_taxonomy(taxon_json)["lineages"])
+    outputs["species_coverage_tsv"] = out_dir / f"{sample_id}.species_coverage.tsv"
+    sp_df.to_csv(outputs["species_coverage_tsv"], sep="\t", index=False)
+    return outputs
+
+
+def build_pipeline(executor, reads, params, out_dir):
+    """
+    Add the tasks of main.nf for every sample to executor
+    reads: input fastq files, one per sample -> list
+    params: pipeline parameters, see DEFAULT_PARAMS -> dict
+    out_dir: output directory, laid out like the published nextflow outputs -> Path
+    """
+    out_dir = Path(out_dir)
+    dirs = {
+        name: out_dir / name
+        for name in (
+            "valid_reads",
+            "nonhuman",
+            "subsampled_reads",
+            "dedup_reads",
+            "hit",
+            "taxon",
+            "rpm",
+            "report",
+            "coverage",
+        )
+    }
+    for name in ("valid_reads", "nonhuman", "subsampled_reads"):
+        dirs[name].mkdir(parents=True, exist_ok=True)
+    for name, enabled in (
+        ("dedup_reads", params["dedup"] and not params["adaptive"]),
+        ("hit", not params["adaptive"]),
+        ("taxon", True),
+        ("rpm", True),
+        ("report", True),
+        ("coverage", params["coverage"]),
+    ):
+        if enabled:
+            dirs[name].mkdir(parents=True, exist_ok=True)
+    threads = int(params["threads"]) or MAX_THREADS
+
+    def stage_threads(stage):
+        # split between the tasks of a stage that run together, the executor
+        # keeps tasks of other stages within the rest of the budget
+        limit = executor.limits.get(stage, executor.workers)
+        return max(1, threads // limit)
+
+    sample_ids = []
+    query_tasks = []
+    for fastq in reads:
+        fastq = Path(fastq).resolve()
+        sample_ids.append(get_sample_id(fastq))
+        task = executor.add(
+            "validate_reads",
+            validate_stage,
+            lambda fastq=fastq: {"reads": fastq, "out_dir": dirs["valid_reads"]},
+            sample_id=sample_ids[-1],
+        )
+        task = executor.add(
+            "host_filter",
+            host_filter_stage,
+            lambda valid: {
+                "reads": valid["reads"],
+                "out_dir": dirs["nonhuman"],
+                "bowtie2_idx": params["bowtie2_idx"],
+                "hisat2_idx": params["hisat2_idx"],
+                "shared_index": params["shared_index"],
+                "subsample_first": params["subsample_first"],
+                "subsample_n": params["subsample_n"],
+                "threads": stage_threads("host_filter"),
+            },
+            deps=[task],
+            sample_id=sample_ids[-1],
+            cpus=stage_threads("host_filter"),
+        )
+        if params["adaptive"]:
+            task = executor.add(
+                "adaptive_sample",
+                adaptive_stage,
+                lambda nonhuman: {
+                    "reads": nonhuman["reads"],
+                    "out_dir": dirs["subsampled_reads"],
+                    "reference": params["nonhuman_db"],
+                    "taxdump_dir": params["taxdump_dir"],
+                    "start_n": params["adaptive_start_n"],
+                    "max_n": params["subsample_n"],
+                    "top_n": params["adaptive_top_n"],
+                    "tolerance": params["adaptive_tolerance"],
+                    "read_type": params["read_type"],
+                    "threads": stage_threads("adaptive_sample"),
+                },
+                deps=[task],
+                sample_id=sample_ids[-1],
+                cpus=stage_threads("adaptive_sample"),
+            )
+        else:
+            task = executor.add(
+                "subsample_reads",
+                subsample_stage,
+                lambda nonhuman: {
+                    "reads": nonhuman["reads"],
+                    "out_dir": dirs["subsampled_reads"],
+                    "subsample_n": params["subsample_n"],
+                },
+                deps=[task],
+                sample_id=sample_ids[-1],
+            )
+            if params["dedup"]:
+                task = executor.add(
+                    "dedup_reads",
+                    dedup_stage,
+                    lambda subsampled: {
+                        "reads": subsampled["reads"],
+                        "out_dir": dirs["dedup_reads"],
+                    },
+                    deps=[task],
+                    sample_id=sample_ids[-1],
+                )
+        query_tasks.append(task)
+
+    if params["adaptive"]:
+        hit_tasks = query_tasks
+    else:
+        hit_tasks = [
+            executor.add(
+                "pathogen_alignment",
+                alignment_stage,
+                lambda *queries: {
+                    "queries": [query["reads"] for query in queries],
+                    "out_dir": dirs["hit"],
+                    "reference": params["nonhuman_db"],
+                    "threads": stage_threads("pathogen_alignment"),
+                    "read_type": params["read_type"],
+                    "cache_dir": params["aln_cache_dir"],
+                    "cache_size": params["aln_cache_size"],
+                },
+                deps=query_tasks,
+                cpus=stage_threads("pathogen_alignment"),
+            )
+        ]
+
+    def hit_jsons(*results):
+        if params["adaptive"]:
+            return [result["hit_json"] for result in results]
+        return [entry["hit_json"] for entry in results[0].values()]
+
+    if params["fused_report"]:
+        taxon_task = executor.add(
+            "taxon_report",
+            taxon_report_stage,
+            lambda *results: {
+                "hit_jsons": hit_jsons(*results),
+                "out_dir": out_dir,
+                "taxdump_dir": params["taxdump_dir"],
+                "count_mode": params["count_mode"],
+                "background": params["background_model"],
+                "length_index": params["length_index"],
+                "threads": params["sub_threads"],
+            },
+            deps=hit_tasks,
+            inline=True,
+        )
+    else:
+        taxon_task = executor.add(
+            "assign_taxon",
+            assign_taxon_stage,
+            lambda *results: {
+                "hit_jsons": hit_jsons(*results),
+                "out_dir": dirs["taxon"],
+                "taxdump_dir": params["taxdump_dir"],
+            },
+            deps=hit_tasks,
+            inline=True,
+        )
+
+    for i, sample_id in enumerate(sample_ids):
+        hit_task = hit_tasks[i] if params["adaptive"] else hit_tasks[0]
+        _add_sample_tasks(executor, sample_id, hit_task, taxon_task, params, dirs)
+    return executor
+
+
+def _add_sample_tasks(executor, sample_id, hit_task, taxon_task, params, dirs):
+    """
+    Add the per-sample tasks after taxon assignment, skipped without hits
+    """
+
+    def sample_outputs(hit_result, taxon_result):
+        # a batch alignment result is keyed by sample, an adaptive one is not
+        hit = hit_result if "hit_json" in hit_result else hit_result.get(sample_id)
+        taxon = taxon_result.get(sample_id)
+        if hit is None or taxon is None:
+            return None
+        return {
+            "hit_json": hit["hit_json"],
+            "taxon_json": taxon["taxon_json"],
+            "memory": taxon.get("memory", {}),
+        }
+
+    if not params["fused_report"]:
+
+        def abundance_args(hit_result, taxon_result):
+            outputs = sample_outputs(hit_result, taxon_result)
+            if outputs is None:
+                return None
+            return {
+                "taxon_json": outputs["taxon_json"],
+                "out_dir": dirs["rpm"],
+                "count_mode": params["count_mode"],
+                "length_index": params["length_index"],
+            }
+
+        def report_args(hit_result, taxon_result, abundance):
+            outputs = sample_outputs(hit_result, taxon_result)
+            return {
+                "hit_json": outputs["hit_json"],
+                "taxon_json": outputs["taxon_json"],
+                "rpm_json": abundance["rpm_json"],
+                "out_dir": dirs["report"],
+                "background": params["background_model"],
+            }
+
+        abundance_task = executor.add(
+            "abundance_calculation",
+            abundance_stage,
+            abundance_args,
+            deps=[hit_task, taxon_task],
+            sample_id=sample_id,
+            memory=lambda hit_result, taxon_result: sample_outputs(
+                hit_result, taxon_result
+            )["memory"],
+            inline=True,
+        )
+        executor.add(
+            "summary_report",
+            summary_stage,
+            report_args,
+            deps=[hit_task, taxon_task, abundance_task],
+            sample_id=sample_id,
+            memory=lambda hit_result, taxon_result, abundance: abundance.get(
+                "memory", {}
+            ),
+            inline=True,
+        )
+
+    if params["coverage"]:
+
+        def coverage_args(hit_result, taxon_result):
+            outputs = sample_outputs(hit_result, taxon_result)
+            if outputs is None:
+                return None
+            return {
+                "hit_json": outputs["hit_json"],
+                "taxon_json": outputs["taxon_json"],
+                "out_dir": dirs["coverage"],
+            }
+
+        executor.add(
+            "coverage",
+            coverage_stage,
+            coverage_args,
+            deps=[hit_task, taxon_task],
+            sample_id=sample_id,
+        )
+
+
+@click.command(
+    help="Run the pipeline on a few samples in one process pool, without nextflow",
+    context_settings=CONTEXT_SETTINGS,
+)
+@click.option(
+    "--reads",
+    help="reads, a file or glob pattern, one file per sample (multiple allowed)",
+    required=True,
+    multiple=True,
+)
+@click.option(
+    "--out_dir",
+    "-o",
+    help="output directory",
+    type=click.Path(file_okay=False, resolve_path=True, path_type=Path),
+    default="./reich_out",
+    show_default=True,
+)
+@click.option(
+    "--bowtie2_idx", help="bowtie2 index of human", type=BaseNameType(), required=True
+)
+@click.option(
+    "--hisat2_idx", help="hisat2 index of human", type=BaseNameType(), required=True
+)
+@click.option(
+    "--nonhuman_db",
+    help="non-human reference fasta",
+    type=click.Path(exists=True, dir_okay=False, resolve_path=True, path_type=Path),
+    required=True,
+)
+@click.option(
+    "--taxdump_dir",
+    help="taxdump directory",
+    type=click.Path(exists=True, file_okay=False, resolve_path=True, path_type=Path),
+    required=True,
+)
+@click.option(
+    "--length_index",
+    help="reference length index from build_db, adds RPKM and TPM",
+    type=click.Path(exists=True, file_okay=False, resolve_path=True, path_type=Path),
+)
+@click.option(
+    "--background_model",
+    help="background model of control samples (.npz) for Z scores",
+    type=click.Path(exists=True, dir_okay=False, resolve_path=True, path_type=Path),
+)
+@click.option(
+    "--threads",
+    "-t",
+    help="number of threads, default: 0 (use all available cores)",
+    type=int,
+    default=0,
+)
+@click.option(
+    "--sub_threads",
+    help="worker processes of the taxon report",
+    type=int,
+    default=DEFAULT_PARAMS["sub_threads"],
+    show_default=True,
+)
+@click.option(
+    "--workers",
+    "-w",
+    help="tasks run at the same time, default: 0 (4, at most the number of cores)",
+    type=int,
+    default=0,
+)
+@click.option(
+    "--limit",
+    help="most tasks of a stage run at the same time, e.g. host_filter=2 "
+    "(multiple allowed)",
+    multiple=True,
+)
+@click.option(
+    "--resume/--no_resume",
+    help="reuse the outputs of tasks finished by an earlier run",
+    default=True,
+    show_default=True,
+)
+@click.option("--read_type", type=click.Choice(["illumina", "ont"]), default="illumina")
+@click.option("--shared_index", type=bool, default=False, show_default=True)
+@click.option("--subsample_n", type=int, default=1000000, show_default=True)
+@click.option("--subsample_first", type=bool, default=False, show_default=True)
+@click.option("--dedup", type=bool, default=False, show_default=True)
+@click.option(
+    "--count_mode",
+    type=click.Choice(["total", "dedup"]),
+    default="total",
+    show_default=True,
+)
+@click.option(
+    "--aln_cache_dir",
+    type=click.Path(file_okay=False, resolve_path=True, path_type=Path),
+)
+@click.option("--aln_cache_size", type=float, default=10, show_default=True)
+@click.option("--fused_report", type=bool, default=True, show_default=True)
+@click.option("--coverage", type=bool, default=False, show_default=True)
+@click.option("--adaptive", type=bool, default=False, show_default=True)
+@click.option("--adaptive_start_n", type=int, default=100000, show_default=True)
+@click.option("--adaptive_top_n", type=int, default=10, show_default=True)
+@click.option("--adaptive_tolerance", type=float, default=0.05, show_default=True)
+@click.option(
+    "--profiling", help="cprofile and/or tracemalloc, e.g. cprofile,tracemalloc"
+)
+def cli(reads, out_dir, workers, limit, resume, profiling, **params):
+    fastqs = []
+    for pattern in reads:
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            raise click.BadParameter(f"No reads match {pattern}", param_hint="--reads")
+        fastqs.extend(Path(match) for match in matches)
+    limits = {}
+    for item in limit:
+        stage, _, n = item.partition("=")
+        if not n.isdigit() or int(n) < 1:
+            raise click.BadParameter(f"Invalid limit {item}", param_hint="--limit")
+        limits[stage] = int(n)
+    if profiling:
+        # read by instrument in this process and in the workers
+        os.environ[PROFILE_ENV] = profiling
+
+    pipeline_params = dict(DEFAULT_PARAMS)
+    pipeline_params.update(params)
+    executor = LocalExecutor(
+        out_dir,
+        workers=workers,
+        limits=limits,
+        resume=resume,
+        cpus=pipeline_params["threads"],
+    )
+    build_pipeline(executor, fastqs, pipeline_params, out_dir)
+    status = executor.run()
+    for name in status.get("skipped", []):
+        click.echo(f"[skipped] {name}")
+    click.echo(
+        ", ".join(f"{len(names)} {state}" for state, names in sorted(status.items()))
+    )
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+import os
+import json
+import time
+from pathlib import Path
+
+# set by the job runner to a file shared by all stages of a run
+PROGRESS_ENV = "REICH_PROGRESS_FILE"
+
+
+def progress_file():
+    """
+    return: progress file of the current run, None outside a job -> Path
+    """
+    path = os.environ.get(PROGRESS_ENV)
+    return Path(path) if path else None
+
+
+def emit(stage, event, path=None, **fields):
+    """
+    Append one progress event as a JSON line.
+    Lines are short and written with O_APPEND, so concurrent stages of a run
+    can share one file. Does nothing when no progress file is set.
+    stage: pipeline stage, e.g. "alignment" -> str
+    event: "start", "progress", "end", "failed" or a job state -> str
+    path: progress file, default from REICH_PROGRESS_FILE -> Path
+    return: event, None if not written -> dict
+    """
+    path = progress_file() if path is None else Path(path)
+    if path is None:
+        return None
+    record = {"time": round(time.time(), 3), "stage": stage, "event": event}
+    record.update(fields)
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (json.dumps(record, default=str) + "\n").encode())
+    finally:
+        os.close(fd)
+    return record
+
+
+class track_stage:
+    """
+    Context manager emitting start, throttled progress and end (or failed)
+    events of a stage, with the elapsed time and number of items processed.
+    path is the progress file, default from REICH_PROGRESS_FILE.
+
+        with track_stage("assignment", sample_id="S1", total=len(hits)) as progress:
+            for hit in hits:
+                ...
+                progress.update()
+    """
+
+    def __init__(
+        self, stage, sample_id=None, total=None, interval=1.0, path=None, **fields
+    ):
+        self.stage = stage
+        self.sample_id = sample_id
+        self.total = total
+        self.interval = interval
+        self.processed = 0
+        self.fields = fields
+        self.path = progress_file() if path is None else Path(path)
+        self.enabled = self.path is not None
+
+    def _emit(self, event, **fields):
+        if not self.enabled:
+            return None
+        if self.sample_id is not None:
+            fields["sample_id"] = self.sample_id
+        fields["processed"] = self.processed
+        if self.total:
+            fields["total"] = self.total
+            fields["fraction"] = round(min(self.processed / self.total, 1.0), 4)
+        fields["elapsed"] = round(time.time() - self.start, 3)
+        return emit(self.stage, event, path=self.path, **self.fields, **fields)
+
+    def __enter__(self):
+        self.start = time.time()
+        self.last = self.start
+        self._emit("start")
+        return self
+
+    def update(self, n=1, **fields):
+        """
+        n: items processed since the last call -> int
+        fields: extra values kept for the following events -> dict
+        """
+        self.processed += n
+        self.fields.update(fields)
+        if not self.enabled:
+            return
+        now = time.time()
+        if now - self.last >= self.interval:
+            self.last = now
+            elapsed = now - self.start
+            self._emit("progress", rate=round(self.processed / elapsed, 1))
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self._emit("end")
+        else:
+            self._emit("failed", error=str(exc))
+        return False
+
+
+def read_events(path, offset=0):
+    """
+    Read complete progress lines written after offset
+    path: progress file -> Path
+    offset: byte offset to start from -> int
+    return: [(offset after the line, event)], new offset -> tuple
+    """
+    path = Path(path)
+    if not path.is_file():
+        return [], offset
+    events = []
+    with open(path, "rb") as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            offset += len(line)
+            try:
+                events.append((offset, json.loads(line)))
+            except ValueError:
+                continue
+    return events, offset
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+import numpy as np
+from array import array
+from pathlib import Path
+
+from modules.common import open_gz
+
+# accessions per chunk of RefLengthBuilder
+ACC_CHUNK = 1 << 20
+
+
+class RefLengthIndex:
+    """
+    Sequence length per accession and total length / sequence count per taxid,
+    stored as sorted .npy arrays that are memory-mapped on load.
+    """
+
+    def __init__(self, index_dir, mmap_mode="r"):
+        index_dir = Path(index_dir)
+        self.accs = np.load(index_dir / "acc.npy", mmap_mode=mmap_mode)
+        self.acc_lens = np.load(index_dir / "acc_len.npy", mmap_mode=mmap_mode)
+        self.taxids = np.load(index_dir / "taxid.npy", mmap_mode=mmap_mode)
+        self.taxid_lens = np.load(index_dir / "taxid_len.npy", mmap_mode=mmap_mode)
+        self.taxid_ns = np.load(index_dir / "taxid_n.npy", mmap_mode=mmap_mode)
+
+    @staticmethod
+    def exists(index_dir):
+        return (Path(index_dir) / "taxid_n.npy").is_file()
+
+    @staticmethod
+    def _lookup(keys, values, queries):
+        result = np.zeros(len(queries), dtype=np.int64)
+        if len(keys) == 0:
+            return result
+        idx = np.minimum(np.searchsorted(keys, queries), len(keys) - 1)
+        found = keys[idx] == queries
+        result[found] = values[idx[found]]
+        return result
+
+    def acc_length(self, accs):
+        """
+        accs: accessions -> list
+        return: sequence length, 0 if unknown -> np.ndarray
+        """
+        accs = [acc.encode() for acc in accs]
+        result = self._lookup(
+            self.accs, self.acc_lens, np.array(accs, dtype=self.accs.dtype)
+        )
+        # the cast truncates to the width of the index, so a longer accession
+        # could match its own prefix
+        too_long = np.fromiter(map(len, accs), dtype=np.int64, count=len(accs))
+        result[too_long > self.accs.dtype.itemsize] = 0
+        return result
+
+    def taxid_length(self, taxids):
+        """
+        taxids: taxids -> list
+        return: (total sequence length, sequence count), 0 if unknown -> tuple
+        """
+        queries = np.asarray([int(taxid) for taxid in taxids], dtype=np.int64)
+        return (
+            self._lookup(self.taxids, self.taxid_lens, queries),
+            self._lookup(self.taxids, self.taxid_ns, queries),
+        )
+
+
+class RefLengthBuilder:
+    """
+    Collect (accession, taxid, length) while a fasta is written or read,
+    then save a RefLengthIndex.
+    Accessions are kept in fixed-width chunks that are widened as longer
+    accessions come in, not as one python object each.
+    """
+
+    def __init__(self, chunk_size=ACC_CHUNK):
+        self.chunk_size = chunk_size
+        self.acc_chunks = []
+        self.acc_chunk = np.zeros(0, dtype="S1")
+        self.acc_n = 0
+        self.taxids = array("q")
+        self.lens = array("q")
+
+    def add(self, acc, taxid, length):
+        acc = acc.encode()
+        if self.acc_n == len(self.acc_chunk):
+            self._flush()
+            self.acc_chunk = np.zeros(self.chunk_size, dtype=self.acc_chunk.dtype)
+        if len(acc) > self.acc_chunk.dtype.itemsize:
+            self.acc_chunk = self.acc_chunk.astype(f"S{len(acc)}")
+        self.acc_chunk[self.acc_n] = acc
+        self.acc_n += 1
+        self.taxids.append(int(taxid))
+        self.lens.append(int(length))
+
+    def _flush(self):
+        if self.acc_n:
+            self.acc_chunks.append(self.acc_chunk[: self.acc_n])
+        self.acc_chunk = self.acc_chunk[:0]
+        self.acc_n = 0
+
+    def save(self, index_dir):
+        """
+        index_dir: output directory -> Path
+        return: index directory -> Path
+        """
+        index_dir = Path(index_dir)
+        index_dir.mkdir(parents=True, exist_ok=True)
+        self._flush()
+        # concatenate widens every chunk to the longest accession
+        accs = np.concatenate(self.acc_chunks) if self.acc_chunks else np.zeros(0, "S1")
+        self.acc_chunks = []
+        taxids = np.frombuffer(self.taxids, dtype=np.int64)
+        lens = np.frombuffer(self.lens, dtype=np.int64)
+
+        order = np.argsort(accs, kind="stable")
+        np.save(index_dir / "acc.npy", accs[order])
+        np.save(index_dir / "acc_len.npy", lens[order])
+
+        uniq_taxids, inverse = np.unique(taxids, return_inverse=True)
+        np.save(index_dir / "taxid.npy", uniq_taxids)
+        np.save(
+            index_dir / "taxid_len.npy",
+            np.bincount(inverse, weights=lens, minlength=len(uniq_taxids)).astype(
+                np.int64
+            ),
+        )
+        # written last, RefLengthIndex.exists checks for it
+        np.save(
+            index_dir / "taxid_n.npy",
+            np.bincount(inverse, minlength=len(uniq_taxids)).astype(np.int64),
+        )
+        return index_dir
+
+
+def build_length_index(fasta, index_dir):
+    """
+    Build a RefLengthIndex from a fasta with >{accession}|{taxid} headers in one
+    streaming pass
+    fasta: path to (gzipped) fasta -> Path
+    index_dir: output directory -> Path
+    return: index directory -> Path
+    """
+    builder = RefLengthBuilder()
+    name = None
+    length = 0
+    with open_gz(fasta) as f:
+        for line in f:
+            if line.startswith(">"):
+                if name is not None:
+                    builder.add(*name.split("|")[:2], length)
+                name = line[1:].split()[0]
+                length = 0
+            else:
+                length += len(line.rstrip("\n"))
+    if name is not None:
+        builder.add(*name.split("|")[:2], length)
+    return builder.save(index_dir)
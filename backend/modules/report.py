@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+import os
+import json
+import time
+import pandas as pd
+from pathlib import Path
+
+from modules.taxonparse import assign_taxon, get_lineage
+from modules.abundance import get_rank_rpm, add_length_normalization
+from modules.reflen import RefLengthIndex
+from modules.background import BackgroundModel
+from modules.progress import track_stage
+
+REPORT_COLS = ["Taxon", "Score", "Z score", "rPM", "r", "%id", "L"]
+
+
+class SpeciesAccumulator:
+    """
+    Running per-taxon read counts and sums of pident and alignment length.
+    Hits are added one at a time, so no per-species lists are kept.
+    """
+
+    def __init__(self, rank="species", count_mode="total"):
+        if count_mode not in ("total", "dedup"):
+            raise ValueError(f"Unknown count mode: {count_mode}")
+        self.rank = rank
+        self.count_mode = count_mode
+        self.total_n = 0
+        self.taxid2stats = {}
+
+    def add(self, hit, taxon):
+        """
+        hit: alignment record from hit json -> dict
+        taxon: {"taxid": ..., "lineage": ...} of the read -> dict
+        """
+        lineage = taxon.get("lineage")
+        if not lineage or not lineage.get(self.rank):
+            return
+        count = hit.get("count", 1)
+        n = count if self.count_mode == "total" else 1
+        self.total_n += n
+        taxid = lineage[self.rank]["taxid"]
+        stats = self.taxid2stats.get(taxid)
+        if stats is None:
+            stats = self.taxid2stats[taxid] = {
+                "hit_n": 0,
+                "read_n": 0,
+                "pident_sum": 0.0,
+                "alnlen_sum": 0,
+                "taxon": taxon,
+            }
+        stats["hit_n"] += n
+        stats["read_n"] += count
+        stats["pident_sum"] += hit["pident"] * count
+        stats["alnlen_sum"] += hit["alnlen"] * count
+
+    def get_rpm(self):
+        """
+        return: taxid -> {"rpm", "hit_n", "taxon"}, same as abundance.get_rpm -> dict
+        """
+        taxid2rpm = {
+            taxid: {
+                "rpm": stats["hit_n"] / self.total_n * (10**6),
+                "hit_n": stats["hit_n"],
+                "taxon": stats["taxon"],
+            }
+            for taxid, stats in self.taxid2stats.items()
+        }
+        return dict(sorted(taxid2rpm.items(), key=lambda x: x[1]["rpm"], reverse=True))
+
+
+def make_report(taxid2rpm, accumulator, background=None):
+    """
+    Build the summary report table
+    taxid2rpm: output of get_rpm -> dict
+    accumulator: per-species hit statistics -> SpeciesAccumulator
+    background: path to background model, or the loaded model -> Path
+    return: report -> pd.DataFrame
+    """
+    rows = []
+    for taxid, values in taxid2rpm.items():
+        stats = accumulator.taxid2stats[taxid]
+        rows.append(
+            [
+                values["taxon"]["lineage"][accumulator.rank]["name"],
+                "-",
+                "-",
+                values["rpm"],
+                values["hit_n"],
+                round(stats["pident_sum"] / stats["read_n"] * 100, 2),
+                round(stats["alnlen_sum"] / stats["read_n"], 2),
+            ]
+        )
+    if background is not None and rows:
+        if not isinstance(background, BackgroundModel):
+            background = BackgroundModel.load(background)
+        zscores = background.zscores(list(taxid2rpm.keys()), [row[3] for row in rows])
+        for row, zscore in zip(rows, zscores):
+            row[2] = round(float(zscore), 2)
+    report_df = pd.DataFrame(rows, columns=REPORT_COLS)
+    if any("rpkm" in values for values in taxid2rpm.values()):
+        report_df["RPKM"] = [values.get("rpkm") for values in taxid2rpm.values()]
+        report_df["TPM"] = [values.get("tpm") for values in taxid2rpm.values()]
+    return report_df
+
+
+def species_report(hits, taxonomy, taxid2rpm, background=None):
+    """
+    Summary report of a sample from its hits, taxonomy and abundance
+    hits: records of {sample_id}.hit.json -> list
+    taxonomy: normalized taxonomy, see taxonparse.normalize_taxonomy -> dict
+    taxid2rpm: species abundance, see abundance.get_rpm -> dict
+    background: path to background model, or the loaded model -> Path
+    return: report table -> pd.DataFrame
+    """
+    read2hit = {hit["qname"]: hit for hit in hits}
+    read2taxid = dict(zip(taxonomy["reads"]["qname"], taxonomy["reads"]["taxid"]))
+    accumulator = SpeciesAccumulator()
+    for read_id, hit in read2hit.items():
+        taxid = read2taxid[read_id]
+        accumulator.add(
+            hit, {"taxid": taxid, "lineage": taxonomy["lineages"].get(taxid)}
+        )
+    return make_report(taxid2rpm, accumulator, background=background)
+
+
+def assign_and_report(
+    hit_json,
+    taxdump_dir,
+    out_dir,
+    count_mode="total",
+    background=None,
+    length_index=None,
+    taxid2lineage=None,
+):
+    """
+    Assign taxa, calculate abundance and write the report in one pass over the hits
+    hit_json: path to {sample_id}.hit.json -> Path
+    taxdump_dir: path to taxdump directory -> Path
+    out_dir: output directory, taxon/, rpm/ and report/ are created inside -> Path
+    count_mode: "total" or "dedup", see abundance.get_rpm -> str
+    background: path to background model -> Path
+    length_index: reference length index directory, adds RPKM and TPM -> Path
+    taxid2lineage: lineages already resolved by get_lineage -> dict
+    return: paths of the outputs -> dict
+    """
+    out_dir = Path(out_dir)
+    sample_id = hit_json.name.split(".")[0]
+    hits = json.loads(hit_json.read_text())
+
+    accumulator = SpeciesAccumulator(count_mode=count_mode)
+    qname2hit = {hit["qname"]: hit for hit in hits}
+    with track_stage(
+        "assignment", sample_id=sample_id, total=len(qname2hit)
+    ) as progress:
+        taxonomy = assign_taxon(
+            hit_json, taxdump_dir, taxid2lineage=taxid2lineage, hits=hits
+        )
+        for qname, taxid in zip(taxonomy["reads"]["qname"], taxonomy["reads"]["taxid"]):
+            accumulator.add(
+                qname2hit[qname],
+                {"taxid": taxid, "lineage": taxonomy["lineages"].get(taxid)},
+            )
+            progress.update()
+
+    outputs = {}
+    for sub_dir in ("taxon", "rpm", "report"):
+        (out_dir / sub_dir).mkdir(parents=True, exist_ok=True)
+    outputs["taxon_json"] = out_dir / "taxon" / f"{sample_id}.taxonomy.json"
+    outputs["taxon_json"].write_text(json.dumps(taxonomy))
+
+    taxid2rpm = accumulator.get_rpm()
+    if length_index is not None:
+        add_length_normalization(taxid2rpm, taxonomy, RefLengthIndex(length_index))
+    outputs["rpm_json"] = out_dir / "rpm" / f"{sample_id}.rpm.json"
+    outputs["rpm_json"].write_text(json.dumps(taxid2rpm, indent=2))
+    outputs["rank_tsv"] = out_dir / "rpm" / f"{sample_id}.rank_rpm.tsv"
+    get_rank_rpm(taxonomy, count_mode=count_mode).to_csv(
+        outputs["rank_tsv"], sep="\t", index=False
+    )
+
+    outputs["report_tsv"] = out_dir / "report" / f"{sample_id}.report.tsv"
+    make_report(taxid2rpm, accumulator, background=background).to_csv(
+        outputs["report_tsv"], sep="\t", index=False
+    )
+    return outputs
+
+
+def _write_atomic(path, text):
+    tmp = path.with_name(f".{path.name}.tmp")
+    tmp.write_text(text)
+    os.replace(tmp, path)
+
+
+class IncrementalReport:
+    """
+    Provisional rpm and report snapshots while alignments are still streaming in.
+    Reads are added as minimap2 reports them, lineages are resolved in batches
+    and every snapshot is written with the fraction of reads processed so far.
+    """
+
+    def __init__(
+        self,
+        taxdump_dir,
+        out_dir,
+        total_n,
+        count_mode="total",
+        background=None,
+        interval=60,
+    ):
+        self.taxdump_dir = taxdump_dir
+        self.out_dir = Path(out_dir)
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        self.total_n = total_n
+        self.count_mode = count_mode
+        self.background = background
+        self.interval = interval
+        self.read_n = 0
+        self.taxid2lineage = {}
+        self.sample2acc = {}
+        self.pending = []
+        self.start = time.time()
+        self.last_snapshot = self.start
+
+    def add(self, sample_id, hit=None):
+        """
+        Count a processed read and, if it has a hit, queue it for assignment
+        sample_id: sample of the read -> str
+        hit: hit of the read kept by assign_and_report, None if unmapped -> dict
+        """
+        self.read_n += 1
+        self.sample2acc.setdefault(
+            sample_id, SpeciesAccumulator(count_mode=self.count_mode)
+        )
+        if hit is not None:
+            self.pending.append((sample_id, hit))
+        if time.time() - self.last_snapshot >= self.interval:
+            self.snapshot()
+
+    def _flush(self):
+        taxids = set(hit["tname"].split("|")[1] for _, hit in self.pending)
+        taxids -= self.taxid2lineage.keys()
+        if taxids:
+            self.taxid2lineage.update(get_lineage(taxids, self.taxdump_dir))
+        for sample_id, hit in self.pending:
+            taxid = hit["tname"].split("|")[1]
+            self.sample2acc[sample_id].add(
+                hit, {"taxid": taxid, "lineage": self.taxid2lineage.get(taxid)}
+            )
+        self.pending = []
+
+    def snapshot(self, final=False):
+        """
+        Write {sample_id}.rpm.json, {sample_id}.report.tsv and
+        {sample_id}.progress.json to out_dir
+        final: all reads have been processed -> bool
+        """
+        self._flush()
+        fraction = 1.0 if final else min(self.read_n / max(self.total_n, 1), 1.0)
+        progress = {
+            "reads_processed": self.read_n,
+            "reads_total": self.total_n,
+            "fraction": round(fraction, 4),
+            "elapsed": round(time.time() - self.start, 1),
+            "final": final,
+        }
+        for sample_id, accumulator in self.sample2acc.items():
+            taxid2rpm = accumulator.get_rpm()
+            _write_atomic(
+                self.out_dir / f"{sample_id}.rpm.json",
+                json.dumps(taxid2rpm, indent=2),
+            )
+            report_df = make_report(taxid2rpm, accumulator, background=self.background)
+            _write_atomic(
+                self.out_dir / f"{sample_id}.report.tsv",
+                report_df.to_csv(sep="\t", index=False),
+            )
+            _write_atomic(
+                self.out_dir / f"{sample_id}.progress.json",
+                json.dumps(dict(progress, hit_n=accumulator.total_n), indent=2),
+            )
+        print(
+            f"snapshot: {self.read_n} of {self.total_n} reads ({fraction:.1%})",
+            flush=True,
+        )
+        self.last_snapshot = time.time()
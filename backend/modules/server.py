@@ -1,12 +1,101 @@
 #!/usr/bin/env python3
 from pathlib import Path
+import json
+import time
+import hashlib
+import threading
 import subprocess
-from flask import Flask, request, jsonify
+from collections import OrderedDict
+from flask import Flask, request, jsonify, Response
 
-from modules.common import read_config
+from modules.common import read_config, PROJECT_ROOT
+from modules.fasta_index import FastaIndex
+from modules.jobs import JobStore, JobRunner, JOB_STATES, get_job_config
+from modules.warehouse import Warehouse
+from modules.progress import read_events
+from modules.validate import save_stream
+from modules.taxon_index import INDEX_NAME, TaxonIndex
+from werkzeug.utils import secure_filename
 
 API_PORT = read_config()["api_port"]
 app = Flask(__name__)
+_fasta_index = {}
+_taxon_index = {}
+_job_runner = {}
+_warehouse = {}
+
+
+class ResponseCache:
+    """
+    LRU cache of serialized responses keyed by the request and data version
+    """
+
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.items:
+                return None
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+
+_results_cache = ResponseCache()
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+
+def get_upload_dir():
+    upload_dir = Path(
+        read_config().get("upload_dir") or PROJECT_ROOT / "jobs" / "uploads"
+    )
+    upload_dir.mkdir(parents=True, exist_ok=True)
+    return upload_dir
+
+
+def get_warehouse():
+    if "warehouse" not in _warehouse:
+        db_path = read_config().get("warehouse_db") or (
+            PROJECT_ROOT / "jobs" / "warehouse.sqlite"
+        )
+        _warehouse["warehouse"] = Warehouse(db_path)
+    return _warehouse["warehouse"]
+
+
+def ingest_job(job):
+    get_warehouse().ingest(
+        job["out_dir"],
+        run_id=job["job_id"],
+        project_id=job["project_id"],
+        date=job["finished"],
+    )
+
+
+def get_job_runner():
+    if "runner" not in _job_runner:
+        job_config = get_job_config()
+        store = JobStore(Path(job_config["job_dir"]) / "jobs.sqlite")
+        _job_runner["runner"] = JobRunner(store, job_config, on_success=ingest_job)
+    return _job_runner["runner"]
+
+
+def start_job_runner():
+    """
+    Start the job scheduler thread, once per server process
+    """
+    runner = get_job_runner()
+    if runner.thread is None:
+        runner.run_in_thread()
+    return runner
 
 
 @app.route("/version", methods=["GET"])
@@ -14,7 +103,225 @@ def version():
     return jsonify(read_config()["version"])
 
 
-@app.route("/run", methods=["GET"])
+@app.route("/run", methods=["GET", "POST"])
 def run():
-    project_id = request.args.get("project_id")
-    return jsonify({"project_id": project_id})
+    """
+    Queue a pipeline run and return at once. Nextflow params are passed as a
+    JSON object under "params"; cpus and memory_gb default to the jobs section
+    of config.yml.
+    """
+    body = request.get_json(silent=True) or {}
+    project_id = body.get("project_id", request.args.get("project_id"))
+    params = body.get("params", {})
+    if "reads" in request.args:
+        params.setdefault("reads", request.args["reads"])
+    if not project_id or not params.get("reads"):
+        return jsonify({"error": "project_id and params.reads are required"}), 400
+    if not all(key.isidentifier() for key in params):
+        return jsonify({"error": "params must be nextflow parameter names"}), 400
+    runner = get_job_runner()
+    try:
+        cpus = int(body.get("cpus", runner.config["job_cpus"]))
+        memory_gb = float(body.get("memory_gb", runner.config["job_memory_gb"]))
+        runner.check_request(cpus, memory_gb)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    job = runner.store.add(
+        project_id, params, cpus, memory_gb, runner.config["job_dir"]
+    )
+    return jsonify(job), 202
+
+
+@app.route("/jobs", methods=["GET"])
+def list_jobs():
+    status = request.args.get("status")
+    if status and status not in JOB_STATES:
+        return jsonify({"error": f"unknown status {status}"}), 400
+    jobs = get_job_runner().store.list(
+        status=status,
+        project_id=request.args.get("project_id"),
+        limit=request.args.get("limit", 100, type=int),
+    )
+    return jsonify(jobs)
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    job = get_job_runner().store.get(job_id)
+    if job is None:
+        return jsonify({"error": f"job {job_id} not found"}), 404
+    return jsonify(job)
+
+
+@app.route("/jobs/<job_id>/cancel", methods=["POST"])
+def cancel_job(job_id):
+    job = get_job_runner().cancel(job_id)
+    if job is None:
+        return jsonify({"error": f"job {job_id} not found"}), 404
+    return jsonify(job)
+
+
+@app.route("/jobs/<job_id>/events", methods=["GET"])
+def job_events(job_id):
+    """
+    Server-sent events of a run: job state changes and the start, progress
+    and end of pipeline stages. The event id is a byte offset into the
+    progress file, so reconnecting clients resume with Last-Event-ID.
+    """
+    runner = get_job_runner()
+    job = runner.store.get(job_id)
+    if job is None:
+        return jsonify({"error": f"job {job_id} not found"}), 404
+    path = runner.progress_file(job)
+    offset = request.headers.get("Last-Event-ID", 0, type=int)
+
+    def stream(offset):
+        yield "retry: 3000\n\n"
+        last_send = time.time()
+        while True:
+            # read the job state first so that its last events are not missed
+            status = runner.store.get(job_id)["status"]
+            events, offset = read_events(path, offset)
+            for event_offset, event in events:
+                yield (
+                    f"id: {event_offset}\nevent: {event['stage']}\n"
+                    f"data: {json.dumps(event)}\n\n"
+                )
+                last_send = time.time()
+            if status not in ("queued", "running"):
+                yield f"event: done\ndata: {json.dumps({'status': status})}\n\n"
+                return
+            if time.time() - last_send >= 15:
+                yield ": keepalive\n\n"
+                last_send = time.time()
+            time.sleep(0.5)
+
+    return Response(
+        stream(offset),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.route("/jobs/<job_id>/progress", methods=["GET"])
+def job_progress(job_id):
+    progress = get_job_runner().progress(job_id)
+    if progress is None:
+        return jsonify({"error": f"job {job_id} not found"}), 404
+    return jsonify(progress)
+
+
+def get_fasta_index():
+    fasta = read_config().get("reference_fasta")
+    if not fasta:
+        return None
+    if fasta not in _fasta_index:
+        _fasta_index[fasta] = FastaIndex(fasta)
+    return _fasta_index[fasta]
+
+
+@app.route("/reference/<accession>", methods=["GET"])
+def reference(accession):
+    fasta_index = get_fasta_index()
+    if fasta_index is None:
+        return jsonify({"error": "reference_fasta is not configured"}), 404
+    start = request.args.get("start", 0, type=int)
+    end = request.args.get("end", None, type=int)
+    try:
+        seq = fasta_index.fetch(accession, start, end)
+    except KeyError:
+        return jsonify({"error": f"{accession} not found"}), 404
+    record = fasta_index.get(accession)
+    return jsonify(
+        {
+            "accession": accession,
+            "length": int(record["length"]),
+            "start": start,
+            "end": start + len(seq),
+            "seq": seq,
+        }
+    )
+
+
+def get_taxon_index():
+    taxdump_dir = read_config().get("taxdump_dir")
+    if not taxdump_dir:
+        return None
+    if taxdump_dir not in _taxon_index:
+        _taxon_index[taxdump_dir] = TaxonIndex(Path(taxdump_dir) / INDEX_NAME)
+    return _taxon_index[taxdump_dir]
+
+
+@app.route("/taxonomy/search", methods=["GET"])
+def taxonomy_search():
+    taxon_index = get_taxon_index()
+    if taxon_index is None:
+        return jsonify({"error": "taxdump_dir is not configured"}), 404
+    query = request.args.get("q", "")
+    limit = min(request.args.get("limit", 10, type=int), 100)
+    return jsonify({"query": query, "matches": taxon_index.search(query, limit)})
+
+
+@app.route("/taxonomy/<int:taxid>", methods=["GET"])
+def taxonomy_lineage(taxid):
+    taxon_index = get_taxon_index()
+    if taxon_index is None:
+        return jsonify({"error": "taxdump_dir is not configured"}), 404
+    taxon = taxon_index.taxon(taxid)
+    if taxon is None:
+        return jsonify({"error": f"taxid {taxid} not found"}), 404
+    taxon["lineage"] = taxon_index.lineage(taxid)
+    return jsonify(taxon)
+
+
+@app.route("/results", methods=["GET"])
+def results():
+    """
+    Query ingested abundance rows, e.g.
+    /results?rank=species&name=coli&min_rpm=10&since=2024-01-01&sort=rpm&page=2
+    """
+    warehouse = get_warehouse()
+    args = dict(sorted(request.args.items()))
+    etag = hashlib.md5(f"{warehouse.version}\t{json.dumps(args)}".encode()).hexdigest()
+    if etag in request.if_none_match:
+        return Response(status=304, headers={"ETag": f'"{etag}"'})
+    body = _results_cache.get(etag)
+    if body is None:
+        try:
+            body = json.dumps(warehouse.query(**args))
+        except (TypeError, ValueError) as e:
+            return jsonify({"error": str(e)}), 400
+        _results_cache.put(etag, body)
+    return Response(
+        body,
+        mimetype="application/json",
+        headers={"ETag": f'"{etag}"', "Cache-Control": "no-cache"},
+    )
+
+
+@app.route("/upload/<filename>", methods=["PUT", "POST"])
+def upload(filename):
+    """
+    Stream a (gzip, BGZF or zstd compressed) FASTQ to the upload directory.
+    The body is validated while it is written, and the upload is rejected at
+    the first malformed record. The returned path can be used as params.reads.
+    """
+    filename = secure_filename(filename)
+    if not filename:
+        return jsonify({"error": "invalid file name"}), 400
+    out_file = get_upload_dir() / filename
+    if out_file.exists() and request.args.get("overwrite") != "true":
+        return jsonify({"error": f"{filename} already exists"}), 409
+
+    def chunks():
+        while True:
+            chunk = request.stream.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+    try:
+        stats = save_stream(chunks(), out_file)
+    except ValueError as e:
+        return jsonify({"error": f"{filename}: {e}"}), 400
+    return jsonify({"path": str(out_file), "stats": stats}), 201
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+import subprocess
+from pathlib import Path
+
+from modules.common import open_gz
+
+
+def count_reads(fastq):
+    """
+    Count reads in a fastq file
+    fastq: path to fastq file -> Path
+    return: number of reads -> int
+    """
+    with open_gz(fastq) as f:
+        return sum(1 for _ in f) // 4
+
+
+def seqtk_sample(reads, subsample_n, out_fq, seed=11, sample_id=None):
+    """
+    Randomly sample reads with seqtk
+    Mates of paired files are kept in sync by sampling them with the same seed.
+    reads: path to fastq file -> Path
+    subsample_n: number (or fraction if < 1) of reads to keep -> int or float
+    out_fq: path to output fastq -> Path
+    seed: random seed -> int
+    sample_id: rename reads to {sample_id}.{i} if given -> str
+    return: path to output fastq -> Path
+    """
+    cmd = ["seqtk", "sample", "-s", str(seed), str(reads), str(subsample_n)]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    i = 0
+    line_n = 0
+    with open(out_fq, "w") as f:
+        for line in proc.stdout:
+            line = line.decode("utf-8")
+            line_n += 1
+            if sample_id is not None and line_n % 4 == 1:
+                i += 1
+                line = f"@{sample_id}.{i}\n"
+            f.write(line)
+    if proc.wait():
+        raise Exception("Failed to run seqtk\nCMD: " + " ".join(cmd))
+    return Path(out_fq)
+
+
+def subsample_reads(reads, subsample_n, out_dir):
+    """
+    Subsample reads and rename them to {sample_id}.{i}
+    reads: path to fastq file -> Path
+    subsample_n: number of reads to keep -> int
+    out_dir: path to output directory -> Path
+    return: path to subsampled fastq -> Path
+    """
+    sample_id = reads.name.split(".")[0]
+    print(f"sample id: {sample_id}")
+    return seqtk_sample(
+        reads,
+        subsample_n,
+        out_dir / f"{sample_id}.subsampled.fq",
+        sample_id=sample_id,
+    )
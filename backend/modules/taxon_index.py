@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+import re
+import json
+import mmap
+import click
+import numpy as np
+from bisect import bisect_left, bisect_right
+from pathlib import Path
+
+from modules.common import CONTEXT_SETTINGS
+
+INDEX_NAME = "taxon_index"
+# name classes of names.dmp that are searchable, in order of preference
+NAME_CLASSES = (
+    "scientific name",
+    "synonym",
+    "equivalent name",
+    "genbank common name",
+    "common name",
+)
+# words of a name start after these characters, e.g. "coli" in "Escherichia coli"
+WORD_RE = re.compile(rb"[^\s\-_.,;:()\[\]/'\"]+")
+# candidates looked at per requested match, bounds the time of short queries
+SCAN_FACTOR = 50
+
+
+def read_dmp(dmp):
+    """
+    dmp: path to a taxdump .dmp file -> Path
+    return: fields of each row -> generator
+    """
+    with open(dmp, encoding="utf-8") as f:
+        for line in f:
+            yield line.rstrip("\n").rstrip("\t|").split("\t|\t")
+
+
+def _write_blob(path, items):
+    """
+    Write newline-terminated items and return their start offsets
+    """
+    offsets = np.zeros(len(items) + 1, dtype=np.int64)
+    with open(path, "wb") as f:
+        for i, item in enumerate(items):
+            f.write(item + b"\n")
+            offsets[i + 1] = offsets[i] + len(item) + 1
+    return offsets
+
+
+def build_taxon_index(taxdump_dir, index_dir=None):
+    """
+    Build the name search and lineage index of a taxdump.
+    Nodes are stored as dense arrays indexed by taxid; names as a newline
+    separated blob with a sorted array of the start of every word (a word
+    suffix array), so prefix searches of any word are two binary searches.
+    taxdump_dir: directory with nodes.dmp, names.dmp and merged.dmp -> Path
+    index_dir: output directory, default taxdump_dir/taxon_index -> Path
+    return: index directory -> Path
+    """
+    taxdump_dir = Path(taxdump_dir)
+    index_dir = taxdump_dir / INDEX_NAME if index_dir is None else Path(index_dir)
+    index_dir.mkdir(parents=True, exist_ok=True)
+
+    nodes = [
+        (int(row[0]), int(row[1]), row[2])
+        for row in read_dmp(taxdump_dir / "nodes.dmp")
+    ]
+    merged = []
+    if (taxdump_dir / "merged.dmp").is_file():
+        merged = sorted(
+            (int(row[0]), int(row[1])) for row in read_dmp(taxdump_dir / "merged.dmp")
+        )
+    ranks = sorted(set(rank for _, _, rank in nodes))
+    rank2code = {rank: code for code, rank in enumerate(ranks)}
+    size = max(taxid for taxid, _, _ in nodes) + 1
+    parent = np.full(size, -1, dtype=np.int32)
+    rank_codes = np.zeros(size, dtype=np.uint8)
+    for taxid, parent_taxid, rank in nodes:
+        parent[taxid] = parent_taxid
+        rank_codes[taxid] = rank2code[rank]
+    del nodes
+
+    class2code = {name_class: code for code, name_class in enumerate(NAME_CLASSES)}
+    names = []
+    for row in read_dmp(taxdump_dir / "names.dmp"):
+        code = class2code.get(row[3])
+        if code is not None and int(row[0]) < size:
+            names.append((row[1], int(row[0]), code))
+    sci_name = np.full(size, -1, dtype=np.int32)
+    for i, (_, taxid, code) in enumerate(names):
+        if code == 0 and sci_name[taxid] < 0:
+            sci_name[taxid] = i
+
+    keys = [name.lower().encode() for name, _, _ in names]
+    name_off = _write_blob(
+        index_dir / "names.bin", [name.encode() for name, _, _ in names]
+    )
+    key_off = _write_blob(index_dir / "keys.bin", keys)
+    suffixes = []
+    positions = []
+    suffix_names = []
+    for name_id, (key, offset) in enumerate(zip(keys, key_off)):
+        for word in WORD_RE.finditer(key):
+            suffixes.append(key[word.start() :])
+            positions.append(offset + word.start())
+            suffix_names.append(name_id)
+    order = sorted(range(len(suffixes)), key=suffixes.__getitem__)
+    del suffixes
+
+    np.save(index_dir / "parent.npy", parent)
+    np.save(index_dir / "rank.npy", rank_codes)
+    np.save(index_dir / "sci_name.npy", sci_name)
+    np.save(index_dir / "merged.npy", np.array(merged, dtype=np.int32).reshape(-1, 2))
+    np.save(index_dir / "name_taxid.npy", np.array([n[1] for n in names], np.int32))
+    np.save(index_dir / "name_class.npy", np.array([n[2] for n in names], np.uint8))
+    np.save(index_dir / "name_off.npy", name_off)
+    (index_dir / "ranks.json").write_text(json.dumps(ranks))
+    np.save(index_dir / "suffix_name.npy", np.array(suffix_names, np.int32)[order])
+    # written last, marks a complete index
+    np.save(index_dir / "suffix.npy", np.array(positions, dtype=np.int64)[order])
+    return index_dir
+
+
+def _load(path):
+    # plain ndarray view of the memory map, indexing a np.memmap is slower
+    return np.asarray(np.load(path, mmap_mode="r"))
+
+
+class _PrefixView:
+    """
+    Sorted word suffixes truncated to the query length, for bisect
+    """
+
+    def __init__(self, keys, suffixes, width):
+        self.keys = keys
+        self.suffixes = suffixes
+        self.width = width
+
+    def __len__(self):
+        return len(self.suffixes)
+
+    def __getitem__(self, i):
+        pos = int(self.suffixes[i])
+        return self.keys[pos : pos + self.width]
+
+
+class TaxonIndex:
+    """
+    Taxon name search and lineage lookup on an index built by build_taxon_index.
+    Arrays are memory-mapped and read-only, so one instance can serve
+    concurrent requests.
+    """
+
+    def __init__(self, index_dir):
+        index_dir = Path(index_dir)
+        self.parent = _load(index_dir / "parent.npy")
+        self.rank = _load(index_dir / "rank.npy")
+        self.sci_name = _load(index_dir / "sci_name.npy")
+        self.merged = np.load(index_dir / "merged.npy")
+        self.name_taxid = _load(index_dir / "name_taxid.npy")
+        self.name_class = _load(index_dir / "name_class.npy")
+        self.name_off = _load(index_dir / "name_off.npy")
+        self.suffixes = _load(index_dir / "suffix.npy")
+        self.suffix_names = _load(index_dir / "suffix_name.npy")
+        self.ranks = json.loads((index_dir / "ranks.json").read_text())
+        self._files = []
+        self.names = self._map(index_dir / "names.bin")
+        self.keys = self._map(index_dir / "keys.bin")
+
+    @staticmethod
+    def exists(index_dir):
+        return (Path(index_dir) / "suffix.npy").is_file()
+
+    def _map(self, path):
+        f = open(path, "rb")
+        self._files.append(f)
+        if Path(path).stat().st_size == 0:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _name(self, name_id):
+        start, end = int(self.name_off[name_id]), int(self.name_off[name_id + 1])
+        return self.names[start : end - 1].decode()
+
+    def resolve(self, taxid):
+        """
+        taxid: taxid, possibly merged into another -> int
+        return: current taxid, None if unknown -> int
+        """
+        taxid = int(taxid)
+        if len(self.merged):
+            i = np.searchsorted(self.merged[:, 0], taxid)
+            if i < len(self.merged) and self.merged[i, 0] == taxid:
+                taxid = int(self.merged[i, 1])
+        if taxid < 0 or taxid >= len(self.parent) or self.parent[taxid] < 0:
+            return None
+        return taxid
+
+    def taxon(self, taxid):
+        """
+        return: {"taxid", "name", "rank"}, None if unknown -> dict
+        """
+        taxid = self.resolve(taxid)
+        if taxid is None:
+            return None
+        name_id = int(self.sci_name[taxid])
+        return {
+            "taxid": str(taxid),
+            "name": self._name(name_id) if name_id >= 0 else str(taxid),
+            "rank": self.ranks[self.rank[taxid]],
+        }
+
+    def lineage(self, taxid):
+        """
+        taxid: taxid -> int
+        return: taxa from the top of the tree down to taxid, without the root,
+            None if unknown -> list
+        """
+        taxid = self.resolve(taxid)
+        if taxid is None:
+            return None
+        lineage = []
+        while taxid != 1:
+            lineage.append(self.taxon(taxid))
+            parent = int(self.parent[taxid])
+            if parent == taxid:
+                break
+            taxid = parent
+        return lineage[::-1]
+
+    def ranked_lineage(self, taxids, ranks):
+        """
+        Same output as taxonparse.get_lineage
+        taxids: list of taxids -> list
+        ranks: ranks to keep -> tuple
+        return: {taxid: {rank: {"name", "taxid"}}}, empty for unknown taxids -> dict
+        """
+        lineage_dct = {}
+        for taxid in set(str(taxid) for taxid in taxids):
+            lineage = self.lineage(taxid) if taxid.isdigit() else None
+            lineage_dct[taxid] = {
+                taxon["rank"]: {"name": taxon["name"], "taxid": taxon["taxid"]}
+                for taxon in lineage or []
+                if taxon["rank"] in ranks
+            }
+        return lineage_dct
+
+    def search(self, query, limit=10):
+        """
+        Case-insensitive prefix search of the words of scientific names and
+        synonyms, e.g. "esch" or "coli" both find Escherichia coli
+        query: start of a name or of any word in it -> str
+        limit: maximum number of taxa returned -> int
+        return: matching taxa, shortest matches first -> list
+        """
+        query = query.strip().lower().encode()
+        if not query or limit < 1:
+            return []
+        view = _PrefixView(self.keys, self.suffixes, len(query))
+        lo = bisect_left(view, query)
+        hi = min(bisect_right(view, query, lo), lo + limit * SCAN_FACTOR)
+        matches = {}
+        for name_id in self.suffix_names[lo:hi].tolist():
+            taxid = int(self.name_taxid[name_id])
+            if taxid in matches:
+                continue
+            taxon = self.taxon(taxid)
+            taxon["matched_name"] = self._name(name_id)
+            taxon["name_class"] = NAME_CLASSES[self.name_class[name_id]]
+            matches[taxid] = taxon
+            if len(matches) == limit:
+                break
+        return list(matches.values())
+
+    def close(self):
+        for data in (self.names, self.keys):
+            if isinstance(data, mmap.mmap):
+                data.close()
+        for f in self._files:
+            f.close()
+
+
+@click.command(
+    help="Search taxa by name and show lineages", context_settings=CONTEXT_SETTINGS
+)
+@click.option(
+    "--taxdump_dir",
+    "-t",
+    help="taxdump directory",
+    type=click.Path(exists=True, file_okay=False, resolve_path=True, path_type=Path),
+    required=True,
+)
+@click.option("--build_index", help="build the index first", is_flag=True)
+@click.option("--search", "-s", help="name or start of a name", multiple=True)
+@click.option("--lineage", "-l", help="taxid", multiple=True)
+@click.option("--limit", help="maximum number of matches", default=10, type=int)
+def cli(taxdump_dir, build_index, search, lineage, limit):
+    index_dir = taxdump_dir / INDEX_NAME
+    if build_index:
+        click.echo(f"Output: {build_taxon_index(taxdump_dir, index_dir)}")
+    taxon_index = TaxonIndex(index_dir)
+    for query in search:
+        for taxon in taxon_index.search(query, limit):
+            click.echo(
+                f"{query}\t{taxon['taxid']}\t{taxon['name']}\t{taxon['rank']}\t"
+                f"{taxon['matched_name']}\t{taxon['name_class']}"
+            )
+    for taxid in lineage:
+        taxa = taxon_index.lineage(taxid) or []
+        click.echo(
+            f"{taxid}\t"
+            + ";".join(taxon["name"] for taxon in taxa)
+            + "\t"
+            + ";".join(taxon["rank"] for taxon in taxa)
+        )
@@ -1,14 +1,52 @@
 #!/usr/bin/env python3
 import json
 import subprocess
+from pathlib import Path
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+from modules.common import MAX_THREADS
+from modules.progress import track_stage
+from modules.taxon_index import INDEX_NAME, TaxonIndex
+
+RANKS = (
+    "superkingdom",
+    "kingdom",
+    "phylum",
+    "class",
+    "order",
+    "family",
+    "genus",
+    "species",
+)
+
+
+_taxon_indexes = {}
+
+
+def get_taxon_index(taxdump_dir):
+    """
+    taxdump_dir: path to taxdump directory -> Path
+    return: taxon index of the taxdump, None if it has not been built -> TaxonIndex
+    """
+    index_dir = Path(taxdump_dir) / INDEX_NAME
+    if index_dir not in _taxon_indexes:
+        _taxon_indexes[index_dir] = (
+            TaxonIndex(index_dir) if TaxonIndex.exists(index_dir) else None
+        )
+    return _taxon_indexes[index_dir]
 
 
 def get_lineage(taxids, taxdump_dir):
     """
-    convert taxid to lineage with taxonkit
+    convert taxid to lineage with the taxon index of the taxdump if it has been
+    built (see modules.taxon_index), with taxonkit otherwise
     taxids: list of taxids -> list
     taxdump_dir: path to taxdump directory -> Path
     """
+    taxon_index = get_taxon_index(taxdump_dir)
+    if taxon_index is not None:
+        return taxon_index.ranked_lineage(taxids, RANKS)
     taxids = set([str(taxid) for taxid in taxids])
     lineage_cmd = [
         "taxonkit",
@@ -25,21 +63,7 @@ def get_lineage(taxids, taxdump_dir):
         raise Exception("Failed to convert taxid to lineage")
 
     lineage_dct = {}
-    rank_dct = dict(
-        [
-            (r, True)
-            for r in (
-                "superkingdom",
-                "kingdom",
-                "phylum",
-                "class",
-                "order",
-                "family",
-                "genus",
-                "species",
-            )
-        ]
-    )
+    rank_dct = dict([(r, True) for r in RANKS])
     for row in lineage_proc.stdout.decode("utf-8").strip().split("\n"):
         row = row.split("\t")
         if len(row) == 4:
@@ -73,7 +97,7 @@ def list_subtree(taxids, taxdump_dir):
         "--ids",
         ",".join(taxids),
         "-j",
-        "4",
+        str(min(4, MAX_THREADS)),
     ]
     list_proc = subprocess.Popen(list_cmd, stdout=subprocess.PIPE)
     sub_taxids = set()
@@ -84,18 +108,145 @@ def list_subtree(taxids, taxdump_dir):
     return sub_taxids
 
 
-def assign_taxon(hit_json, taxdump_dir):
-    taxids = set()
-    hits = json.loads(hit_json.read_text())
-    qname2lineage = {}
-    for hit in hits:
-        qname = hit["qname"]
+def assign_taxon(hit_json, taxdump_dir=None, taxid2lineage=None, hits=None):
+    """
+    Assign reads to taxon
+    hit_json: path to {sample_id}.hit.json -> Path
+    taxdump_dir: path to taxdump directory -> Path
+    taxid2lineage: lineages already resolved by get_lineage -> dict
+    hits: records of hit_json if already loaded -> list
+    return: normalized taxonomy, see normalize_taxonomy -> dict
+    """
+    if hits is None:
+        hits = json.loads(hit_json.read_text())
+    qname2hit = {hit["qname"]: hit for hit in hits}
+    reads = {"qname": [], "taxid": [], "count": []}
+    for qname, hit in qname2hit.items():
         acc, taxid = hit["tname"].split("|")
-        taxids.add(taxid)
-        qname2lineage[qname] = {"taxid": taxid, "lineage": None}
+        reads["qname"].append(qname)
+        reads["taxid"].append(taxid)
+        reads["count"].append(hit.get("count", 1))
+
+    if taxid2lineage is None:
+        taxid2lineage = get_lineage(set(reads["taxid"]), taxdump_dir)
+    lineages = {taxid: taxid2lineage.get(taxid) for taxid in set(reads["taxid"])}
+    return {"reads": reads, "lineages": lineages}
+
+
+def write_taxonomy(hit_json, out_dir, taxdump_dir=None, taxid2lineage=None):
+    """
+    Assign reads to taxon and write {sample_id}.taxonomy.json
+    hit_json: path to {sample_id}.hit.json -> Path
+    out_dir: output directory -> Path
+    return: path to taxonomy json -> Path
+    """
+    sample_id = hit_json.name.split(".")[0]
+    with track_stage("assignment", sample_id=sample_id) as progress:
+        taxonomy = assign_taxon(
+            hit_json=hit_json, taxdump_dir=taxdump_dir, taxid2lineage=taxid2lineage
+        )
+        progress.update(len(taxonomy["reads"]["qname"]))
+    lineage_json = out_dir / f"{sample_id}.taxonomy.json"
+    lineage_json.write_text(json.dumps(taxonomy))
+    return lineage_json
+
+
+def read_hit_taxids(hit_json, hits=None):
+    """
+    hit_json: path to {sample_id}.hit.json -> Path
+    hits: records of hit_json if already loaded -> list
+    return: taxids of the hits -> set
+    """
+    if hits is None:
+        hits = json.loads(hit_json.read_text())
+    return set(hit["tname"].split("|")[1] for hit in hits)
 
+
+_SHARED_LINEAGES = None
+
+
+def _share_lineages(taxid2lineage):
+    global _SHARED_LINEAGES
+    _SHARED_LINEAGES = taxid2lineage
+
+
+def _call_with_lineages(func, item):
+    return func(item, taxid2lineage=_SHARED_LINEAGES)
+
+
+def map_with_lineages(func, hit_jsons, taxdump_dir, workers=1):
+    """
+    Resolve the lineages of many hit files with one taxonomy load, then call
+    func(hit_json, taxid2lineage=...) for each file in parallel workers that
+    share the resolved table.
+    func: picklable per-sample function -> callable
+    hit_jsons: paths to {sample_id}.hit.json -> list
+    taxdump_dir: path to taxdump directory -> Path
+    workers: number of worker processes -> int
+    return: results of func in the order of hit_jsons -> list
+    """
+    workers = max(1, min(int(workers), len(hit_jsons)))
+    if workers == 1:
+        taxids = set().union(*map(read_hit_taxids, hit_jsons))
+        taxid2lineage = get_lineage(taxids, taxdump_dir)
+        return [func(hit_json, taxid2lineage=taxid2lineage) for hit_json in hit_jsons]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        taxids = set().union(*executor.map(read_hit_taxids, hit_jsons))
     taxid2lineage = get_lineage(taxids, taxdump_dir)
-    for qname in list(qname2lineage.keys()):
-        taxid = qname2lineage[qname]["taxid"]
-        qname2lineage[qname]["lineage"] = taxid2lineage.get(taxid)
-    return qname2lineage
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=_share_lineages, initargs=(taxid2lineage,)
+    ) as executor:
+        return list(executor.map(partial(_call_with_lineages, func), hit_jsons))
+
+
+def normalize_taxonomy(read2taxon):
+    """
+    Convert a per-read taxonomy ({qname: {"taxid", "lineage", "count"}}) to the
+    normalized layout: read columns plus each distinct lineage stored once.
+    {"reads": {"qname": [...], "taxid": [...], "count": [...]},
+     "lineages": {taxid: lineage}}
+    read2taxon: per-read taxonomy -> dict
+    return: normalized taxonomy -> dict
+    """
+    reads = {"qname": [], "taxid": [], "count": []}
+    lineages = {}
+    for qname, taxon in read2taxon.items():
+        reads["qname"].append(qname)
+        reads["taxid"].append(taxon["taxid"])
+        reads["count"].append(taxon.get("count", 1))
+        lineages.setdefault(taxon["taxid"], taxon["lineage"])
+    return {"reads": reads, "lineages": lineages}
+
+
+def read_taxonomy(taxon_json):
+    """
+    Load a taxonomy json, converting the per-read layout if needed
+    taxon_json: path to {sample_id}.taxonomy.json -> Path
+    return: normalized taxonomy -> dict
+    """
+    taxonomy = json.loads(taxon_json.read_text())
+    if set(taxonomy.keys()) != {"reads", "lineages"}:
+        taxonomy = normalize_taxonomy(taxonomy)
+    return taxonomy
+
+
+def count_taxids(taxonomy, count_mode="total"):
+    """
+    Count reads per assigned taxid
+    taxonomy: normalized taxonomy -> dict
+    count_mode: "total" weights reads by their dedup multiplicity,
+                "dedup" counts each unique read once -> str
+    return: taxid -> number of reads -> dict
+    """
+    if count_mode not in ("total", "dedup"):
+        raise ValueError(f"Unknown count mode: {count_mode}")
+    reads = taxonomy["reads"]
+    taxid2n = {}
+    if count_mode == "total":
+        for taxid, count in zip(reads["taxid"], reads["count"]):
+            taxid2n[taxid] = taxid2n.get(taxid, 0) + count
+    else:
+        for taxid in reads["taxid"]:
+            taxid2n[taxid] = taxid2n.get(taxid, 0) + 1
+    return taxid2n
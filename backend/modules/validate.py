@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+import zlib
+from pathlib import Path
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+CHUNK_SIZE = 1 << 20
+# IUPAC nucleotide codes, either case
+SEQ_CHARS = b"ACGTURYSWKMBDHVNacgturyswkmbdhvn"
+# quality characters (phred+33) and those below Q30
+QUAL_CHARS = bytes(range(33, 127))
+LOW_QUAL_CHARS = bytes(range(33, 63))
+
+
+def detect_compression(head):
+    """
+    head: first bytes of a file, at least 18 for BGZF -> bytes
+    return: "bgzf", "gzip", "zstd" or "none" -> str
+    """
+    if head[:2] == GZIP_MAGIC:
+        # BGZF is gzip with a "BC" extra subfield
+        if len(head) >= 16 and head[3] & 4 and head[12:14] == b"BC":
+            return "bgzf"
+        return "gzip"
+    if head[:4] == ZSTD_MAGIC:
+        return "zstd"
+    return "none"
+
+
+class StreamDecompressor:
+    """
+    Incremental decompression of gzip (including multi-member files such as
+    BGZF or concatenated gzip) and zstd (including multi-frame files) data fed
+    in arbitrary chunks.
+    """
+
+    def __init__(self, compression):
+        self.compression = compression
+        self.in_member = False
+        if compression in ("gzip", "bgzf"):
+            self.format = "gzip"
+            self.errors = (zlib.error,)
+        elif compression == "zstd":
+            if zstandard is None:
+                raise Exception("zstd input needs the zstandard package")
+            self.format = "zstd"
+            self.errors = (zstandard.ZstdError,)
+        elif compression != "none":
+            raise ValueError(f"Unknown compression: {compression}")
+        self.decomp = None if compression == "none" else self._decompressobj()
+
+    def _decompressobj(self):
+        if self.format == "zstd":
+            return zstandard.ZstdDecompressor().decompressobj()
+        return zlib.decompressobj(wbits=31)
+
+    def feed(self, chunk):
+        """
+        chunk: compressed bytes -> bytes
+        return: decompressed bytes -> bytes
+        """
+        if self.decomp is None:
+            return chunk
+        out = []
+        while chunk:
+            try:
+                out.append(self.decomp.decompress(chunk))
+            except self.errors as e:
+                raise ValueError(f"Corrupt {self.format} data: {e}")
+            self.in_member = not self.decomp.eof
+            if self.in_member:
+                break
+            # next gzip member or zstd frame
+            chunk = self.decomp.unused_data
+            self.decomp = self._decompressobj()
+        return b"".join(out)
+
+    def finish(self):
+        if self.in_member:
+            raise ValueError(f"Truncated {self.format} data")
+
+
+class FastqValidator:
+    """
+    Incremental FASTQ validator that collects read statistics.
+    Data can be fed in chunks of any size; a ValueError naming the record is
+    raised as soon as a complete record is malformed.
+    """
+
+    def __init__(self):
+        self.buffer = b""
+        self.lines = []
+        self.read_n = 0
+        self.base_n = 0
+        self.gc_n = 0
+        self.n_n = 0
+        self.q30_n = 0
+        self.min_len = None
+        self.max_len = 0
+
+    def _check_record(self, record_n, header, seq, plus, qual):
+        if not header.startswith(b"@"):
+            raise ValueError(f"Record {record_n}: header does not start with @")
+        if not plus.startswith(b"+"):
+            raise ValueError(f"Record {record_n}: separator line does not start with +")
+        if len(seq) != len(qual):
+            raise ValueError(
+                f"Record {record_n}: sequence and quality lengths differ "
+                f"({len(seq)} != {len(qual)})"
+            )
+        if seq.translate(None, SEQ_CHARS):
+            raise ValueError(f"Record {record_n}: invalid sequence characters")
+        if qual.translate(None, QUAL_CHARS):
+            raise ValueError(f"Record {record_n}: invalid quality characters")
+
+    def _check_batch(self, headers, seqs, pluses, quals):
+        """
+        Check and count a batch of records with whole-batch byte operations;
+        on failure the records are checked one by one to name the bad one.
+        """
+        seq_lens = list(map(len, seqs))
+        all_seq = b"".join(seqs)
+        all_qual = b"".join(quals)
+        if not (
+            all(header[:1] == b"@" for header in headers)
+            and all(plus[:1] == b"+" for plus in pluses)
+            and seq_lens == list(map(len, quals))
+            and not all_seq.translate(None, SEQ_CHARS)
+            and not all_qual.translate(None, QUAL_CHARS)
+        ):
+            for i, record in enumerate(zip(headers, seqs, pluses, quals)):
+                self._check_record(self.read_n + i + 1, *record)
+
+        self.read_n += len(seqs)
+        self.base_n += len(all_seq)
+        self.gc_n += sum(all_seq.count(base) for base in (b"G", b"C", b"g", b"c"))
+        self.n_n += all_seq.count(b"N") + all_seq.count(b"n")
+        self.q30_n += len(all_qual.translate(None, LOW_QUAL_CHARS))
+        if seq_lens:
+            min_len = min(seq_lens)
+            self.min_len = (
+                min_len if self.min_len is None else min(self.min_len, min_len)
+            )
+            self.max_len = max(self.max_len, max(seq_lens))
+
+    def feed(self, data):
+        """
+        data: uncompressed FASTQ bytes -> bytes
+        """
+        if b"\r" in data:
+            data = data.replace(b"\r", b"")
+        lines = (self.buffer + data).split(b"\n")
+        self.buffer = lines.pop()
+        lines = self.lines + lines
+        # blank lines are held back until more data shows they are not the
+        # blank lines some writers leave at the end of the file
+        n = len(lines)
+        while n and not lines[n - 1]:
+            n -= 1
+        end = n - n % 4
+        self._check_batch(
+            lines[0:end:4], lines[1:end:4], lines[2:end:4], lines[3:end:4]
+        )
+        self.lines = lines[end:]
+
+    def finish(self):
+        """
+        Check the trailing record and return the statistics
+        return: read statistics -> dict
+        """
+        if self.buffer:
+            self.feed(b"\n")
+        while self.lines and not self.lines[-1]:
+            self.lines.pop()
+        if self.lines:
+            raise ValueError(f"Record {self.read_n + 1}: truncated record")
+        if self.read_n == 0:
+            raise ValueError("No reads found")
+        return self.stats()
+
+    def stats(self):
+        return {
+            "reads": self.read_n,
+            "bases": self.base_n,
+            "min_len": self.min_len or 0,
+            "max_len": self.max_len,
+            "mean_len": round(self.base_n / self.read_n, 2) if self.read_n else 0,
+            "gc": round(self.gc_n / self.base_n, 4) if self.base_n else 0,
+            "n_frac": round(self.n_n / self.base_n, 6) if self.base_n else 0,
+            "q30": round(self.q30_n / self.base_n, 4) if self.base_n else 0,
+        }
+
+
+class FastqStream:
+    """
+    Validate a (compressed) FASTQ byte stream chunk by chunk, e.g. while it is
+    being written to disk. The compression is detected from the first bytes.
+    """
+
+    def __init__(self):
+        self.head = b""
+        self.compression = None
+        self.decompressor = None
+        self.validator = FastqValidator()
+
+    def feed(self, chunk):
+        """
+        chunk: raw bytes as stored in the file -> bytes
+        """
+        if self.decompressor is None:
+            self.head += chunk
+            if len(self.head) < 18:
+                return
+            chunk, self.head = self.head, b""
+            self.compression = detect_compression(chunk)
+            self.decompressor = StreamDecompressor(self.compression)
+        self.validator.feed(self.decompressor.feed(chunk))
+
+    def finish(self):
+        """
+        return: read statistics and compression -> dict
+        """
+        if self.decompressor is None:
+            self.compression = detect_compression(self.head)
+            self.decompressor = StreamDecompressor(self.compression)
+            self.validator.feed(self.decompressor.feed(self.head))
+        self.decompressor.finish()
+        stats = self.validator.finish()
+        stats["compression"] = self.compression
+        return stats
+
+
+def validate_fastq(fastq, chunk_size=CHUNK_SIZE):
+    """
+    Validate a FASTQ file in one streaming pass
+    fastq: path to (gzip, BGZF or zstd compressed) fastq -> Path
+    return: read statistics -> dict
+    """
+    stream = FastqStream()
+    with open(fastq, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            stream.feed(chunk)
+    return stream.finish()
+
+
+def save_stream(chunks, out_file):
+    """
+    Write a stream of chunks to out_file while validating it.
+    The partial file is removed if the stream is not a valid FASTQ.
+    chunks: iterable of raw bytes -> iterable
+    out_file: destination path -> Path
+    return: read statistics -> dict
+    """
+    out_file = Path(out_file)
+    part = out_file.with_name(f"{out_file.name}.part")
+    stream = FastqStream()
+    try:
+        with open(part, "wb") as f:
+            for chunk in chunks:
+                stream.feed(chunk)
+                f.write(chunk)
+        stats = stream.finish()
+    except BaseException:
+        if part.exists():
+            part.unlink()
+        raise
+    part.rename(out_file)
+    return stats
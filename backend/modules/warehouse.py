@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+import pandas as pd
+from pathlib import Path
+from datetime import datetime
+
+SORT_COLS = ("rpm", "hit_n", "rpkm", "tpm", "zscore", "name", "sample_id", "date")
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 1000
+
+
+def _to_float(value):
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return None if value != value else value
+
+
+def _to_timestamp(value):
+    """
+    value: unix time or ISO date such as 2024-05-01 -> str or float
+    return: unix time -> float
+    """
+    if value is None or value == "":
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+def read_sample_results(rpm_json, rank_tsv=None, report_tsv=None):
+    """
+    Collect the abundance rows of one sample from its pipeline outputs
+    rpm_json: path to {sample_id}.rpm.json -> Path
+    rank_tsv: path to {sample_id}.rank_rpm.tsv, adds the other ranks -> Path
+    report_tsv: path to {sample_id}.report.tsv, adds Z score, %id and L -> Path
+    return: one row per rank and taxid -> list
+    """
+    rows = {}
+    name2report = {}
+    if report_tsv is not None and Path(report_tsv).is_file():
+        report_df = pd.read_csv(report_tsv, sep="\t")
+        for _, row in report_df.iterrows():
+            name2report[row["Taxon"]] = row
+
+    for taxid, values in json.loads(Path(rpm_json).read_text()).items():
+        lineage = values["taxon"]["lineage"] or {}
+        name = lineage.get("species", {}).get("name", taxid)
+        report_row = name2report.get(name, {})
+        rows[("species", str(taxid))] = {
+            "rank": "species",
+            "taxid": str(taxid),
+            "name": name,
+            "hit_n": values["hit_n"],
+            "rpm": values["rpm"],
+            "rpkm": values.get("rpkm"),
+            "tpm": values.get("tpm"),
+            "zscore": _to_float(report_row.get("Z score")),
+            "pident": _to_float(report_row.get("%id")),
+            "alnlen": _to_float(report_row.get("L")),
+        }
+
+    if rank_tsv is not None and Path(rank_tsv).is_file():
+        rank_df = pd.read_csv(rank_tsv, sep="\t", dtype={"taxid": str})
+        for rank, taxid, name, hit_n, rpm in rank_df[
+            ["rank", "taxid", "name", "hit_n", "rpm"]
+        ].itertuples(index=False):
+            if (rank, taxid) in rows:
+                continue
+            rows[(rank, taxid)] = {
+                "rank": rank,
+                "taxid": taxid,
+                "name": name,
+                "hit_n": int(hit_n),
+                "rpm": float(rpm),
+                "rpkm": None,
+                "tpm": None,
+                "zscore": None,
+                "pident": None,
+                "alnlen": None,
+            }
+    return list(rows.values())
+
+
+class Warehouse:
+    """
+    SQLite store of abundance results of all ingested runs, indexed for
+    dashboard queries by taxon, rank, rPM and date.
+    A version counter is bumped on every ingest so responses can be cached.
+    """
+
+    COLS = (
+        "run_id",
+        "sample_id",
+        "rank",
+        "taxid",
+        "name",
+        "hit_n",
+        "rpm",
+        "rpkm",
+        "tpm",
+        "zscore",
+        "pident",
+        "alnlen",
+        "date",
+    )
+
+    def __init__(self, db_path):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.db_path, timeout=60, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript("""
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER);
+            INSERT OR IGNORE INTO meta VALUES ('version', 0);
+            CREATE TABLE IF NOT EXISTS runs (
+                run_id TEXT PRIMARY KEY, project_id TEXT, out_dir TEXT,
+                date REAL, ingested REAL);
+            CREATE TABLE IF NOT EXISTS abundance (
+                run_id TEXT, sample_id TEXT, rank TEXT, taxid TEXT, name TEXT,
+                hit_n INTEGER, rpm REAL, rpkm REAL, tpm REAL, zscore REAL,
+                pident REAL, alnlen REAL, date REAL,
+                PRIMARY KEY (run_id, sample_id, rank, taxid));
+            CREATE INDEX IF NOT EXISTS abundance_taxid ON abundance (rank, taxid, rpm);
+            CREATE INDEX IF NOT EXISTS abundance_rank_rpm ON abundance (rank, rpm);
+            CREATE INDEX IF NOT EXISTS abundance_name ON abundance (rank, name);
+            CREATE INDEX IF NOT EXISTS abundance_date ON abundance (rank, date);
+            CREATE INDEX IF NOT EXISTS abundance_sample ON abundance (sample_id, rank);
+            """)
+        self.conn.commit()
+
+    @property
+    def version(self):
+        with self.lock:
+            return self.conn.execute(
+                "SELECT value FROM meta WHERE key = 'version'"
+            ).fetchone()[0]
+
+    def ingest(self, out_dir, run_id=None, project_id=None, date=None):
+        """
+        Load the rpm/ and report/ outputs of a run, replacing earlier loads of it
+        out_dir: pipeline output directory -> Path
+        run_id: run identifier, default a hash of the resolved out_dir, so
+            runs of different projects with the same directory name are kept
+            apart -> str
+        project_id: project the run belongs to -> str
+        date: run date as unix time, default when the newest rpm json was
+            written -> float
+        return: number of samples ingested -> int
+        """
+        out_dir = Path(out_dir).resolve()
+        if run_id is None:
+            run_id = hashlib.sha1(str(out_dir).encode()).hexdigest()[:12]
+        rpm_jsons = sorted((out_dir / "rpm").glob("*.rpm.json"))
+        if date is None:
+            date = max(
+                (rpm_json.stat().st_mtime for rpm_json in rpm_jsons),
+                default=time.time(),
+            )
+        rows = []
+        sample_n = 0
+        for rpm_json in rpm_jsons:
+            sample_id = rpm_json.name.split(".")[0]
+            sample_rows = read_sample_results(
+                rpm_json,
+                rank_tsv=rpm_json.with_name(f"{sample_id}.rank_rpm.tsv"),
+                report_tsv=out_dir / "report" / f"{sample_id}.report.tsv",
+            )
+            rows.extend(
+                tuple(
+                    dict(row, run_id=run_id, sample_id=sample_id, date=date)[col]
+                    for col in self.COLS
+                )
+                for row in sample_rows
+            )
+            sample_n += 1
+
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM abundance WHERE run_id = ?", (run_id,))
+            self.conn.execute(
+                "INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?)",
+                (run_id, project_id, str(out_dir), date, time.time()),
+            )
+            self.conn.executemany(
+                f"INSERT OR REPLACE INTO abundance ({', '.join(self.COLS)}) "
+                f"VALUES ({', '.join('?' * len(self.COLS))})",
+                rows,
+            )
+            self.conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'version'")
+            # keep planner statistics current so filters use the right index
+            self.conn.execute("PRAGMA analysis_limit = 1000")
+            self.conn.execute("ANALYZE")
+        return sample_n
+
+    def query(
+        self,
+        rank="species",
+        taxid=None,
+        name=None,
+        min_rpm=None,
+        sample_id=None,
+        run_id=None,
+        project_id=None,
+        since=None,
+        until=None,
+        sort="rpm",
+        order="desc",
+        page=1,
+        page_size=PAGE_SIZE,
+    ):
+        """
+        Filter, sort and paginate abundance rows
+        name: case-insensitive substring of the taxon name -> str
+        since, until: run date range, unix time or ISO date -> str
+        sort: one of SORT_COLS -> str
+        return: {"total", "page", "page_size", "rows"} -> dict
+        """
+        if sort not in SORT_COLS:
+            raise ValueError(f"sort must be one of {', '.join(SORT_COLS)}")
+        if order not in ("asc", "desc"):
+            raise ValueError("order must be asc or desc")
+        page = max(int(page), 1)
+        page_size = min(max(int(page_size), 1), MAX_PAGE_SIZE)
+
+        where = ["a.rank = ?"]
+        args = [rank]
+        for col, value in (("a.taxid", taxid), ("a.sample_id", sample_id)):
+            if value:
+                where.append(f"{col} = ?")
+                args.append(str(value))
+        if run_id:
+            where.append("a.run_id = ?")
+            args.append(run_id)
+        if project_id:
+            where.append("a.run_id IN (SELECT run_id FROM runs WHERE project_id = ?)")
+            args.append(project_id)
+        if name:
+            where.append("a.name LIKE ?")
+            args.append(f"%{name}%")
+        if min_rpm is not None:
+            where.append("a.rpm >= ?")
+            args.append(float(min_rpm))
+        if since:
+            where.append("a.date >= ?")
+            args.append(_to_timestamp(since))
+        if until:
+            where.append("a.date <= ?")
+            args.append(_to_timestamp(until))
+        clause = " AND ".join(where)
+
+        with self.lock:
+            total = self.conn.execute(
+                f"SELECT COUNT(*) FROM abundance a WHERE {clause}", args
+            ).fetchone()[0]
+            rows = self.conn.execute(
+                "SELECT a.*, (SELECT project_id FROM runs r WHERE r.run_id = a.run_id) "
+                f"AS project_id FROM abundance a WHERE {clause} "
+                f"ORDER BY a.{sort} {order}, a.run_id, a.sample_id, a.taxid "
+                "LIMIT ? OFFSET ?",
+                (*args, page_size, (page - 1) * page_size),
+            ).fetchall()
+        return {
+            "total": total,
+            "page": page,
+            "page_size": page_size,
+            "rows": [dict(row) for row in rows],
+        }
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+import os
+import json
+import time
+import signal
+import socket
+import threading
+import socketserver
+import click
+from collections import OrderedDict
+from pathlib import Path
+
+from modules.common import (
+    CONTEXT_SETTINGS,
+    WORKER_SOCKET_ENV,
+    AdvancedJSONEncoder,
+    WorkerUnavailable,
+    call_worker,
+    logger,
+)
+from modules.taxonparse import (
+    assign_taxon,
+    get_lineage,
+    get_taxon_index,
+    read_hit_taxids,
+    read_taxonomy,
+)
+from modules.abundance import calculate_abundance
+from modules.reflen import RefLengthIndex
+from modules.background import BackgroundModel
+from modules.report import species_report
+from modules.progress import track_stage
+
+# parsed input files kept between tasks, e.g. the hits and taxonomy of a sample
+# that assign_taxon, abundance_calculation and summary_report all read
+CACHE_FILES = 8
+# seconds between checks of the idle timeout
+IDLE_POLL = 5
+
+
+def read_json(path):
+    return json.loads(Path(path).read_text())
+
+
+def _file_key(path):
+    stat = Path(path).stat()
+    return str(path), stat.st_mtime_ns, stat.st_size
+
+
+class WorkerCache:
+    """
+    State kept resident between tasks: lineages resolved per taxdump, reference
+    length indexes and background models for the life of the worker, and the
+    most recently used parsed files. Entries are keyed by path, mtime and size,
+    so a rewritten file is loaded again.
+    """
+
+    def __init__(self, max_files=CACHE_FILES):
+        self.max_files = max_files
+        self.lineages = {}
+        self.resident = {}
+        self.files = OrderedDict()
+        self.lock = threading.Lock()
+
+    def lineage(self, taxids, taxdump_dir):
+        """
+        Lineages of taxids, only taxids not seen before are looked up
+        taxids: list of taxids -> list
+        taxdump_dir: path to taxdump directory -> Path
+        return: {taxid: lineage}, see taxonparse.get_lineage -> dict
+        """
+        nodes_dmp = Path(taxdump_dir) / "nodes.dmp"
+        key = _file_key(nodes_dmp) if nodes_dmp.is_file() else str(taxdump_dir)
+        taxids = set(str(taxid) for taxid in taxids)
+        with self.lock:
+            taxid2lineage = self.lineages.setdefault(key, {})
+            missing = taxids.difference(taxid2lineage)
+        # looked up unlocked, so other tasks are not held up by taxonkit; two
+        # tasks may look up the same taxids, which resolve the same
+        found = get_lineage(missing, taxdump_dir) if missing else {}
+        with self.lock:
+            taxid2lineage.update(found)
+            return {taxid: taxid2lineage.get(taxid) for taxid in taxids}
+
+    def get(self, path, loader, resident=False):
+        """
+        path: file or index directory -> Path
+        loader: loads path on a miss -> callable
+        resident: keep for the life of the worker instead of among the
+            recently used files -> bool
+        return: loaded value -> object
+        """
+        key = (loader, *_file_key(path))
+        store = self.resident if resident else self.files
+        with self.lock:
+            if key in store:
+                if not resident:
+                    store.move_to_end(key)
+                return store[key]
+        value = loader(Path(path))
+        self.put(path, loader, value, resident=resident)
+        return value
+
+    def put(self, path, loader, value, resident=False):
+        """
+        Store value as the result of loader for path, e.g. a file just written
+        """
+        key = (loader, *_file_key(path))
+        store = self.resident if resident else self.files
+        with self.lock:
+            for old_key in [k for k in store if k[:2] == key[:2]]:
+                del store[old_key]
+            store[key] = value
+            while not resident and len(store) > self.max_files:
+                store.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "lineages": sum(len(lineages) for lineages in self.lineages.values()),
+                "resident": [key[1] for key in self.resident],
+                "files": [key[1] for key in self.files],
+            }
+
+
+def assign_taxon_task(cache, hit_jsons, taxdump_dir, out_dir, progress_file=None):
+    """
+    Same outputs and progress events as scripts/assign_taxon.py
+    progress_file: progress file of the calling job -> Path
+    return: paths to taxonomy json -> list
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    hit_jsons = [Path(hit_json) for hit_json in hit_jsons]
+    hits_list = [cache.get(hit_json, read_json) for hit_json in hit_jsons]
+    taxids = set().union(
+        *(
+            read_hit_taxids(hit_json, hits)
+            for hit_json, hits in zip(hit_jsons, hits_list)
+        )
+    )
+    taxid2lineage = cache.lineage(taxids, taxdump_dir)
+    taxon_jsons = []
+    for hit_json, hits in zip(hit_jsons, hits_list):
+        sample_id = hit_json.name.split(".")[0]
+        with track_stage(
+            "assignment", sample_id=sample_id, path=progress_file
+        ) as progress:
+            taxonomy = assign_taxon(hit_json, taxid2lineage=taxid2lineage, hits=hits)
+            progress.update(len(taxonomy["reads"]["qname"]))
+        taxon_json = out_dir / f"{sample_id}.taxonomy.json"
+        taxon_json.write_text(json.dumps(taxonomy))
+        cache.put(taxon_json, read_taxonomy, taxonomy)
+        taxon_jsons.append(taxon_json)
+    return taxon_jsons
+
+
+def abundance_task(cache, taxon_json, out_dir, count_mode="total", length_index=None):
+    """
+    Same outputs as scripts/abundance_calculation.py
+    return: paths to rpm json and rank tsv -> list
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    taxid2rpm, rank_df = calculate_abundance(
+        cache.get(taxon_json, read_taxonomy),
+        count_mode=count_mode,
+        length_index=(
+            cache.get(length_index, RefLengthIndex, resident=True)
+            if length_index
+            else None
+        ),
+    )
+    sample_id = Path(taxon_json).name.split(".")[0]
+    rpm_json = out_dir / f"{sample_id}.rpm.json"
+    rpm_json.write_text(json.dumps(taxid2rpm, indent=2))
+    rank_tsv = out_dir / f"{sample_id}.rank_rpm.tsv"
+    rank_df.to_csv(rank_tsv, sep="\t", index=False)
+    return [rpm_json, rank_tsv]
+
+
+def summary_report_task(
+    cache, hit_json, taxon_json, rpm_json, out_dir, background=None
+):
+    """
+    Same outputs as scripts/summary_report.py
+    return: path to report tsv -> Path
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    report_df = species_report(
+        cache.get(hit_json, read_json),
+        cache.get(taxon_json, read_taxonomy),
+        read_json(rpm_json),
+        background=(
+            cache.get(background, BackgroundModel.load, resident=True)
+            if background
+            else None
+        ),
+    )
+    report_tsv = out_dir / f"{Path(rpm_json).name.split('.')[0]}.report.tsv"
+    report_df.to_csv(report_tsv, sep="\t", index=False)
+    return report_tsv
+
+
+def ping_task(cache):
+    return {"pid": os.getpid(), "cache": cache.stats()}
+
+
+TASKS = {
+    "assign_taxon": assign_taxon_task,
+    "abundance_calculation": abundance_task,
+    "summary_report": summary_report_task,
+    "ping": ping_task,
+}
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        self.server.begin()
+        start = time.time()
+        try:
+            request = json.loads(line)
+            if request["task"] not in TASKS:
+                raise ValueError(f"Unknown task: {request['task']}")
+            result = TASKS[request["task"]](self.server.cache, **request["kwargs"])
+            response = {"ok": True, "result": result}
+            logger.info(f"{request['task']} done in {time.time() - start:.3f}s")
+        except Exception as e:
+            logger.exception(f"task failed: {line[:200]!r}")
+            response = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+        finally:
+            self.server.end()
+        self.wfile.write(json.dumps(response, cls=AdvancedJSONEncoder).encode())
+        self.wfile.write(b"\n")
+
+
+class WorkerServer(socketserver.ThreadingUnixStreamServer):
+    """
+    Serves tasks over a unix socket, one json request and response line per
+    connection. Connections are handled in threads that share one WorkerCache.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, cache):
+        self.cache = cache
+        self.active = 0
+        self.last_active = time.time()
+        self._active_lock = threading.Lock()
+        # only the owner may connect, tasks write files as the worker user
+        umask = os.umask(0o177)
+        try:
+            super().__init__(str(socket_path), _RequestHandler)
+        finally:
+            os.umask(umask)
+
+    def begin(self):
+        with self._active_lock:
+            self.active += 1
+
+    def end(self):
+        with self._active_lock:
+            self.active -= 1
+            self.last_active = time.time()
+
+    def idle_for(self):
+        with self._active_lock:
+            return 0 if self.active else time.time() - self.last_active
+
+
+def _remove_stale_socket(socket_path):
+    if not socket_path.exists():
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(str(socket_path))
+        except OSError:
+            socket_path.unlink()
+            return
+    raise Exception(f"A worker is already listening on {socket_path}")
+
+
+def serve(socket_path, idle_timeout=0, max_files=CACHE_FILES, taxdump_dirs=()):
+    """
+    Run the worker until SIGTERM, SIGINT or idle_timeout
+    socket_path: unix socket to listen on -> Path
+    idle_timeout: seconds without tasks before exiting, 0 to run forever -> int
+    max_files: parsed files kept between tasks -> int
+    taxdump_dirs: taxdumps whose taxon index is opened at start -> list
+    """
+    socket_path = Path(socket_path).resolve()
+    _remove_stale_socket(socket_path)
+    cache = WorkerCache(max_files=max_files)
+    for taxdump_dir in taxdump_dirs:
+        if get_taxon_index(taxdump_dir) is None:
+            logger.warning(f"{taxdump_dir} has no taxon index, taxonkit is used")
+    server = WorkerServer(socket_path, cache)
+
+    def stop(*args):
+        # shutdown waits for serve_forever, so it can not run in its thread
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    def watch_idle():
+        while server.idle_for() < idle_timeout:
+            time.sleep(min(IDLE_POLL, idle_timeout))
+        logger.info(f"worker idle for {idle_timeout}s, exiting")
+        stop()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    if idle_timeout > 0:
+        threading.Thread(target=watch_idle, daemon=True).start()
+    logger.info(f"worker {os.getpid()} listening on {socket_path}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        socket_path.unlink(missing_ok=True)
+
+
+@click.command(
+    help="Keep taxonomy and indexes loaded and run the short stages "
+    "(assign_taxon, abundance_calculation, summary_report) of scripts with "
+    f"{WORKER_SOCKET_ENV} set",
+    context_settings=CONTEXT_SETTINGS,
+)
+@click.option(
+    "--socket",
+    "socket_path",
+    help="unix socket to listen on",
+    type=click.Path(dir_okay=False, path_type=Path),
+    envvar=WORKER_SOCKET_ENV,
+    required=True,
+)
+@click.option(
+    "--taxdump_dir",
+    help="taxdump to load at start (multiple allowed)",
+    type=click.Path(exists=True, file_okay=False, resolve_path=True, path_type=Path),
+    multiple=True,
+)
+@click.option(
+    "--idle_timeout",
+    help="exit after this many seconds without tasks, 0 to run until stopped",
+    type=int,
+    default=0,
+    show_default=True,
+)
+@click.option(
+    "--cache_files",
+    help="number of parsed hit and taxonomy files kept",
+    type=int,
+    default=CACHE_FILES,
+    show_default=True,
+)
+@click.option("--ping", help="show the state of a running worker", is_flag=True)
+def cli(socket_path, taxdump_dir, idle_timeout, cache_files, ping):
+    if ping:
+        try:
+            click.echo(json.dumps(call_worker("ping", socket_path), indent=2))
+        except WorkerUnavailable as e:
+            raise click.ClickException(str(e))
+        return
+    serve(
+        socket_path,
+        idle_timeout=idle_timeout,
+        max_files=cache_files,
+        taxdump_dirs=taxdump_dir,
+    )
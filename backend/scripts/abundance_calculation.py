@@ -6,8 +6,13 @@ import click
 from pathlib import Path
 
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
-from modules.common import set_out_dir, CONTEXT_SETTINGS
-from modules.abundance import get_rpm
+from modules.common import (
+    set_out_dir,
+    CONTEXT_SETTINGS,
+    instrument,
+    call_worker,
+    WorkerUnavailable,
+)
 
 
 @click.command(help="Relative abundance calculation", context_settings=CONTEXT_SETTINGS)
@@ -18,6 +23,20 @@ from modules.abundance import get_rpm
     type=click.Path(exists=True, dir_okay=False, resolve_path=True, path_type=Path),
     required=True,
 )
+@click.option(
+    "--count_mode",
+    help="count total reads or unique reads after dedup",
+    type=click.Choice(["total", "dedup"]),
+    default="total",
+    show_default=True,
+)
+@click.option(
+    "--length_index",
+    "-l",
+    help="reference length index from build_db, adds RPKM and TPM",
+    type=click.Path(exists=True, file_okay=False, resolve_path=True, path_type=Path),
+    required=False,
+)
 @click.option(
     "--out_dir",
     "-o",
@@ -26,14 +45,40 @@ from modules.abundance import get_rpm
     required=True,
 )
 @set_out_dir
-def main(taxon_json, out_dir):
-    read2taxon = json.loads(taxon_json.read_text())
+@instrument("abundance_calculation", sample_from="taxon_json")
+def main(taxon_json, count_mode, length_index, out_dir):
+    try:
+        outputs = call_worker(
+            "abundance_calculation",
+            taxon_json=taxon_json,
+            out_dir=out_dir,
+            count_mode=count_mode,
+            length_index=length_index,
+        )
+        for output in outputs:
+            click.echo(f"Output: {output}")
+        return 0
+    except WorkerUnavailable:
+        pass
+    # imported only without a worker, which has them loaded already
+    from modules.abundance import calculate_abundance
+    from modules.reflen import RefLengthIndex
+    from modules.taxonparse import read_taxonomy
+
+    taxonomy = read_taxonomy(taxon_json)
 
-    rpm_dct = get_rpm(read2taxon)
+    rpm_dct, rank_df = calculate_abundance(
+        taxonomy,
+        count_mode=count_mode,
+        length_index=RefLengthIndex(length_index) if length_index else None,
+    )
     sample_id = taxon_json.name.split(".")[0]
     out_json = out_dir / f"{sample_id}.rpm.json"
     out_json.write_text(json.dumps(rpm_dct, indent=2))
     click.echo(f"Output: {out_json}")
+    rank_tsv = out_dir / f"{sample_id}.rank_rpm.tsv"
+    rank_df.to_csv(rank_tsv, sep="\t", index=False)
+    click.echo(f"Output: {rank_tsv}")
     return 0
 
 
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+import sys
+from pathlib import Path
+import click
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from modules.common import set_out_dir, CONTEXT_SETTINGS, instrument
+from modules.adaptive import adaptive_sample
+
+
+@click.command(
+    help="Subsample reads in growing batches until the top species rPM converge",
+    context_settings=CONTEXT_SETTINGS,
+)
+@click.option(
+    "--reads",
+    help="Path to reads file",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    required=True,
+)
+@click.option(
+    "--reference",
+    "-r",
+    help="reference genomes",
+    type=click.Path(exists=True, dir_okay=False, resolve_path=True, path_type=Path),
+    required=True,
+)
+@click.option(
+    "--taxdump_dir",
+    help="taxdump directory",
+    type=click.Path(exists=True, dir_okay=True, resolve_path=True, path_type=Path),
+    required=True,
+)
+@click.option(
+    "--start_n",
+    help="reads in the first batch",
+    type=int,
+    default=100000,
+    show_default=True,
+)
+@click.option(
+    "--subsample_n",
+    help="maximum number of reads",
+    type=int,
+    default=1000000,
+    show_default=True,
+)
+@click.option(
+    "--growth",
+    help="factor by which the depth grows per batch",
+    type=float,
+    default=2.0,
+    show_default=True,
+)
+@click.option(
+    "--top_n",
+    help="number of species compared between batches",
+    type=int,
+    default=10,
+    show_default=True,
+)
+@click.option(
+    "--tolerance",
+    help="stop when no top species rPM changes by more than this fraction",
+    type=float,
+    default=0.05,
+    show_default=True,
+)
+@click.option(
+    "--read_type",
+    help="read type",
+    type=click.Choice(["illumina", "ont"]),
+    default="illumina",
+    show_default=True,
+)
+@click.option("--threads", "-t", help="number of threads", type=int, default=0)
+@click.option("--out_dir", help="Path to output directory", type=Path, required=True)
+@set_out_dir
+@instrument("adaptive_sample", sample_from="reads")
+def main(
+    reads,
+    reference,
+    taxdump_dir,
+    start_n,
+    subsample_n,
+    growth,
+    top_n,
+    tolerance,
+    read_type,
+    threads,
+    out_dir,
+):
+    outputs = adaptive_sample(
+        reads,
+        reference,
+        taxdump_dir,
+        out_dir,
+        start_n=start_n,
+        max_n=subsample_n,
+        growth=growth,
+        top_n=top_n,
+        tolerance=tolerance,
+        read_type=read_type,
+        threads=threads,
+    )
+    for output in outputs.values():
+        print("output written to", output)
+
+
+if __name__ == "__main__":
+    main()
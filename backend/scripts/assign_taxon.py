@@ -1,20 +1,31 @@
 #!/usr/bin/env python3
 import sys
-import json
 import click
 from pathlib import Path
+from functools import partial
 
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
-from modules.common import set_out_dir, CONTEXT_SETTINGS
-from modules.taxonparse import assign_taxon
+from modules.common import (
+    set_out_dir,
+    CONTEXT_SETTINGS,
+    instrument,
+    call_worker,
+    WorkerUnavailable,
+)
+from modules.progress import progress_file
 
 
 @click.command(help="Assign reads to taxon from paf", context_settings=CONTEXT_SETTINGS)
 @click.option(
     "--hit_json",
-    help="input {sample_id}.hits.json",
+    help="input {sample_id}.hits.json (multiple allowed)",
     type=click.Path(exists=True, dir_okay=False, resolve_path=True, path_type=Path),
-    required=True,
+    multiple=True,
+)
+@click.option(
+    "--hit_dir",
+    help="directory of {sample_id}.hit.json, assigned as one batch",
+    type=click.Path(exists=True, file_okay=False, resolve_path=True, path_type=Path),
 )
 @click.option(
     "--taxdump_dir",
@@ -22,14 +33,43 @@ from modules.taxonparse import assign_taxon
     type=click.Path(exists=True, dir_okay=True, resolve_path=True, path_type=Path),
     required=True,
 )
+@click.option(
+    "--threads",
+    "-t",
+    help="number of worker processes for a batch",
+    type=int,
+    default=1,
+    show_default=True,
+)
 @click.option("--out_dir", "-o", help="output directory")
 @set_out_dir
-def main(hit_json, taxdump_dir, out_dir):
-    sample_id = hit_json.name.split(".")[0]
-    qname2lineage = assign_taxon(hit_json=hit_json, taxdump_dir=taxdump_dir)
-    lineage_json = out_dir / f"{sample_id}.taxonomy.json"
-    lineage_json.write_text(json.dumps(qname2lineage, indent=4))
-    click.echo(f"Output: {lineage_json}")
+@instrument("assign_taxon", sample_from="hit_json")
+def main(hit_json, hit_dir, taxdump_dir, threads, out_dir):
+    hit_jsons = list(hit_json)
+    if hit_dir is not None:
+        hit_jsons.extend(sorted(hit_dir.glob("*.hit.json")))
+    if not hit_jsons:
+        raise click.UsageError("Either --hit_json or --hit_dir must be provided.")
+    try:
+        lineage_jsons = call_worker(
+            "assign_taxon",
+            hit_jsons=hit_jsons,
+            taxdump_dir=taxdump_dir,
+            out_dir=out_dir,
+            progress_file=progress_file(),
+        )
+    except WorkerUnavailable:
+        # imported only without a worker, which has them loaded already
+        from modules.taxonparse import write_taxonomy, map_with_lineages
+
+        lineage_jsons = map_with_lineages(
+            partial(write_taxonomy, out_dir=out_dir),
+            hit_jsons,
+            taxdump_dir,
+            workers=threads,
+        )
+    for lineage_json in lineage_jsons:
+        click.echo(f"Output: {lineage_json}")
 
 
 if __name__ == "__main__":
@@ -20,6 +20,7 @@ def update_nf_config(db_paths):
     hisat2_idx = db_paths["human_idx"]["hisat2"]
     nonhuman_db = db_paths["blastdb"]["fasta"]["non_human"]
     taxdump_dir = db_paths["taxdump"]
+    length_index = db_paths["length_index"]
 
     with open(config_fpath, "r") as f_in, open(updated_fpath, "w") as f_out:
         for row in f_in:
@@ -31,6 +32,10 @@ def update_nf_config(db_paths):
                 row = re.sub(r"nonhuman_db = .+", f'nonhuman_db = "{nonhuman_db}"', row)
             elif re.search(r"taxdump_dir = .+", row):
                 row = re.sub(r"taxdump_dir = .+", f'taxdump_dir = "{taxdump_dir}"', row)
+            elif re.search(r"length_index = .+", row):
+                row = re.sub(
+                    r"length_index = .+", f'length_index = "{length_index}"', row
+                )
             f_out.write(row)
     print(f"updated {updated_fpath}")
 
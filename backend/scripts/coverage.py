@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+import sys
+import json
+import click
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from modules.common import set_out_dir, CONTEXT_SETTINGS, instrument
+from modules.coverage import get_coverage, get_species_coverage
+from modules.taxonparse import read_taxonomy
+
+
+@click.command(
+    help="Coverage breadth and depth per reference and species",
+    context_settings=CONTEXT_SETTINGS,
+)
+@click.option(
+    "--hit_json",
+    "-i",
+    help="input hit json",
+    type=click.Path(exists=True, dir_okay=False, resolve_path=True, path_type=Path),
+    required=True,
+)
+@click.option(
+    "--taxon_json",
+    "-t",
+    help="input taxonomy json, enables the species table",
+    type=click.Path(exists=True, dir_okay=False, resolve_path=True, path_type=Path),
+    required=False,
+)
+@click.option(
+    "--bins",
+    help="number of bins in the depth profile",
+    type=int,
+    default=10,
+    show_default=True,
+)
+@click.option(
+    "--out_dir",
+    "-o",
+    help="output directory",
+    type=click.Path(exists=False, dir_okay=True, resolve_path=True, path_type=Path),
+    required=True,
+)
+@set_out_dir
+@instrument("coverage", sample_from="hit_json")
+def main(hit_json, taxon_json, bins, out_dir):
+    sample_id = hit_json.name.split(".")[0]
+    acc_df = get_coverage(json.loads(hit_json.read_text()), bins=bins)
+    acc_tsv = out_dir / f"{sample_id}.coverage.tsv"
+    acc_df.to_csv(acc_tsv, sep="\t", index=False)
+    click.echo(f"Output: {acc_tsv}")
+    if taxon_json is not None:
+        sp_df = get_species_coverage(acc_df, read_taxonomy(taxon_json)["lineages"])
+        sp_tsv = out_dir / f"{sample_id}.species_coverage.tsv"
+        sp_df.to_csv(sp_tsv, sep="\t", index=False)
+        click.echo(f"Output: {sp_tsv}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+import sys
+import click
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from modules.common import read_config, PROJECT_ROOT, CONTEXT_SETTINGS
+from modules.warehouse import Warehouse
+
+
+@click.command(
+    help="Load pipeline outputs into the results warehouse",
+    context_settings=CONTEXT_SETTINGS,
+)
+@click.option(
+    "--db",
+    help="warehouse database, default warehouse_db from config.yml",
+    type=click.Path(dir_okay=False, resolve_path=True, path_type=Path),
+)
+@click.option("--project_id", help="project the runs belong to", type=str)
+@click.option(
+    "--date",
+    help="run date, default when the run wrote its rpm outputs",
+    type=click.DateTime(),
+)
+@click.argument(
+    "out_dirs",
+    nargs=-1,
+    required=True,
+    type=click.Path(exists=True, file_okay=False, resolve_path=True, path_type=Path),
+)
+def main(db, project_id, date, out_dirs):
+    db = (
+        db
+        or read_config().get("warehouse_db")
+        or PROJECT_ROOT / "jobs" / "warehouse.sqlite"
+    )
+    warehouse = Warehouse(db)
+    for out_dir in out_dirs:
+        sample_n = warehouse.ingest(
+            out_dir,
+            project_id=project_id,
+            date=None if date is None else date.timestamp(),
+        )
+        click.echo(f"{out_dir}: {sample_n} samples ingested")
+    warehouse.close()
+
+
+if __name__ == "__main__":
+    main()
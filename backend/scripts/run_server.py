@@ -3,7 +3,8 @@ import sys
 from pathlib import Path
 
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
-from modules.server import app, API_PORT
+from modules.server import app, API_PORT, start_job_runner
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=API_PORT, debug=True)
+    start_job_runner()
+    app.run(host="0.0.0.0", port=API_PORT, threaded=True)
@@ -2,11 +2,16 @@
 import sys
 import json
 import click
-import pandas as pd
 from pathlib import Path
 
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
-from modules.common import set_out_dir, CONTEXT_SETTINGS
+from modules.common import (
+    set_out_dir,
+    CONTEXT_SETTINGS,
+    instrument,
+    call_worker,
+    WorkerUnavailable,
+)
 
 
 @click.command(help="Relative abundance calculation", context_settings=CONTEXT_SETTINGS)
@@ -31,6 +36,13 @@ from modules.common import set_out_dir, CONTEXT_SETTINGS
     type=click.Path(exists=True, dir_okay=False, resolve_path=True, path_type=Path),
     required=True,
 )
+@click.option(
+    "--background",
+    "-b",
+    help="background model of control samples (.npz) for Z scores",
+    type=click.Path(exists=True, dir_okay=False, resolve_path=True, path_type=Path),
+    required=False,
+)
 @click.option(
     "--out_dir",
     "-o",
@@ -39,43 +51,31 @@ from modules.common import set_out_dir, CONTEXT_SETTINGS
     required=True,
 )
 @set_out_dir
-def main(hit_json, taxon_json, rpm_json, out_dir):
-    cols = ["Taxon", "Score", "Z score", "rPM", "r", "%id", "L"]
+@instrument("summary_report", sample_from="hit_json")
+def main(hit_json, taxon_json, rpm_json, background, out_dir):
+    try:
+        report_tsv = call_worker(
+            "summary_report",
+            hit_json=hit_json,
+            taxon_json=taxon_json,
+            rpm_json=rpm_json,
+            out_dir=out_dir,
+            background=background,
+        )
+        click.echo(f"Output: {report_tsv}")
+        return
+    except WorkerUnavailable:
+        pass
+    # imported only without a worker, which has them loaded already
+    from modules.report import species_report
+    from modules.taxonparse import read_taxonomy
+
     hits = json.loads(hit_json.read_text())
-    read2hit = {hit["qname"]: hit for hit in hits}
-    read2taxon = json.loads(taxon_json.read_text())
-    taxid2sp_taxid = {
-        taxon["taxid"]: taxon["lineage"]["species"]["taxid"]
-        for read_id, taxon in read2taxon.items()
-    }
+    taxonomy = read_taxonomy(taxon_json)
     taxid2rpms = json.loads(rpm_json.read_text())
 
-    sp_taxid2idents = {}
-    sp_taxid2aln_lens = {}
-    for read_id, hit in read2hit.items():
-        taxid = hit["tname"].split("|")[1]
-        sp_taxid = taxid2sp_taxid[taxid]
-        ident = hit["pident"]
-        aln_len = hit["alnlen"]
-        sp_taxid2idents.setdefault(sp_taxid, []).append(ident)
-        sp_taxid2aln_lens.setdefault(sp_taxid, []).append(aln_len)
-
-    rows = []
-
-    for sp_taxid, values in taxid2rpms.items():
-        rpm = values["rpm"]
-        r = values["hit_n"]
-        pident = round(
-            sum(sp_taxid2idents[sp_taxid]) / len(sp_taxid2idents[sp_taxid]) * 100, 2
-        )
-        aln_len = round(
-            sum(sp_taxid2aln_lens[sp_taxid]) / len(sp_taxid2aln_lens[sp_taxid]), 2
-        )
-        sp_name = values["taxon"]["lineage"]["species"]["name"]
-        rows.append([sp_name, "-", "-", rpm, r, pident, aln_len])
-
     sample_id = rpm_json.name.split(".")[0]
-    report_df = pd.DataFrame(rows, columns=cols)
+    report_df = species_report(hits, taxonomy, taxid2rpms, background=background)
     report_tsv = out_dir / f"{sample_id}.report.tsv"
     report_df.to_csv(report_tsv, sep="\t", index=False)
     click.echo(f"Output: {report_tsv}")
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+import sys
+import click
+from pathlib import Path
+from functools import partial
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from modules.common import set_out_dir, CONTEXT_SETTINGS, instrument
+from modules.report import assign_and_report
+from modules.taxonparse import map_with_lineages
+
+
+@click.command(
+    help="Assign taxa, calculate abundance and write the summary report in one step",
+    context_settings=CONTEXT_SETTINGS,
+)
+@click.option(
+    "--hit_json",
+    "-i",
+    help="input {sample_id}.hit.json (multiple allowed)",
+    type=click.Path(exists=True, dir_okay=False, resolve_path=True, path_type=Path),
+    multiple=True,
+)
+@click.option(
+    "--hit_dir",
+    help="directory of {sample_id}.hit.json, processed as one batch",
+    type=click.Path(exists=True, file_okay=False, resolve_path=True, path_type=Path),
+)
+@click.option(
+    "--taxdump_dir",
+    help="taxdump directory",
+    type=click.Path(exists=True, dir_okay=True, resolve_path=True, path_type=Path),
+    required=True,
+)
+@click.option(
+    "--count_mode",
+    help="count total reads or unique reads after dedup",
+    type=click.Choice(["total", "dedup"]),
+    default="total",
+    show_default=True,
+)
+@click.option(
+    "--background",
+    "-b",
+    help="background model of control samples (.npz) for Z scores",
+    type=click.Path(exists=True, dir_okay=False, resolve_path=True, path_type=Path),
+    required=False,
+)
+@click.option(
+    "--length_index",
+    "-l",
+    help="reference length index from build_db, adds RPKM and TPM",
+    type=click.Path(exists=True, file_okay=False, resolve_path=True, path_type=Path),
+    required=False,
+)
+@click.option(
+    "--threads",
+    "-t",
+    help="number of worker processes for a batch",
+    type=int,
+    default=1,
+    show_default=True,
+)
+@click.option(
+    "--out_dir",
+    "-o",
+    help="output directory",
+    type=click.Path(exists=False, dir_okay=True, resolve_path=True, path_type=Path),
+    required=True,
+)
+@set_out_dir
+@instrument("taxon_report", sample_from="hit_json")
+def main(
+    hit_json,
+    hit_dir,
+    taxdump_dir,
+    count_mode,
+    background,
+    length_index,
+    threads,
+    out_dir,
+):
+    hit_jsons = list(hit_json)
+    if hit_dir is not None:
+        hit_jsons.extend(sorted(hit_dir.glob("*.hit.json")))
+    if not hit_jsons:
+        raise click.UsageError("Either --hit_json or --hit_dir must be provided.")
+    results = map_with_lineages(
+        partial(
+            assign_and_report,
+            taxdump_dir=taxdump_dir,
+            out_dir=out_dir,
+            count_mode=count_mode,
+            background=background,
+            length_index=length_index,
+        ),
+        hit_jsons,
+        taxdump_dir,
+        workers=threads,
+    )
+    for outputs in results:
+        for output in outputs.values():
+            click.echo(f"Output: {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,7 +6,8 @@ from pathlib import Path
 from time import sleep
 
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
-from modules.common import check_seq_format, set_out_dir, AdvancedJSONEncoder
+from modules.common import set_out_dir, AdvancedJSONEncoder, instrument
+from modules.validate import validate_fastq
 
 
 @click.command(help="Validate the input files")
@@ -18,14 +19,17 @@ from modules.common import check_seq_format, set_out_dir, AdvancedJSONEncoder
 )
 @click.option("--out_dir", "-o", help="output directory")
 @set_out_dir
+@instrument("validate_input", sample_from="reads")
 def main(reads, out_dir):
     sample_id = reads.name.split(".")[0]
     valid_json = Path(out_dir) / f"{sample_id}.valid.json"
     valid_dct = {"valid_json": valid_json}
-    if check_seq_format(reads) != "fastq":
-        click.echo(f"{reads} is not a fastq")
-        raise click.Abort(f"{reads} is not a fastq")
-    valid_dct.update({"valid_fastq": reads})
+    try:
+        stats = validate_fastq(reads)
+    except ValueError as e:
+        click.echo(f"{reads} is not a valid fastq: {e}")
+        raise click.Abort(f"{reads} is not a valid fastq")
+    valid_dct.update({"valid_fastq": reads, "stats": stats})
     valid_json.write_text(json.dumps(valid_dct, indent=4, cls=AdvancedJSONEncoder))
     click.echo("OK")
     sleep(1)
@@ -0,0 +1,76 @@
+import os
+import time
+import signal
+import subprocess
+import pytest
+
+from modules.common import KILL_GRACE, run_pipeline
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+def test_lines_reach_callback():
+    lines = []
+    stages = run_pipeline(
+        [["sh", "-c", "printf 'a\\nb\\nc'"], ["cat"]], stdout=lines.append
+    )
+    assert lines == [b"a\n", b"b\n", b"c"]
+    assert [stage["returncode"] for stage in stages] == [0, 0]
+
+
+def test_failure_stops_the_other_stages(tmp_path):
+    pid_file = tmp_path / "pid"
+    start = time.time()
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        run_pipeline(
+            [
+                ["sh", "-c", f"echo $$ > {pid_file}; exec sleep 30"],
+                ["sh", "-c", "sleep 0.5; echo bad input >&2; exit 3"],
+                ["sleep", "30"],
+            ]
+        )
+    assert e.value.returncode == 3
+    assert "bad input" in e.value.stderr
+    assert time.time() - start < KILL_GRACE + 5
+    assert not _alive(int(pid_file.read_text()))
+
+
+def test_first_stage_failure(tmp_path):
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        run_pipeline([["false"], ["cat"]], stdout=tmp_path / "out")
+    assert e.value.cmd == ["false"]
+
+
+def test_upstream_sigpipe_is_not_a_failure(tmp_path):
+    out = tmp_path / "out"
+    stages = run_pipeline([["yes"], ["head", "-n", "5"]], stdout=out)
+    assert out.read_text() == "y\n" * 5
+    assert stages[0]["returncode"] == -signal.SIGPIPE
+    assert stages[1]["returncode"] == 0
+
+
+def test_timeout(tmp_path):
+    pid_file = tmp_path / "pid"
+    start = time.time()
+    with pytest.raises(subprocess.TimeoutExpired):
+        run_pipeline(
+            [["sh", "-c", f"echo $$ > {pid_file}; exec sleep 30"]], timeout=0.5
+        )
+    assert time.time() - start < KILL_GRACE + 5
+    assert not _alive(int(pid_file.read_text()))
+
+
+def test_callback_error_propagates():
+    def callback(line):
+        raise RuntimeError(f"bad line {line!r}")
+
+    start = time.time()
+    with pytest.raises(RuntimeError, match="bad line"):
+        run_pipeline([["yes"]], stdout=callback)
+    assert time.time() - start < KILL_GRACE + 5
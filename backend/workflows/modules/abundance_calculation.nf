@@ -1,7 +1,8 @@
 #!/usr/bin/env nextflow 
 
 process abundance_calculation {
-    publishDir "${params.out_dir}", mode: 'copy', pattern: 'rpm/*.rpm.json'
+    publishDir "${params.out_dir}", mode: 'copy', pattern: 'rpm/*'
+    publishDir "${params.out_dir}/metrics", mode: 'copy', pattern: '**.{metrics.json,prof,prof.txt,tracemalloc.txt}', saveAs: { file(it).name }
 
     input:
         path(hit_json)
@@ -10,8 +11,9 @@ process abundance_calculation {
         path(hit_json), emit: hit_json
         path(taxon_json), emit: taxon_json
         path("rpm/*.rpm.json"), emit: rpm_json
+        path("**.{metrics.json,prof,prof.txt,tracemalloc.txt}"), optional: true, emit: metrics
     script:
         """
-        python $workflow.projectDir/scripts/abundance_calculation.py --taxon_json ${taxon_json} --out_dir rpm
+        python $workflow.projectDir/scripts/abundance_calculation.py --taxon_json ${taxon_json} --count_mode ${params.count_mode} ${params.length_index ? "--length_index ${params.length_index}" : ''} --out_dir rpm
         """
 }
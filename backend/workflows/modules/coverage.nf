@@ -0,0 +1,16 @@
+#!/usr/bin/env nextflow 
+
+process coverage {
+    publishDir "${params.out_dir}", mode: 'copy', pattern: 'coverage/*.tsv'
+    publishDir "${params.out_dir}/metrics", mode: 'copy', pattern: '**.{metrics.json,prof,prof.txt,tracemalloc.txt}', saveAs: { file(it).name }
+    label "normal"
+    input:
+        tuple val(sample_id), path(hit_json), path(taxon_json)
+    output:
+        path("coverage/*.tsv")
+        path("**.{metrics.json,prof,prof.txt,tracemalloc.txt}"), optional: true, emit: metrics
+    script:
+        """
+        python $workflow.projectDir/scripts/coverage.py --hit_json ${hit_json} --taxon_json ${taxon_json} --out_dir coverage
+        """
+}
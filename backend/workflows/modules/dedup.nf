@@ -0,0 +1,19 @@
+#!/usr/bin/env nextflow 
+
+process dedup_reads {
+    label "normal"
+    publishDir "${params.out_dir}", mode: 'copy', pattern: 'dedup_reads/*'
+    publishDir "${params.out_dir}/metrics", mode: 'copy', pattern: '**.{metrics.json,prof,prof.txt,tracemalloc.txt}', saveAs: { file(it).name }
+    input:
+        path(reads)
+    output:
+        path("dedup_reads/*.dedup.fq"), emit: dedup_reads
+        path("dedup_reads/*.dedup.json"), emit: dedup_json
+        path("**.{metrics.json,prof,prof.txt,tracemalloc.txt}"), optional: true, emit: metrics
+    script:
+    """
+    python $workflow.projectDir/scripts/dedup.py \\
+    --fastq_1 $reads \\
+    --out_dir dedup_reads
+    """
+}
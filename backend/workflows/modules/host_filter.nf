@@ -4,10 +4,12 @@ process host_filter {
     label "performance"
     cpus = 3
     publishDir "${params.out_dir}", mode: 'copy', pattern: 'nonhuman/*.nonhuman.fq'
+    publishDir "${params.out_dir}/metrics", mode: 'copy', pattern: '**.{metrics.json,prof,prof.txt,tracemalloc.txt}', saveAs: { file(it).name }
     input:
         path(reads)    
     output:
         path("nonhuman/*.qc.nonhuman.fq"), emit: nonhuman_reads
+        path("**.{metrics.json,prof,prof.txt,tracemalloc.txt}"), optional: true, emit: metrics
     
     script:
     """
@@ -16,6 +18,8 @@ process host_filter {
     --out_dir nonhuman \\
     --bowtie2_idx $params.bowtie2_idx \\
     --hisat2_idx $params.hisat2_idx \\
+    ${params.shared_index ? '--shared_index' : ''} \\
+    ${params.subsample_first ? "--subsample_first --subsample_n ${params.subsample_n}" : ''} \\
     --threads ${task.cpus} 
     """
 
@@ -24,14 +28,45 @@ process host_filter {
 process subsample_reads {
     label "normal"
     publishDir "${params.out_dir}", mode: 'copy', pattern: 'subsampled_reads/*.subsampled.fq'
+    publishDir "${params.out_dir}/metrics", mode: 'copy', pattern: '**.{metrics.json,prof,prof.txt,tracemalloc.txt}', saveAs: { file(it).name }
     input:
         path(reads)
     output:
         path("subsampled_reads/*.subsampled.fq"), emit: subsampled_reads
+        path("**.{metrics.json,prof,prof.txt,tracemalloc.txt}"), optional: true, emit: metrics
     script:
     """
     python $workflow.projectDir/scripts/subsample.py \\
     --reads $reads \\
+    --subsample_n $params.subsample_n \\
     --out_dir subsampled_reads
     """
-} 
\ No newline at end of file
+} 
+
+process adaptive_sample {
+    label "performance"
+    publishDir "${params.out_dir}", mode: 'copy', pattern: 'subsampled_reads/*.{subsampled.fq,adaptive.json}'
+    publishDir "${params.out_dir}", mode: 'copy', pattern: 'subsampled_reads/*.hit.json', saveAs: { "hit/${file(it).name}" }
+    publishDir "${params.out_dir}/metrics", mode: 'copy', pattern: '**.{metrics.json,prof,prof.txt,tracemalloc.txt}', saveAs: { file(it).name }
+    input:
+        path(reads)
+    output:
+        path("subsampled_reads/*.subsampled.fq"), emit: subsampled_reads
+        path("subsampled_reads/*.hit.json"), emit: hit_json
+        path("subsampled_reads/*.adaptive.json"), emit: trace
+        path("**.{metrics.json,prof,prof.txt,tracemalloc.txt}"), optional: true, emit: metrics
+    script:
+    """
+    python $workflow.projectDir/scripts/adaptive_sample.py \\
+    --reads $reads \\
+    --reference $params.nonhuman_db \\
+    --taxdump_dir $params.taxdump_dir \\
+    --start_n $params.adaptive_start_n \\
+    --subsample_n $params.subsample_n \\
+    --top_n $params.adaptive_top_n \\
+    --tolerance $params.adaptive_tolerance \\
+    --read_type $params.read_type \\
+    --threads $params.threads \\
+    --out_dir subsampled_reads
+    """
+}
@@ -2,29 +2,32 @@
 
 process pathogen_alignment {
     publishDir "${params.out_dir}", mode: 'copy', pattern: 'hit/*.hit.json'
+    publishDir "${params.out_dir}/metrics", mode: 'copy', pattern: '**.{metrics.json,prof,prof.txt,tracemalloc.txt}', saveAs: { file(it).name }
 
     label "performance"
     input:
         path(reads)
     output:
         path('hit/*.hit.json'), emit: hit_json
+        path("**.{metrics.json,prof,prof.txt,tracemalloc.txt}"), optional: true, emit: metrics
     script:
     """
-    python $workflow.projectDir/scripts/pathogen_alignment.py --out_dir hit --queries $reads --reference $params.nonhuman_db --threads $params.threads
+    python $workflow.projectDir/scripts/pathogen_alignment.py --out_dir hit --queries $reads --reference $params.nonhuman_db --threads $params.threads ${params.aln_cache_dir ? "--cache_dir ${params.aln_cache_dir} --cache_size ${params.aln_cache_size}" : ''} ${params.incremental ? "--partial_dir ${file(params.out_dir)}/partial --taxdump_dir ${params.taxdump_dir} --snapshot_interval ${params.snapshot_interval} --chunk_reads ${params.chunk_reads}" : ''}
     """
 }
 
 process assign_taxon {
     publishDir "${params.out_dir}", mode: 'copy', pattern: 'taxon/*.taxonomy.json'
+    publishDir "${params.out_dir}/metrics", mode: 'copy', pattern: '**.{metrics.json,prof,prof.txt,tracemalloc.txt}', saveAs: { file(it).name }
 
     label "normal"
     input:
-        path(hit_json)
+        path(hit_jsons)
     output:
-        path(hit_json), emit: hit_json
         path("taxon/*.taxonomy.json"), emit: taxon_json
+        path("**.{metrics.json,prof,prof.txt,tracemalloc.txt}"), optional: true, emit: metrics
     script:
     """
-    python $workflow.projectDir/scripts/assign_taxon.py --hit_json $hit_json --out_dir taxon --taxdump_dir $params.taxdump_dir
+    python $workflow.projectDir/scripts/assign_taxon.py --hit_dir . --out_dir taxon --taxdump_dir $params.taxdump_dir --threads $params.sub_threads
     """
 }
\ No newline at end of file
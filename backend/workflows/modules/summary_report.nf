@@ -2,15 +2,34 @@
 
 process summary_report {
     publishDir "${params.out_dir}", mode: 'copy', pattern: 'report/*.report.tsv'
+    publishDir "${params.out_dir}/metrics", mode: 'copy', pattern: '**.{metrics.json,prof,prof.txt,tracemalloc.txt}', saveAs: { file(it).name }
     label "normal"
     input:
         path(hit_json)
         path(taxon_json)
         path(rpm_json)
     output:
-        path("report/*.report.tsv")
+        path("report/*.report.tsv"), emit: report
+        path("**.{metrics.json,prof,prof.txt,tracemalloc.txt}"), optional: true, emit: metrics
     script:
         """
-        python $workflow.projectDir/scripts/summary_report.py --hit_json ${hit_json} --taxon_json ${taxon_json} --rpm_json ${rpm_json}  --out_dir report
+        python $workflow.projectDir/scripts/summary_report.py --hit_json ${hit_json} --taxon_json ${taxon_json} --rpm_json ${rpm_json} ${params.background_model ? "--background ${params.background_model}" : ''} --out_dir report
         """
-}
\ No newline at end of file
+}
+
+process taxon_report {
+    publishDir "${params.out_dir}", mode: 'copy', pattern: '{taxon,rpm,report}/*'
+    publishDir "${params.out_dir}/metrics", mode: 'copy', pattern: '**.{metrics.json,prof,prof.txt,tracemalloc.txt}', saveAs: { file(it).name }
+    label "normal"
+    input:
+        path(hit_jsons)
+    output:
+        path("taxon/*.taxonomy.json"), emit: taxon_json
+        path("rpm/*.rpm.json"), emit: rpm_json
+        path("report/*.report.tsv"), emit: report
+        path("**.{metrics.json,prof,prof.txt,tracemalloc.txt}"), optional: true, emit: metrics
+    script:
+        """
+        python $workflow.projectDir/scripts/taxon_report.py --hit_dir . --threads $params.sub_threads --taxdump_dir $params.taxdump_dir --count_mode ${params.count_mode} ${params.background_model ? "--background ${params.background_model}" : ''} ${params.length_index ? "--length_index ${params.length_index}" : ''} --out_dir .
+        """
+}
@@ -3,12 +3,14 @@ nextflow.enable.dsl = 2
 
 process validate_reads {
     publishDir "${params.out_dir}" , mode: 'copy', pattern: 'valid_reads/*.json'
+    publishDir "${params.out_dir}/metrics", mode: 'copy', pattern: '**.{metrics.json,prof,prof.txt,tracemalloc.txt}', saveAs: { file(it).name }
     label "normal"
     input:
         path(reads)
     output:
         path('valid_reads/*.json'), emit: valid_json
         path(reads), emit: valid_reads
+        path("**.{metrics.json,prof,prof.txt,tracemalloc.txt}"), optional: true, emit: metrics
     script:
     """
     python $workflow.projectDir/scripts/validate_input.py \\